@@ -0,0 +1,202 @@
+"""
+Admission control for the Inventory Service
+
+When the database slows down, requests that are admitted anyway only
+queue up and time out. Each route class (read, write, bulk, reset) has a
+limit on the requests it may have in flight in a worker, and a request
+over the limit is answered at once with 503 Service Unavailable and a
+Retry-After header instead.
+
+The read and write limits adapt to latency, much like TCP Vegas adapts
+its window: the limit is scaled by the ratio of the long term latency to
+the recent latency, so it shrinks as soon as requests start taking
+longer than usual, and grows back by a small allowance for queueing
+while latency is normal and the limit is in use.
+
+Bulk and reset requests have small fixed limits and are shed first: they
+are only admitted while the interactive classes use less than
+ADMISSION_BULK_HEADROOM of their limits, so that imports and exports
+cannot take the capacity interactive traffic needs.
+"""
+import os
+import math
+import time
+import threading
+
+# turn admission control off with ADMISSION_CONTROL=false
+ADMISSION_CONTROL = os.environ.get('ADMISSION_CONTROL', 'True').lower() == 'true'
+# adaptive limits of the interactive classes
+ADMISSION_INITIAL_LIMIT = int(os.environ.get('ADMISSION_INITIAL_LIMIT', 100))
+ADMISSION_MIN_LIMIT = int(os.environ.get('ADMISSION_MIN_LIMIT', 10))
+ADMISSION_MAX_LIMIT = int(os.environ.get('ADMISSION_MAX_LIMIT', 1000))
+# recent latency may exceed the long term latency this much before the limit shrinks
+ADMISSION_TOLERANCE = float(os.environ.get('ADMISSION_TOLERANCE', 2.0))
+# fixed limits of the deprioritized classes
+ADMISSION_BULK_LIMIT = int(os.environ.get('ADMISSION_BULK_LIMIT', 2))
+ADMISSION_RESET_LIMIT = int(os.environ.get('ADMISSION_RESET_LIMIT', 1))
+# share of the interactive limits that must be free for bulk requests
+ADMISSION_BULK_HEADROOM = float(os.environ.get('ADMISSION_BULK_HEADROOM', 0.5))
+# seconds clients are asked to wait after being shed (bulk: five times as long)
+ADMISSION_RETRY_AFTER = int(os.environ.get('ADMISSION_RETRY_AFTER', 1))
+
+# weights of the latest latency in the recent and long term averages
+RECENT_WEIGHT = 0.1
+LONG_TERM_WEIGHT = 0.002
+# weight of a newly computed limit against the current one
+LIMIT_SMOOTHING = 0.2
+
+INTERACTIVE = ('read', 'write')
+
+
+class Overloaded(Exception):
+    """ Raised for a request that is shed """
+
+    def __init__(self, route_class, retry_after):
+        super(Overloaded, self).__init__(
+            'The service is overloaded with {} requests, retry in {} seconds'.format(
+                route_class, retry_after))
+        self.route_class = route_class
+        self.retry_after = retry_after
+
+
+class FixedLimit(object):
+    """ A limit that does not change """
+
+    def __init__(self, limit):
+        self.limit = limit
+
+    def update(self, latency, inflight, failed):
+        """ Ignores a completed request """
+        pass
+
+    def serialize(self):
+        """ Serializes the limit into a dictionary """
+        return {'limit': self.limit}
+
+
+class GradientLimit(object):
+    """ A concurrency limit that follows the latency of completed requests """
+
+    def __init__(self, initial=None, minimum=None, maximum=None, tolerance=None):
+        self.limit = float(initial or ADMISSION_INITIAL_LIMIT)
+        self.minimum = minimum or ADMISSION_MIN_LIMIT
+        self.maximum = maximum or ADMISSION_MAX_LIMIT
+        self.tolerance = tolerance or ADMISSION_TOLERANCE
+        self.recent = None          # seconds, moving average of the latest requests
+        self.long_term = None       # seconds, slowly moving average
+
+    def update(self, latency, inflight, failed):
+        """ Adjusts the limit after a request completed """
+        if failed:
+            # errors from an overloaded backend shrink the limit at once
+            self.limit = max(self.minimum, self.limit * 0.9)
+            return
+        if self.recent is None:
+            self.recent = self.long_term = latency
+            return
+        self.recent += RECENT_WEIGHT * (latency - self.recent)
+        self.long_term += LONG_TERM_WEIGHT * (latency - self.long_term)
+        if self.long_term > 2 * self.recent:
+            # latency dropped for good: let the baseline catch up
+            self.long_term *= 0.95
+        gradient = max(0.5, min(1.0, self.tolerance * self.long_term / self.recent))
+        limit = self.limit * gradient + math.sqrt(self.limit)
+        if limit > self.limit and inflight < self.limit / 2:
+            return      # the limit is not what holds requests back, so keep it
+        limit = self.limit * (1 - LIMIT_SMOOTHING) + limit * LIMIT_SMOOTHING
+        self.limit = max(self.minimum, min(self.maximum, limit))
+
+    def serialize(self):
+        """ Serializes the limit into a dictionary """
+        return {'limit': int(self.limit),
+                'latency': self.recent,
+                'baseline': self.long_term}
+
+
+class AdmissionController(object):
+    """ In-flight request limits per route class """
+
+    def __init__(self):
+        self.limits = {
+            'read': GradientLimit(),
+            'write': GradientLimit(),
+            'bulk': FixedLimit(ADMISSION_BULK_LIMIT),
+            'reset': FixedLimit(ADMISSION_RESET_LIMIT),
+        }
+        self.inflight = dict((name, 0) for name in self.limits)
+        self.admitted = dict((name, 0) for name in self.limits)
+        self.shed = dict((name, 0) for name in self.limits)
+        self.lock = threading.Lock()
+
+    def _busy(self):
+        """ Returns True if interactive traffic needs the headroom bulk would use """
+        return any(self.inflight[name] >=
+                   self.limits[name].limit * (1 - ADMISSION_BULK_HEADROOM)
+                   for name in INTERACTIVE)
+
+    def acquire(self, route_class):
+        """ Admits a request; returns False if it should be shed """
+        with self.lock:
+            saturated = self.inflight[route_class] >= self.limits[route_class].limit
+            if not saturated and route_class not in INTERACTIVE:
+                saturated = self._busy()
+            if saturated:
+                self.shed[route_class] += 1
+                return False
+            self.inflight[route_class] += 1
+            self.admitted[route_class] += 1
+            return True
+
+    def release(self, route_class, latency, failed=False):
+        """ Records that an admitted request completed """
+        with self.lock:
+            inflight = self.inflight[route_class]
+            self.inflight[route_class] -= 1
+            self.limits[route_class].update(latency, inflight, failed)
+
+    def retry_after(self, route_class):
+        """ Returns the seconds a shed client should wait before retrying """
+        if route_class in INTERACTIVE:
+            return ADMISSION_RETRY_AFTER
+        return ADMISSION_RETRY_AFTER * 5
+
+    def serialize(self):
+        """ Serializes the limits and counters of every class into a dictionary """
+        with self.lock:
+            return dict((name, dict(self.limits[name].serialize(),
+                                    inflight=self.inflight[name],
+                                    admitted=self.admitted[name],
+                                    shed=self.shed[name]))
+                        for name in self.limits)
+
+
+class Ticket(object):
+    """ An admitted request, released exactly once """
+
+    def __init__(self, controller, route_class):
+        self.controller = controller
+        self.route_class = route_class
+        self.started = time.time()
+        self.released = False
+
+    def release(self, failed=False):
+        """ Releases the request's slot """
+        if not self.released:
+            self.released = True
+            self.controller.release(self.route_class, time.time() - self.started, failed)
+
+
+controller = AdmissionController()
+
+def admit(route_class):
+    """
+    Admits a request of a route class
+
+    Returns the Ticket to release when the request completes, or None if
+    the class is not limited. Raises Overloaded if the request is shed.
+    """
+    if not ADMISSION_CONTROL or route_class is None:
+        return None
+    if not controller.acquire(route_class):
+        raise Overloaded(route_class, controller.retry_after(route_class))
+    return Ticket(controller, route_class)
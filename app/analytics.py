@@ -0,0 +1,196 @@
+"""
+In-memory stock analytics for the Inventory Service
+
+An AnalyticsSnapshot holds the whole inventory as NumPy columns: count as
+int64, available as bool and category and condition as integer codes into
+tables of distinct values. It is loaded once and then kept current from
+the _changes feed, so group-by sums, percentiles and top-N queries are
+vectorized operations over memory rather than database scans. Queries
+run under the same lock as refreshes, which replace and fill the columns.
+"""
+import os
+import time
+import threading
+import numpy as np
+from .models import Inventory, QUERY_LIMIT
+
+# seconds a snapshot may be served before it is refreshed from _changes
+ANALYTICS_MAX_AGE = float(os.environ.get('ANALYTICS_MAX_AGE', 1))
+# rows the columns grow by when they fill up, at least
+ANALYTICS_GROWTH = 1024
+
+CODED_FIELDS = ('category', 'condition')
+
+
+class AnalyticsSnapshot(object):
+    """ Column-wise copy of the inventory kept current from _changes """
+
+    def __init__(self, database):
+        self.database = database
+        self.size = 0
+        self.rows = {}      # id -> row
+        self.ids = np.empty(0, dtype=object)
+        self.names = np.empty(0, dtype=object)
+        self.count = np.zeros(0, dtype=np.int64)
+        self.available = np.zeros(0, dtype=bool)
+        self.live = np.zeros(0, dtype=bool)
+        self.codes = dict((field, np.zeros(0, dtype=np.int32)) for field in CODED_FIELDS)
+        self.values = dict((field, []) for field in CODED_FIELDS)
+        self.lookup = dict((field, {}) for field in CODED_FIELDS)
+        self.checkpoint = None
+        self.refreshed = 0
+        self.lock = threading.RLock()     # queries call mask() while holding it
+
+    def _grow(self, needed):
+        """ Makes room for at least needed rows """
+        capacity = len(self.count)
+        if needed <= capacity:
+            return
+        capacity = max(needed, capacity * 2, ANALYTICS_GROWTH)
+        for name in ('ids', 'names', 'count', 'available', 'live'):
+            column = getattr(self, name)
+            grown = np.zeros(capacity, dtype=column.dtype)
+            grown[:len(column)] = column
+            setattr(self, name, grown)
+        for field in CODED_FIELDS:
+            grown = np.zeros(capacity, dtype=np.int32)
+            grown[:len(self.codes[field])] = self.codes[field]
+            self.codes[field] = grown
+
+    def _code(self, field, value):
+        """ Returns the code of a category or condition """
+        lookup = self.lookup[field]
+        if value not in lookup:
+            lookup[value] = len(self.values[field])
+            self.values[field].append(value)
+        return lookup[value]
+
+    def _put(self, inventory_id, inventory):
+        """ Adds, replaces or (for None) removes one row """
+        row = self.rows.get(inventory_id)
+        if inventory is None:
+            if row is not None:
+                self.live[row] = False
+            return
+        if row is None:
+            self._grow(self.size + 1)
+            row = self.rows[inventory_id] = self.size
+            self.size += 1
+        self.ids[row] = inventory_id
+        self.names[row] = inventory.name
+        try:
+            self.count[row] = int(inventory.count)
+        except (TypeError, ValueError):
+            self.count[row] = 0
+        self.available[row] = inventory.available is True
+        self.live[row] = True
+        for field in CODED_FIELDS:
+            self.codes[field][row] = self._code(field, getattr(inventory, field))
+
+    def load(self):
+        """ Loads every document and records where the _changes feed is """
+        _, checkpoint, _ = Inventory.changes(since='now')
+        for inventory in Inventory.iterate():
+            self._put(inventory.id, inventory)
+        self.checkpoint = checkpoint
+        self._apply_changes()
+
+    def _apply_changes(self):
+        """ Applies the changes made since the checkpoint """
+        while True:
+            changes, checkpoint, complete = Inventory.changes(since=self.checkpoint,
+                                                              limit=QUERY_LIMIT)
+            for _, inventory_id, inventory in changes:
+                self._put(inventory_id, inventory)
+            self.checkpoint = checkpoint
+            if complete:
+                break
+        self.refreshed = time.time()
+
+    def refresh(self, max_age=None):
+        """ Brings the snapshot up to date if it is older than max_age seconds """
+        max_age = ANALYTICS_MAX_AGE if max_age is None else max_age
+        with self.lock:
+            if self.checkpoint is None:
+                self.load()
+            elif time.time() - self.refreshed >= max_age:
+                self._apply_changes()
+
+    ##################################################################
+    # Queries
+    ##################################################################
+
+    def mask(self, **selector):
+        """ Returns a boolean array of the live rows matching the selector """
+        with self.lock:
+            mask = self.live[:self.size].copy()
+            for field, value in selector.items():
+                if field in CODED_FIELDS:
+                    code = self.lookup[field].get(value)
+                    if code is None:
+                        return np.zeros(self.size, dtype=bool)
+                    mask &= self.codes[field][:self.size] == code
+                elif field == 'available':
+                    mask &= self.available[:self.size] == bool(value)
+                elif field == 'name':
+                    mask &= self.names[:self.size] == value
+                else:
+                    raise KeyError(field)
+            return mask
+
+    def total(self, **selector):
+        """ Returns the number of items and the total count matching the selector """
+        with self.lock:
+            mask = self.mask(**selector)
+            return int(mask.sum()), int(self.count[:self.size][mask].sum())
+
+    def sum_by(self, field, **selector):
+        """ Returns the total count per category or condition """
+        with self.lock:
+            if field not in CODED_FIELDS:
+                raise KeyError(field)
+            mask = self.mask(**selector)
+            values = self.values[field]
+            codes = self.codes[field][:self.size][mask]
+            items = np.bincount(codes, minlength=len(values))
+            sums = np.bincount(codes, weights=self.count[:self.size][mask],
+                               minlength=len(values))
+            return dict((values[code], int(sums[code]))
+                        for code in np.flatnonzero(items))
+
+    def percentiles(self, percents, **selector):
+        """ Returns the count at each percentile """
+        with self.lock:
+            counts = self.count[:self.size][self.mask(**selector)]
+            if not len(counts):
+                return {}
+            return dict((percent, float(value)) for percent, value in
+                        zip(percents, np.percentile(counts, percents)))
+
+    def top(self, number, ascending=False, **selector):
+        """ Returns (id, name, count) of the number highest (or lowest) counts """
+        with self.lock:
+            rows = np.flatnonzero(self.mask(**selector))
+            if not len(rows) or number <= 0:
+                return []
+            counts = self.count[rows]
+            keys = counts if ascending else -counts
+            if number < len(rows):
+                best = np.argpartition(keys, number - 1)[:number]
+            else:
+                best = np.arange(len(rows))
+            best = best[np.argsort(keys[best], kind='mergesort')]
+            return [(self.ids[rows[i]], self.names[rows[i]], int(counts[i])) for i in best]
+
+_snapshot = None
+_snapshot_lock = threading.Lock()
+
+def current_snapshot():
+    """ Returns this process's snapshot of the database, refreshed """
+    global _snapshot
+    with _snapshot_lock:
+        if _snapshot is None or _snapshot.database is not Inventory.database:
+            _snapshot = AnalyticsSnapshot(Inventory.database)
+        snapshot = _snapshot
+    snapshot.refresh()
+    return snapshot
@@ -0,0 +1,471 @@
+"""
+Bulk import and export for the Inventory Service
+
+Import reads CSV or NDJSON files as streams, validates each chunk of rows
+with Inventory.deserialize_many and writes them in _bulk_docs chunks from a small
+pool of writer threads. At most IMPORT_WORKERS chunks are queued or in
+flight at any time, so memory stays constant whatever the file size.
+
+Export is the reverse: a generator that turns Inventory into CSV or
+NDJSON text a chunk of rows at a time.
+
+Bulk updates apply the same partial update to every Inventory matching a
+selector, reading and writing back _bulk_docs chunks from the same pool
+of writer threads.
+
+Migration copies another database into the current one through the same
+importer, moving every document into the partition of its category.
+"""
+import os
+import sys
+import csv
+import json
+import logging
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+from .models import Inventory, DataValidationError, QUERY_LIMIT, partition_key, partition_of
+
+# rows per _bulk_docs request and number of concurrent requests
+IMPORT_CHUNK_SIZE = int(os.environ.get('IMPORT_CHUNK_SIZE', 500))
+IMPORT_WORKERS = int(os.environ.get('IMPORT_WORKERS', 4))
+# row errors kept in the summary; later ones are only counted
+IMPORT_MAX_ERRORS = int(os.environ.get('IMPORT_MAX_ERRORS', 100))
+# rows written per chunk of an export response
+EXPORT_CHUNK_SIZE = int(os.environ.get('EXPORT_CHUNK_SIZE', 100))
+# times a bulk update re-reads and writes documents that changed under it
+UPDATE_CONFLICT_RETRIES = int(os.environ.get('UPDATE_CONFLICT_RETRIES', 3))
+
+# exportable fields, in column order
+FIELDS = ('id', 'name', 'category', 'available', 'condition', 'count')
+
+logger = logging.getLogger(__name__)
+
+
+class ImportSummary(object):
+    """ Running totals for an import, shared by the writer threads """
+
+    def __init__(self):
+        self.imported = 0
+        self.failed = 0
+        self.errors = []
+        self.lock = threading.Lock()
+
+    def succeed(self, count=1):
+        """ Records rows that were written """
+        with self.lock:
+            self.imported += count
+
+    def fail(self, row, message):
+        """ Records a row that was rejected """
+        with self.lock:
+            self.failed += 1
+            if len(self.errors) < IMPORT_MAX_ERRORS:
+                self.errors.append({'row': row, 'error': message})
+
+    def serialize(self):
+        """ Serializes the summary into a dictionary """
+        return {'imported': self.imported,
+                'failed': self.failed,
+                'errors': sorted(self.errors, key=lambda error: error['row'])}
+
+
+######################################################################
+#  R E A D E R S
+######################################################################
+
+def read_csv(stream):
+    """
+    Yields the rows of a CSV stream as dictionaries
+
+    The values are decoded by parse_csv_row, so that a row of invalid
+    UTF-8 is reported on its own rather than ending the import.
+    """
+    if sys.version_info[0] < 3:
+        for row in csv.DictReader(stream):
+            yield row
+    else:
+        lines = (line.decode('utf-8', 'surrogateescape') for line in stream)
+        for row in csv.DictReader(lines):
+            yield row
+
+def parse_csv_row(row):
+    """ Returns a CSV row as unicode strings; the Inventory schema coerces them """
+    if None in row:
+        raise DataValidationError('Invalid inventory: row has more columns than the header')
+    try:
+        if sys.version_info[0] < 3:
+            return dict((key.decode('utf-8'), value.decode('utf-8') if value is not None
+                         else None) for key, value in row.items())
+        for key, value in row.items():
+            key.encode('utf-8')
+            if value is not None:
+                value.encode('utf-8')
+        return dict(row)
+    except UnicodeError:
+        raise DataValidationError('Invalid inventory: row is not valid UTF-8')
+
+def read_ndjson(stream):
+    """ Yields the non blank lines of an NDJSON stream """
+    for line in stream:
+        if line.strip():
+            yield line
+
+def parse_ndjson_line(line):
+    """ Parses one NDJSON line """
+    try:
+        return json.loads(line)
+    except ValueError:
+        raise DataValidationError('Invalid inventory: line is not valid JSON')
+
+FORMATS = {
+    'csv': (read_csv, parse_csv_row),
+    'ndjson': (read_ndjson, parse_ndjson_line),
+}
+
+MIMETYPES = {
+    'text/csv': 'csv',
+    'application/x-ndjson': 'ndjson',
+}
+
+
+######################################################################
+#  W R I T E R S
+######################################################################
+
+def write_csv(rows, fields):
+    """ Yields a CSV header and then one line per row """
+    buffer = StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(fields)
+    yield buffer.getvalue()
+    for row in rows:
+        buffer.seek(0)
+        buffer.truncate()
+        values = [row.get(field) for field in fields]
+        if sys.version_info[0] < 3:
+            values = [value.encode('utf-8') if isinstance(value, unicode) else value
+                      for value in values]
+        writer.writerow(values)
+        yield buffer.getvalue()
+
+def write_ndjson(rows, fields):
+    """ Yields one JSON object per line """
+    for row in rows:
+        yield json.dumps(dict((field, row.get(field)) for field in fields)) + '\n'
+
+WRITERS = {
+    'csv': (write_csv, 'text/csv'),
+    'ndjson': (write_ndjson, 'application/x-ndjson'),
+}
+
+def export_rows(inventories, file_format, fields=FIELDS):
+    """
+    Returns a generator of CSV or NDJSON text, EXPORT_CHUNK_SIZE rows per chunk
+
+    The format and fields are checked before anything is generated, so the
+    caller can still report an error before streaming a response.
+
+    Args:
+        inventories: an iterable of Inventory, e.g. Inventory.iterate()
+        file_format (str): 'csv' or 'ndjson'
+        fields (list): the fields to write, in order
+    """
+    if file_format not in WRITERS:
+        raise DataValidationError('Unsupported export format: {}'.format(file_format))
+    unknown = set(fields) - set(FIELDS)
+    if unknown:
+        raise DataValidationError('Unknown fields: {}'.format(', '.join(sorted(unknown))))
+    return _chunks(WRITERS[file_format][0], inventories, fields)
+
+def _chunks(writer, inventories, fields):
+    """ Joins the lines of a writer into chunks """
+    chunk = []
+    for line in writer((inventory.serialize() for inventory in inventories), fields):
+        chunk.append(line)
+        if len(chunk) >= EXPORT_CHUNK_SIZE:
+            yield ''.join(chunk)
+            chunk = []
+    if chunk:
+        yield ''.join(chunk)
+
+
+######################################################################
+#  I M P O R T E R
+######################################################################
+
+def import_file(stream, file_format, progress=None, seed=None):
+    """
+    Imports a CSV or NDJSON stream into the database
+
+    Args:
+        stream: a binary file-like object to read rows from
+        file_format (str): 'csv' or 'ndjson'
+        progress (callable): called with the ImportSummary after each chunk
+        seed (str): derives the ids of the rows, see import_rows
+    """
+    if file_format not in FORMATS:
+        raise DataValidationError('Unsupported import format: {}'.format(file_format))
+    reader, parse = FORMATS[file_format]
+    return import_rows(reader(stream), parse, progress=progress, seed=seed)
+
+def import_rows(records, parse, chunk_size=None, workers=None, progress=None,
+                validate=True, seed=None):
+    """
+    Validates records and writes them in concurrent _bulk_docs chunks
+
+    With validate=False the parsed records are taken to be documents that
+    were read from the database, and are written as they are. With a seed
+    (see idempotency.request_seed) each row's id is derived from the seed
+    and the row number, so rows that a repeated import already wrote
+    conflict and are counted as imported rather than written twice.
+    """
+    chunk_size = chunk_size or IMPORT_CHUNK_SIZE
+    workers = workers or IMPORT_WORKERS
+    summary = ImportSummary()
+    chunks = queue.Queue(maxsize=workers)
+
+    def write():
+        """ Writes queued chunks until it receives None """
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                return
+            seeds = [u'{}-{}'.format(seed, row) for row, _ in chunk] if seed else None
+            try:
+                results = Inventory.create_many([inventory for _, inventory in chunk],
+                                                seeds=seeds)
+            except Exception as err:    # a writer that died would leave the reader blocked
+                logger.error('Bulk write failed: %s', err)
+                for row, _ in chunk:
+                    summary.fail(row, str(err))
+            else:
+                for (row, _), result in zip(chunk, results):
+                    if 'error' in result:
+                        summary.fail(row, result.get('reason') or result['error'])
+                    else:
+                        summary.succeed()
+            if progress:
+                progress(summary)
+
+    threads = [threading.Thread(target=write, name='inventory-import')
+               for _ in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    def queue_chunk(chunk):
+        """ Validates a chunk of (row, data) and queues its valid rows """
+        rows = [row for row, _ in chunk]
+        documents = [data for _, data in chunk]
+        if validate:
+            results = Inventory.deserialize_many(documents)
+        else:
+            results = [(Inventory.from_document(data), None) for data in documents]
+        valid = []
+        for row, (inventory, error) in zip(rows, results):
+            if error:
+                summary.fail(row, error)
+            else:
+                valid.append((row, inventory))
+        if valid:
+            chunks.put(valid)
+
+    chunk = []
+    try:
+        for row, record in enumerate(records, 1):
+            try:
+                chunk.append((row, parse(record)))
+            except DataValidationError as err:
+                summary.fail(row, str(err))
+            if len(chunk) == chunk_size:
+                queue_chunk(chunk)
+                chunk = []
+        if chunk:
+            queue_chunk(chunk)
+    finally:
+        for _ in threads:
+            chunks.put(None)
+        for thread in threads:
+            thread.join()
+    return summary
+
+
+######################################################################
+#  B U L K   U P D A T E S
+######################################################################
+
+class UpdateSummary(object):
+    """ Running totals for a bulk update, shared by the writer threads """
+
+    def __init__(self, matched):
+        self.matched = matched
+        self.updated = 0
+        self.unchanged = 0
+        self.skipped = 0        # deleted, or no longer matching, when read
+        self.failed = 0
+        self.errors = []
+        self.lock = threading.Lock()
+
+    def count(self, updated=0, unchanged=0, skipped=0):
+        """ Records documents that were written, already up to date, or left alone """
+        with self.lock:
+            self.updated += updated
+            self.unchanged += unchanged
+            self.skipped += skipped
+
+    def fail(self, inventory_id, message):
+        """ Records a document that could not be updated """
+        with self.lock:
+            self.failed += 1
+            if len(self.errors) < IMPORT_MAX_ERRORS:
+                self.errors.append({'id': inventory_id, 'error': message})
+
+    def serialize(self):
+        """ Serializes the summary into a dictionary """
+        return {'matched': self.matched,
+                'updated': self.updated,
+                'unchanged': self.unchanged,
+                'skipped': self.skipped,
+                'failed': self.failed,
+                'errors': sorted(self.errors, key=lambda error: error['id'])}
+
+def update_chunk(inventory_ids, selector, changes, summary):
+    """
+    Applies changes to a chunk of documents with one read and one write
+
+    Documents that were changed by someone else between the read and the
+    write are read and written again, up to UPDATE_CONFLICT_RETRIES times.
+    Documents that no longer match the selector are skipped. Every id is
+    counted once: if a request fails, only the ids still pending fail.
+    """
+    pending = list(inventory_ids)
+    try:
+        for attempt in range(UPDATE_CONFLICT_RETRIES + 1):
+            documents = Inventory.documents(pending)
+            changed = []
+            for inventory_id in pending:
+                document = documents.get(inventory_id)
+                if document is None or not all(document.get(field) == value
+                                               for field, value in selector.items()):
+                    summary.count(skipped=1)    # deleted or changed since it matched
+                    continue
+                if all(document.get(field) == value for field, value in changes.items()):
+                    summary.count(unchanged=1)
+                    continue
+                document.update(changes)
+                changed.append(document)
+            pending = [document['_id'] for document in changed]
+            if not changed:
+                return
+            conflicts = []
+            for document, result in zip(changed, Inventory.save_many(changed)):
+                if 'error' not in result:
+                    summary.count(updated=1)
+                elif result['error'] == 'conflict' and attempt < UPDATE_CONFLICT_RETRIES:
+                    conflicts.append(document['_id'])
+                else:
+                    summary.fail(document['_id'], result.get('reason') or result['error'])
+            pending = conflicts
+            if not conflicts:
+                return
+    except Exception as err:    # a writer that died would lose the rest of its chunks
+        logger.error('Bulk update failed: %s', err)
+        for inventory_id in pending:
+            summary.fail(inventory_id, str(err))
+
+def update_matching(selector, changes, chunk_size=None, workers=None):
+    """
+    Applies a partial update to every Inventory matching a selector
+
+    The matching ids are taken first, so documents the update moves out
+    of the selector cannot shift the pages still to be read. Chunks of
+    them are then read and written back with _bulk_docs concurrently.
+
+    Args:
+        selector (dict): the fields every Inventory to update has
+        changes (dict): the fields to set, validated like a request body
+        chunk_size (int): documents per _bulk_docs request
+        workers (int): concurrent chunks
+    Returns:
+        an UpdateSummary
+    """
+    values, errors = Inventory.schema.validate_changes(changes)
+    if errors:
+        raise DataValidationError('Invalid update: ' + '; '.join(errors))
+    if Inventory.partitioned and 'category' in values:
+        raise DataValidationError('category cannot be changed in bulk in a '
+                                  'partitioned database')
+    chunk_size = chunk_size or IMPORT_CHUNK_SIZE
+    workers = workers or IMPORT_WORKERS
+    inventory_ids = Inventory.find_ids(selector, chunk_size)
+    summary = UpdateSummary(len(inventory_ids))
+    chunks = queue.Queue()
+    for start in range(0, len(inventory_ids), chunk_size):
+        chunks.put(inventory_ids[start:start + chunk_size])
+
+    def write():
+        """ Updates queued chunks until there are none left """
+        while True:
+            try:
+                chunk = chunks.get_nowait()
+            except queue.Empty:
+                return
+            update_chunk(chunk, selector, values, summary)
+
+    threads = [threading.Thread(target=write, name='inventory-update')
+               for _ in range(min(workers, chunks.qsize()))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summary
+
+
+######################################################################
+#  M I G R A T I O N
+######################################################################
+
+def read_database(database, page_size=QUERY_LIMIT):
+    """ Yields the documents of a cloudant database, one _all_docs page at a time """
+    startkey = u'\u0000'
+    while startkey is not None:
+        rows = database.all_docs(startkey=startkey, limit=page_size,
+                                 include_docs=True).get('rows', [])
+        startkey = rows[-1]['id'] + u'\u0000' if len(rows) == page_size else None
+        for row in rows:
+            if not row['id'].startswith('_design/'):
+                yield row['doc']
+
+def partitioned_document(document):
+    """ Returns a document with its id moved to the partition of its category """
+    doc_id = document['_id']
+    if partition_of(doc_id) is not None:
+        doc_id = doc_id.split(':', 1)[1]
+    document = dict(document)
+    document['_id'] = u'{}:{}'.format(partition_key(document.get('category')), doc_id)
+    return document
+
+def migrate_partitioned(source, progress=None):
+    """
+    Copies every Inventory of a database into the partitioned current one
+
+    Ids keep their original value after the partition, e.g. abc becomes
+    tools:abc, so running the migration again reports the documents that
+    were already copied as conflicts rather than copying them twice.
+
+    Args:
+        source: the cloudant database to copy from
+        progress (callable): called with the ImportSummary after each chunk
+    """
+    if not Inventory.partitioned:
+        raise DataValidationError('Database {} is not partitioned'.format(
+            Inventory.database.database_name))
+    return import_rows(read_database(source), partitioned_document,
+                       progress=progress, validate=False)
@@ -0,0 +1,143 @@
+"""
+Shared change feed for the Inventory Service
+
+A ChangeFeed follows the database _changes feed on one background thread
+and fans every change out to its subscribers, so any number of streaming
+clients in a worker share a single upstream connection. The thread is
+started by the first subscriber, from the checkpoint it gives, and stops
+when the last one leaves.
+"""
+import os
+import time
+import logging
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+from requests import HTTPError, ConnectionError
+from .models import Inventory, RETRY_DELAY
+
+# seconds between CouchDB heartbeats and between keep-alives to clients
+CHANGES_HEARTBEAT = int(os.environ.get('CHANGES_HEARTBEAT', 15))
+# changes buffered per subscriber before a slow client is dropped
+CHANGES_BACKLOG = int(os.environ.get('CHANGES_BACKLOG', 1000))
+
+
+class Subscription(object):
+    """ A subscriber's queue of (seq, id, inventory) changes """
+
+    def __init__(self, feed):
+        self.feed = feed
+        self.queue = queue.Queue(maxsize=CHANGES_BACKLOG)
+        self.overflowed = False
+
+    def put(self, change):
+        """ Queues a change, dropping the subscriber if it has fallen behind """
+        try:
+            self.queue.put_nowait(change)
+        except queue.Full:
+            self.overflowed = True
+            self.feed.unsubscribe(self)
+
+    def get(self, timeout=None):
+        """ Returns the next change or None if none arrived within timeout """
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        """ Stops receiving changes """
+        self.feed.unsubscribe(self)
+
+
+class ChangeFeed(object):
+    """ Follows a database _changes feed on behalf of many subscribers """
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, database):
+        self.database = database
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.upstream = None
+
+    def subscribe(self, since=None):
+        """
+        Returns a Subscription that receives every change from now on
+
+        If the feed is not running it starts after since (by default now),
+        so a subscriber that has read the changes up to since misses none.
+        """
+        subscription = Subscription(self)
+        with self.lock:
+            self.subscribers.add(subscription)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._follow,
+                                               args=(since or 'now',),
+                                               name='inventory-changes')
+                self.thread.daemon = True
+                self.thread.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """ Removes a subscriber, stopping the feed after the last one """
+        with self.lock:
+            self.subscribers.discard(subscription)
+            if not self.subscribers and self.upstream is not None:
+                self.upstream.stop()
+
+    def _follow(self, since):
+        """ Relays upstream changes to subscribers until none are left """
+        try:
+            self._relay(since)
+        finally:
+            with self.lock:     # whatever ended the thread, the next subscriber restarts it
+                if self.thread is threading.current_thread():
+                    self.thread = None
+                    self.upstream = None
+
+    def _relay(self, since):
+        """ Follows the feed from since, reconnecting after any failure """
+        while True:
+            with self.lock:
+                if not self.subscribers:
+                    self.thread = None
+                    self.upstream = None
+                    return
+                self.upstream = self.database.infinite_changes(
+                    since=since, include_docs=True,
+                    heartbeat=CHANGES_HEARTBEAT * 1000)
+            try:
+                for change in self.upstream:
+                    if change is None or 'id' not in change:
+                        continue    # heartbeat
+                    since = change['seq']
+                    if change['id'].startswith('_design/'):
+                        continue
+                    inventory = None
+                    if not change.get('deleted'):
+                        inventory = Inventory.from_document(change['doc'])
+                    with self.lock:
+                        subscribers = list(self.subscribers)
+                    for subscription in subscribers:
+                        subscription.put((change['seq'], change['id'], inventory))
+            except (HTTPError, ConnectionError) as err:
+                self.logger.warning('Changes feed interrupted: %s', err)
+                time.sleep(RETRY_DELAY)
+            except Exception:   # a bad change must not stop the feed for every client
+                self.logger.exception('Changes feed failed after %s', since)
+                time.sleep(RETRY_DELAY)
+
+
+_feeds = {}
+_feeds_lock = threading.Lock()
+
+def shared_feed(database):
+    """ Returns the ChangeFeed shared by everyone following database """
+    with _feeds_lock:
+        feed = _feeds.get(database.database_url)
+        if feed is None:
+            feed = _feeds[database.database_url] = ChangeFeed(database)
+        return feed
@@ -0,0 +1,108 @@
+"""
+Response compression for the Inventory Service
+
+Compresses responses with Brotli (when the brotli package is installed) or
+gzip, whichever the client prefers in Accept-Encoding. Responses smaller
+than COMPRESS_MIN_SIZE are sent as is, so single item responses skip the
+work. Streamed responses are compressed chunk by chunk and flushed after
+every chunk so that event streams are not held back.
+"""
+import os
+import zlib
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# smallest body worth compressing, in bytes
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+# gzip level (1-9) and Brotli quality (0-11)
+COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL', 6))
+COMPRESS_BR_LEVEL = int(os.environ.get('COMPRESS_BR_LEVEL', 4))
+
+COMPRESSIBLE_TYPES = ('application/json', 'application/x-ndjson',
+                      'text/csv', 'text/event-stream', 'text/html',
+                      'text/plain', 'text/css', 'application/javascript')
+
+
+class GzipCompressor(object):
+    """ Incremental gzip compressor """
+    encoding = 'gzip'
+
+    def __init__(self):
+        self.compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED,
+                                           16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        """ Compresses data and flushes it so the client can decode it """
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        """ Returns the end of the compressed stream """
+        return self.compressor.flush()
+
+
+class BrotliCompressor(object):
+    """ Incremental Brotli compressor """
+    encoding = 'br'
+
+    def __init__(self):
+        self.compressor = brotli.Compressor(quality=COMPRESS_BR_LEVEL)
+
+    def compress(self, data):
+        """ Compresses data and flushes it so the client can decode it """
+        return self.compressor.process(data) + self.compressor.flush()
+
+    def finish(self):
+        """ Returns the end of the compressed stream """
+        return self.compressor.finish()
+
+
+def negotiate(accept_encodings):
+    """ Returns the compressor class preferred by the client, if any """
+    choices = [(accept_encodings['gzip'], GzipCompressor)]
+    if brotli is not None:
+        choices.append((accept_encodings['br'], BrotliCompressor))
+    quality, compressor = max(choices, key=lambda choice: choice[0])
+    return compressor if quality > 0 else None
+
+def compress_response(response, accept_encodings):
+    """ Compresses a Flask response for a client that accepts it """
+    if (response.status_code < 200 or response.status_code in (204, 304) or
+            response.direct_passthrough or
+            'Content-Encoding' in response.headers or
+            response.mimetype not in COMPRESSIBLE_TYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    compressor_class = negotiate(accept_encodings)
+    if compressor_class is None:
+        return response
+
+    if response.is_streamed:
+        chunks = response.response
+        compressor = compressor_class()
+
+        def generate():
+            """ Compresses each chunk as the wrapped response yields it """
+            try:
+                for chunk in chunks:
+                    if not isinstance(chunk, bytes):
+                        chunk = chunk.encode(response.charset)
+                    if chunk:
+                        yield compressor.compress(chunk)
+                yield compressor.finish()
+            finally:
+                if hasattr(chunks, 'close'):
+                    chunks.close()
+
+        response.response = generate()
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_SIZE:
+            return response
+        compressor = compressor_class()
+        response.set_data(compressor.compress(data) + compressor.finish())
+
+    response.headers['Content-Encoding'] = compressor_class.encoding
+    return response
@@ -0,0 +1,108 @@
+"""
+Fast JSON encoding for the Inventory Service
+
+List responses are written as a JSON array of per item fragments rather
+than through jsonify. Fragments are encoded with orjson or ujson when one
+is installed (JSON_ENCODER picks one by name) and the standard library
+otherwise, and are kept in a bounded cache keyed by document id so an
+unchanged document (same _rev) is only ever encoded once per worker.
+"""
+import os
+import json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+# entries kept in the fragment cache before it is emptied
+JSON_FRAGMENT_CACHE_SIZE = int(os.environ.get('JSON_FRAGMENT_CACHE_SIZE', 10000))
+
+
+def _dumps_json(data):
+    """ Encodes data with the standard library """
+    return json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+def _dumps_ujson(data):
+    """ Encodes data with ujson """
+    return ujson.dumps(data, escape_forward_slashes=False).encode('utf-8')
+
+ENCODERS = {'json': _dumps_json}
+if ujson is not None:
+    ENCODERS['ujson'] = _dumps_ujson
+if orjson is not None:
+    ENCODERS['orjson'] = orjson.dumps
+
+def select_encoder(name=None):
+    """ Returns the named encoder, or the fastest one installed """
+    if name:
+        if name not in ENCODERS:
+            raise ValueError('JSON encoder {} is not installed'.format(name))
+        return ENCODERS[name]
+    for name in ('orjson', 'ujson', 'json'):
+        if name in ENCODERS:
+            return ENCODERS[name]
+
+# encodes a value as UTF-8 JSON bytes
+dumps = select_encoder(os.environ.get('JSON_ENCODER'))
+
+
+class FragmentCache(object):
+    """
+    Encoded Inventory keyed by id and revision
+
+    The cache is emptied when it fills up, which keeps it bounded without
+    the bookkeeping of an LRU on every hit.
+    """
+
+    def __init__(self, size=None):
+        self.size = size or JSON_FRAGMENT_CACHE_SIZE
+        self.fragments = {}     # id -> (rev, fragment)
+
+    def __len__(self):
+        return len(self.fragments)
+
+    def get(self, inventory_id, rev):
+        """ Returns the fragment of a revision, or None """
+        entry = self.fragments.get(inventory_id)
+        if entry is not None and entry[0] == rev:
+            return entry[1]
+        return None
+
+    def put(self, inventory_id, rev, fragment):
+        """ Stores the fragment of a revision """
+        if len(self.fragments) >= self.size:
+            self.fragments.clear()
+        self.fragments[inventory_id] = (rev, fragment)
+
+    def clear(self):
+        """ Empties the cache """
+        self.fragments.clear()
+
+fragments = FragmentCache()
+
+
+def encode(inventory_id, rev, serialize):
+    """
+    Returns the JSON fragment of one Inventory
+
+    Args:
+        inventory_id (str): the document id
+        rev (str): the document revision; None if it is not stored as is
+        serialize (callable): returns the dictionary to encode on a miss
+    """
+    if rev is None:
+        return dumps(serialize())
+    fragment = fragments.get(inventory_id, rev)
+    if fragment is None:
+        fragment = dumps(serialize())
+        fragments.put(inventory_id, rev, fragment)
+    return fragment
+
+def encode_list(inventories):
+    """ Returns a JSON array of Inventory as bytes """
+    return b'[' + b','.join(encode(inventory.id, inventory.rev, inventory.serialize)
+                            for inventory in inventories) + b']'
@@ -0,0 +1,171 @@
+"""
+Hedged reads for the Inventory Service
+
+A few slow database responses make up most of the tail latency of reads.
+With HEDGE_READS=true an idempotent read that has not answered within the
+delay its operation usually answers in (the HEDGE_PERCENTILE of recent
+latencies) is sent a second time, to the next replica when there are
+replicas and on another pooled connection otherwise, and whichever
+answers first is used.
+
+Hedges are paid for from a budget that grows by HEDGE_BUDGET with every
+read, so at most that fraction of reads (5% by default) sends a second
+request however slow the database gets.
+"""
+import os
+import time
+import logging
+import threading
+from collections import deque
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+from . import tracing
+
+# hedge idempotent reads; off by default
+HEDGE_READS = os.environ.get('HEDGE_READS', 'False').lower() == 'true'
+# percentile of recent latencies after which a read is hedged
+HEDGE_PERCENTILE = float(os.environ.get('HEDGE_PERCENTILE', 95))
+# hedges allowed per read
+HEDGE_BUDGET = float(os.environ.get('HEDGE_BUDGET', 0.05))
+# hedges that may be sent in a burst when the budget has built up
+HEDGE_BURST = float(os.environ.get('HEDGE_BURST', 10))
+# seconds to wait before hedging while there are too few latencies to go by
+HEDGE_DEFAULT_DELAY = float(os.environ.get('HEDGE_DEFAULT_DELAY', 0.05))
+# never hedge sooner than this many seconds
+HEDGE_MIN_DELAY = float(os.environ.get('HEDGE_MIN_DELAY', 0.002))
+# latencies kept per operation, and needed before they are used
+HEDGE_WINDOW = 1000
+HEDGE_MIN_SAMPLES = 20
+
+logger = logging.getLogger(__name__)
+
+
+class LatencyWindow(object):
+    """ The latest latencies of one operation """
+
+    def __init__(self, size=HEDGE_WINDOW):
+        self.samples = deque(maxlen=size)
+        self.added = 0
+        self.cached = None      # (percentile, value), recomputed every few samples
+
+    def add(self, seconds):
+        """ Records one latency """
+        self.samples.append(seconds)
+        self.added += 1
+
+    def percentile(self, percent):
+        """ Returns the latency below which percent of the samples are, or None """
+        if len(self.samples) < HEDGE_MIN_SAMPLES:
+            return None
+        if self.cached is None or self.added >= 50 or self.cached[0] != percent:
+            samples = sorted(self.samples)
+            index = min(len(samples) - 1, int(len(samples) * percent / 100.0))
+            self.cached = (percent, samples[index])
+            self.added = 0
+        return self.cached[1]
+
+
+class Hedger(object):
+    """ Runs reads with a hedged second attempt, within a budget """
+
+    def __init__(self, budget=None, burst=None):
+        self.budget = HEDGE_BUDGET if budget is None else budget
+        self.burst = HEDGE_BURST if burst is None else burst
+        self.tokens = self.burst
+        self.windows = {}
+        self.lock = threading.Lock()
+        self.reads = 0
+        self.hedged = 0         # second attempts sent
+        self.won = 0            # ... that answered first
+        self.over_budget = 0    # reads that were late but could not be hedged
+
+    def delay(self, operation):
+        """ Returns the seconds to wait for an operation before hedging it """
+        window = self.windows.get(operation)
+        latency = window.percentile(HEDGE_PERCENTILE) if window is not None else None
+        if latency is None:
+            return HEDGE_DEFAULT_DELAY
+        return max(latency, HEDGE_MIN_DELAY)
+
+    def record(self, operation, seconds):
+        """ Records the latency of one attempt """
+        with self.lock:
+            window = self.windows.get(operation)
+            if window is None:
+                window = self.windows[operation] = LatencyWindow()
+            window.add(seconds)
+
+    def _spend(self):
+        """ Takes a hedge from the budget; returns False if it is spent """
+        with self.lock:
+            if self.tokens >= 1:
+                self.tokens -= 1
+                self.hedged += 1
+                return True
+            self.over_budget += 1
+            return False
+
+    def _start(self, operation, attempt, hedged, results):
+        """ Runs an attempt on its own thread, putting its outcome on results """
+        def run():
+            """ Calls the attempt and reports how it went """
+            started = time.time()
+            try:
+                result = attempt()
+            except Exception as err:    # re-raised by run() if nothing succeeds
+                results.put((hedged, False, err))
+            else:
+                self.record(operation, time.time() - started)
+                results.put((hedged, True, result))
+        thread = threading.Thread(target=tracing.attach(tracing.current(), run),
+                                  name='inventory-' + operation)
+        thread.daemon = True
+        thread.start()
+
+    def run(self, operation, attempt, hedge=None):
+        """
+        Returns the result of attempt(), hedged with hedge() if it is late
+
+        Both are called without arguments and must be idempotent; hedge
+        defaults to attempt. If every attempt fails the first error is
+        raised.
+        """
+        hedge = hedge or attempt
+        with self.lock:
+            self.reads += 1
+            self.tokens = min(self.burst, self.tokens + self.budget)
+        results = queue.Queue()
+        self._start(operation, attempt, False, results)
+        pending = 1
+        try:
+            outcome = results.get(timeout=self.delay(operation))
+        except queue.Empty:
+            if self._spend():
+                self._start(operation, hedge, True, results)
+                pending += 1
+            outcome = results.get()
+        error = None
+        while True:
+            pending -= 1
+            hedged, succeeded, value = outcome
+            if succeeded:
+                if hedged:
+                    with self.lock:
+                        self.won += 1
+                return value
+            error = error or value
+            if not pending:
+                raise error
+            outcome = results.get()
+
+    def serialize(self):
+        """ Serializes the hedging counters into a dictionary """
+        with self.lock:
+            delays = dict((operation, self.delay(operation)) for operation in self.windows)
+            return {'reads': self.reads,
+                    'hedged': self.hedged,
+                    'won': self.won,
+                    'over_budget': self.over_budget,
+                    'delays': delays}
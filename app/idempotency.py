@@ -0,0 +1,194 @@
+"""
+Idempotency keys for the Inventory Service
+
+Clients retry a POST that timed out, and every retry used to insert
+another document. A POST that carries an Idempotency-Key header is run
+once: its response is kept for IDEMPOTENCY_TTL seconds, and a retry with
+the same key gets that response back (with an Idempotent-Replayed
+header) without the database being touched. A retry that arrives while
+the first request is still running is answered with 409 Conflict, and a
+key reused for a different request with 400 Bad Request.
+
+Responses of 5xx and failed requests are not kept, so that they can be
+retried. Keys are kept per worker process in a bounded store, so a retry
+that reaches another worker runs again; views that create a document
+therefore derive its _id from request_seed(), and the database turns the
+second create into a conflict that the view answers with the first
+document. Streamed bodies are fingerprinted by a digest of the whole body,
+which is spooled (to disk past IDEMPOTENCY_SPOOL_SIZE bytes) on the way.
+"""
+import os
+import time
+import hashlib
+import tempfile
+import threading
+from functools import wraps
+from collections import OrderedDict
+from flask import Response, request, g
+from werkzeug.exceptions import Conflict
+from .models import DataValidationError
+
+# seconds a response is kept for replays
+IDEMPOTENCY_TTL = float(os.environ.get('IDEMPOTENCY_TTL', 3600))
+# responses kept before the oldest are evicted
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get('IDEMPOTENCY_CACHE_SIZE', 10000))
+# longest key accepted
+IDEMPOTENCY_KEY_LENGTH = 255
+# bytes of a streamed body kept in memory while it is fingerprinted
+IDEMPOTENCY_SPOOL_SIZE = int(os.environ.get('IDEMPOTENCY_SPOOL_SIZE', 1 << 20))
+
+HEADER = 'Idempotency-Key'
+# headers of the original response that are replayed
+REPLAYED_HEADERS = ('Content-Type', 'Location')
+
+
+class IdempotencyStore(object):
+    """
+    Responses by idempotency key, expiring after a time to live
+
+    Entries are kept in the order they were started, which is also the
+    order they expire in, so expired and surplus entries are always the
+    oldest.
+    """
+
+    def __init__(self, ttl=None, size=None):
+        self.ttl = IDEMPOTENCY_TTL if ttl is None else ttl
+        self.size = size or IDEMPOTENCY_CACHE_SIZE
+        self.entries = OrderedDict()    # key -> [expires, fingerprint, response or None]
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _expire(self, now):
+        """ Drops expired entries, and the oldest ones to make room for another """
+        while self.entries:
+            key, entry = next(iter(self.entries.items()))
+            if entry[0] > now and len(self.entries) < self.size:
+                return
+            del self.entries[key]
+
+    def begin(self, key, fingerprint):
+        """
+        Starts a request with a key
+
+        Returns the (status, headers, body) of a completed request to
+        replay, or None if the request should run. Raises Conflict if it
+        is still running and DataValidationError if the key was used for
+        a different request.
+        """
+        now = time.time()
+        with self.lock:
+            self._expire(now)
+            entry = self.entries.get(key)
+            if entry is None:
+                self.entries[key] = [now + self.ttl, fingerprint, None]
+                return None
+        if entry[1] != fingerprint:
+            raise DataValidationError(
+                '{} {!r} was used for a different request'.format(HEADER, key))
+        if entry[2] is None:
+            raise Conflict('A request with {} {!r} is in progress'.format(HEADER, key))
+        return entry[2]
+
+    def finish(self, key, response):
+        """ Keeps the (status, headers, body) of a completed request """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry[2] = response
+
+    def abandon(self, key):
+        """ Forgets a request that failed, so it can be retried """
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        """ Empties the store """
+        with self.lock:
+            self.entries.clear()
+
+store = IdempotencyStore()
+
+
+def request_key():
+    """ Returns the Idempotency-Key of the current request, or None """
+    key = request.headers.get(HEADER)
+    if key is None:
+        return None
+    if not key or len(key) > IDEMPOTENCY_KEY_LENGTH:
+        raise DataValidationError('{} must be 1 to {} characters'.format(
+            HEADER, IDEMPOTENCY_KEY_LENGTH))
+    return key
+
+def idempotent(fingerprint):
+    """
+    Makes a view replay its response for a repeated Idempotency-Key
+
+    fingerprint is called without arguments during the request and
+    returns a string that identifies what is requested, e.g. a digest of
+    the body; a key is only ever replayed to a request with the same one.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            key = request_key()
+            if key is None:
+                return view(*args, **kwargs)
+            scoped = '{} {} {}'.format(request.method, request.path, key)
+            digest = fingerprint()
+            g.idempotency_seed = hashlib.sha1(
+                u'{} {}'.format(scoped, digest).encode('utf-8')).hexdigest()
+            replay = store.begin(scoped, digest)
+            if replay is not None:
+                status, headers, body = replay
+                response = Response(body, status, headers)
+                response.headers['Idempotent-Replayed'] = 'true'
+                return response
+            try:
+                response = view(*args, **kwargs)
+            except Exception:
+                store.abandon(scoped)
+                raise
+            if response.status_code >= 500 or response.is_streamed:
+                store.abandon(scoped)
+            else:
+                headers = [(name, response.headers[name]) for name in REPLAYED_HEADERS
+                           if name in response.headers]
+                store.finish(scoped, (response.status_code, headers, response.get_data()))
+            return response
+        return wrapper
+    return decorator
+
+def request_seed():
+    """
+    Returns a digest of the Idempotency-Key and fingerprint of the current
+    request, or None if it has no key
+
+    Every worker computes the same seed for a retried request, so a
+    document created with an id derived from it is only created once.
+    """
+    return g.get('idempotency_seed')
+
+def body_digest():
+    """ Fingerprints a request by its (small, buffered) body """
+    return hashlib.sha1(request.get_data()).hexdigest()
+
+def stream_digest():
+    """
+    Fingerprints a streamed request by its type and a digest of its body
+
+    The body is copied to a spool while it is hashed, and the spool
+    replaces request.stream so that the view still reads it from the start.
+    """
+    digest = hashlib.sha1()
+    spool = tempfile.SpooledTemporaryFile(max_size=IDEMPOTENCY_SPOOL_SIZE)
+    while True:
+        block = request.stream.read(1 << 16)
+        if not block:
+            break
+        digest.update(block)
+        spool.write(block)
+    spool.seek(0)
+    request.stream = spool
+    return '{} {}'.format(request.mimetype, digest.hexdigest())
@@ -0,0 +1,898 @@
+"""
+In-memory CouchDB for the Inventory Service
+
+MemoryAdapter is a requests transport adapter that answers the subset of
+the CouchDB HTTP API the service uses from Python dictionaries. Mounted on
+a Cloudant client (see DATABASE_BACKEND in models) the cloudant library
+and Inventory run unchanged without a server:
+
+    - documents carry revisions, and writes with a stale _rev conflict
+    - _all_docs, _bulk_docs and _changes (normal and continuous feeds)
+    - Mango _find with selectors, sort, limit, skip and fields; sorting
+      needs an index from _index, as it does on CouchDB
+    - views, whose JavaScript map functions run as registered Python twins
+    - partitioned databases (PUT /db?partitioned=true) with partition:id
+      document ids, partition and global indexes, and _partition/{p}
+      _all_docs and _find
+
+Every database of a process lives in one MemoryServer, so the data is
+private to the process; that is what makes parallel test workers
+independent. It is meant for tests and local development only.
+"""
+import io
+import re
+import json
+import time
+import uuid
+import hashlib
+import numbers
+import threading
+from requests import Response
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+try:
+    from urllib.parse import urlparse, parse_qsl, unquote, unquote_plus
+except ImportError:
+    from urlparse import urlparse, parse_qsl
+    from urllib import unquote, unquote_plus
+
+MEMORY_URL = 'http://memory'
+
+STRING_TYPES = (type(u''), type(''))
+
+# view query parameters that are JSON encoded
+JSON_PARAMS = ('key', 'keys', 'startkey', 'endkey', 'start_key', 'end_key')
+
+REASONS = {200: 'OK', 201: 'Created', 202: 'Accepted', 400: 'Bad Request',
+           404: 'Object Not Found', 405: 'Method Not Allowed', 409: 'Conflict',
+           412: 'Precondition Failed', 500: 'Internal Server Error',
+           501: 'Not Implemented'}
+
+# Python twins of view map functions, keyed by their JavaScript source
+MAP_FUNCTIONS = {}
+
+def register_views(views):
+    """
+    Registers the Python twins of declared views
+
+    Args:
+        views (dict): {design document: {view: definition}} where each
+            definition has its JavaScript 'map' and a Python 'python'
+            function that takes a document and yields (key, value) pairs
+    """
+    for definitions in views.values():
+        for view in definitions.values():
+            if view.get('python'):
+                MAP_FUNCTIONS[view['map']] = view['python']
+
+
+class CouchError(Exception):
+    """ An error response in CouchDB's format """
+
+    def __init__(self, status, error, reason):
+        super(CouchError, self).__init__(reason)
+        self.status = status
+        self.error = error
+        self.reason = reason
+
+
+######################################################################
+#  C O L L A T I O N   A N D   S E L E C T O R S
+######################################################################
+
+MISSING = object()
+
+def collate(value):
+    """
+    Returns a sort key that orders JSON values the way CouchDB does
+
+    null < false < true < numbers < strings < arrays < objects; strings
+    compare by code point rather than by ICU collation.
+    """
+    if value is None:
+        return (0,)
+    if value is False:
+        return (1,)
+    if value is True:
+        return (2,)
+    if isinstance(value, numbers.Number):
+        return (3, value)
+    if isinstance(value, STRING_TYPES):
+        return (4, value)
+    if isinstance(value, list):
+        return (5, [collate(item) for item in value])
+    return (6, sorted((key, collate(item)) for key, item in value.items()))
+
+def field_value(doc, path):
+    """ Returns the value at a dotted field path, or MISSING """
+    value = doc
+    for name in path.split('.'):
+        if not isinstance(value, dict) or name not in value:
+            return MISSING
+        value = value[name]
+    return value
+
+def json_type(value):
+    """ Returns the Mango $type name of a value """
+    if value is None:
+        return 'null'
+    if isinstance(value, bool):
+        return 'boolean'
+    if isinstance(value, numbers.Number):
+        return 'number'
+    if isinstance(value, STRING_TYPES):
+        return 'string'
+    if isinstance(value, list):
+        return 'array'
+    return 'object'
+
+def compare(value, operand):
+    """ Compares two JSON values by collation: -1, 0 or 1 """
+    left, right = collate(value), collate(operand)
+    return (left > right) - (left < right)
+
+OPERATORS = {
+    '$eq': lambda value, operand: compare(value, operand) == 0,
+    '$ne': lambda value, operand: compare(value, operand) != 0,
+    '$lt': lambda value, operand: compare(value, operand) < 0,
+    '$lte': lambda value, operand: compare(value, operand) <= 0,
+    '$gt': lambda value, operand: compare(value, operand) > 0,
+    '$gte': lambda value, operand: compare(value, operand) >= 0,
+    '$in': lambda value, operand: any(compare(value, item) == 0 for item in operand),
+    '$nin': lambda value, operand: all(compare(value, item) != 0 for item in operand),
+    '$type': lambda value, operand: json_type(value) == operand,
+    '$size': lambda value, operand: isinstance(value, list) and len(value) == operand,
+    '$all': lambda value, operand: (isinstance(value, list) and
+                                    all(item in value for item in operand)),
+    '$mod': lambda value, operand: (isinstance(value, numbers.Integral) and
+                                    not isinstance(value, bool) and
+                                    value % operand[0] == operand[1]),
+}
+
+def matches(doc, selector):
+    """ Returns True if a document matches a Mango selector """
+    for key, condition in selector.items():
+        if key == '$and':
+            if not all(matches(doc, part) for part in condition):
+                return False
+        elif key == '$or':
+            if not any(matches(doc, part) for part in condition):
+                return False
+        elif key == '$nor':
+            if any(matches(doc, part) for part in condition):
+                return False
+        elif key == '$not':
+            if matches(doc, condition):
+                return False
+        elif key.startswith('$'):
+            raise CouchError(400, 'invalid_operator', 'Invalid operator: ' + key)
+        elif not _field_matches(field_value(doc, key), condition):
+            return False
+    return True
+
+def _field_matches(value, condition):
+    """ Returns True if a field value satisfies a selector condition """
+    if not (isinstance(condition, dict) and condition and
+            all(key.startswith('$') for key in condition)):
+        condition = {'$eq': condition}
+    for operator, operand in condition.items():
+        if operator == '$exists':
+            if (value is not MISSING) != operand:
+                return False
+        elif value is MISSING:
+            return False
+        elif operator == '$not':
+            if _field_matches(value, operand):
+                return False
+        elif operator == '$elemMatch':
+            if not isinstance(value, list) or not any(
+                    matches(item, operand) if isinstance(item, dict) and not
+                    all(key.startswith('$') for key in operand)
+                    else _field_matches(item, operand) for item in value):
+                return False
+        elif operator == '$regex':
+            if not isinstance(value, STRING_TYPES) or not re.search(operand, value):
+                return False
+        elif operator in OPERATORS:
+            if not OPERATORS[operator](value, operand):
+                return False
+        else:
+            raise CouchError(400, 'invalid_operator', 'Invalid operator: ' + operator)
+    return True
+
+def sort_fields(sort):
+    """ Returns [(field, direction)] for a Mango sort or index field list """
+    fields = []
+    for entry in sort or []:
+        if isinstance(entry, dict):
+            fields.extend(entry.items())
+        else:
+            fields.append((entry, 'asc'))
+    return fields
+
+
+######################################################################
+#  D A T A B A S E
+######################################################################
+
+class MemoryDatabase(object):
+    """ The documents, revisions and changes of one database """
+
+    def __init__(self, server, name, partitioned=False):
+        self.server = server
+        self.name = name
+        self.partitioned = partitioned
+        self.docs = {}          # id -> current body, including _id and _rev
+        self.deleted = {}       # id -> rev of its tombstone
+        self.changes = {}       # id -> seq of its latest change
+        self.dropped = False
+
+    ##################################################################
+    # Documents
+    ##################################################################
+
+    @staticmethod
+    def _next_rev(rev, body):
+        """ Returns the revision after rev for a new body """
+        generation = int(rev.split('-')[0]) + 1 if rev else 1
+        digest = hashlib.md5(json.dumps([rev, body], sort_keys=True)
+                             .encode('utf-8')).hexdigest()
+        return '{}-{}'.format(generation, digest)
+
+    def write(self, doc_id, body, rev=None, deleted=False):
+        """ Writes one revision of a document; returns its new rev """
+        if doc_id.startswith('_') and not doc_id.startswith('_design/'):
+            raise CouchError(400, 'illegal_docid',
+                             'Only reserved document ids may start with underscore.')
+        if self.partitioned and not doc_id.startswith('_design/'):
+            partition = doc_id.split(':', 1)[0]
+            if partition == doc_id or not partition or partition.startswith('_'):
+                raise CouchError(400, 'illegal_docid',
+                                 'Doc id must be of form partition:id')
+        current = self.docs.get(doc_id)
+        if current is not None:
+            if rev != current['_rev']:
+                raise CouchError(409, 'conflict', 'Document update conflict.')
+        elif rev is not None and rev != self.deleted.get(doc_id):
+            raise CouchError(409, 'conflict', 'Document update conflict.')
+        elif deleted:
+            raise CouchError(404, 'not_found', 'missing')
+        previous = rev or self.deleted.get(doc_id)
+        body = dict((key, value) for key, value in body.items()
+                    if key not in ('_id', '_rev', '_deleted'))
+        new_rev = self._next_rev(previous, body)
+        if deleted:
+            del self.docs[doc_id]
+            self.deleted[doc_id] = new_rev
+        else:
+            body['_id'] = doc_id
+            body['_rev'] = new_rev
+            self.docs[doc_id] = body
+            self.deleted.pop(doc_id, None)
+        self.changes[doc_id] = self.server.next_seq()
+        return new_rev
+
+    def get(self, doc_id):
+        """ Returns the current body of a document """
+        if doc_id in self.docs:
+            return self.docs[doc_id]
+        raise CouchError(404, 'not_found', 'deleted' if doc_id in self.deleted else 'missing')
+
+    def bulk_docs(self, docs):
+        """ Writes many documents; returns a result per document """
+        results = []
+        for doc in docs:
+            doc_id = doc.get('_id') or uuid.uuid4().hex
+            try:
+                rev = self.write(doc_id, doc, doc.get('_rev'), doc.get('_deleted', False))
+            except CouchError as err:
+                results.append({'id': doc_id, 'error': err.error, 'reason': err.reason})
+            else:
+                results.append({'ok': True, 'id': doc_id, 'rev': rev})
+        return results
+
+    ##################################################################
+    # Indexes
+    ##################################################################
+
+    def all_docs(self, params, keys=None, partition=None):
+        """ Returns the _all_docs response, of one partition if given """
+        include_docs = params.get('include_docs', False)
+
+        def row(doc_id):
+            """ Returns the _all_docs row of a document """
+            doc = self.docs[doc_id]
+            result = {'id': doc_id, 'key': doc_id, 'value': {'rev': doc['_rev']}}
+            if include_docs:
+                result['doc'] = doc
+            return result
+
+        if keys is not None:
+            rows = []
+            for key in keys:
+                if key in self.docs:
+                    rows.append(row(key))
+                elif key in self.deleted:
+                    rows.append({'id': key, 'key': key, 'doc': None,
+                                 'value': {'rev': self.deleted[key], 'deleted': True}})
+                else:
+                    rows.append({'key': key, 'error': 'not_found'})
+            return {'total_rows': len(self.docs), 'rows': rows}
+        ids = sorted(doc_id for doc_id in self.docs if in_partition(doc_id, partition))
+        ids = key_range(ids, lambda doc_id: doc_id, params)
+        return {'total_rows': len(self.docs), 'offset': params.get('skip', 0),
+                'rows': [row(doc_id) for doc_id in ids]}
+
+    def design_docs(self):
+        """ Yields the design documents """
+        for doc_id, doc in self.docs.items():
+            if doc_id.startswith('_design/'):
+                yield doc_id, doc
+
+    def is_partitioned(self, ddoc):
+        """ Returns True if a design document serves partition queries """
+        return self.partitioned and ddoc.get('options', {}).get('partitioned', True)
+
+    def indexes(self, partitioned=None):
+        """
+        Returns the Mango indexes as (ddoc, name, [(field, direction)])
+
+        With partitioned=True or False only the indexes of partition or of
+        global queries are returned.
+        """
+        indexes = []
+        for doc_id, doc in self.design_docs():
+            if doc.get('language') != 'query':
+                continue
+            if partitioned is not None and self.is_partitioned(doc) != partitioned:
+                continue
+            for name, view in doc.get('views', {}).items():
+                definition = view.get('options', {}).get('def', {})
+                indexes.append((doc_id, name, sort_fields(definition.get('fields'))))
+        return indexes
+
+    def create_index(self, payload):
+        """ Creates a Mango json index in its design document """
+        if payload.get('type', 'json') != 'json':
+            raise CouchError(400, 'invalid_index', 'Only json indexes are supported')
+        fields = payload.get('index', {}).get('fields')
+        if not fields:
+            raise CouchError(400, 'missing_required_key', 'Missing required key: fields')
+        digest = hashlib.md5(json.dumps(fields, sort_keys=True).encode('utf-8')).hexdigest()
+        ddoc_id = '_design/' + (payload.get('ddoc') or digest)
+        name = payload.get('name') or digest
+        ddoc = dict(self.docs.get(ddoc_id) or {'language': 'query', 'views': {}})
+        view = {'map': {'fields': dict(sort_fields(fields))},
+                'reduce': '_count',
+                'options': {'def': {'fields': fields}}}
+        options = {}
+        if self.partitioned:
+            options = {'partitioned': payload.get('partitioned', True)}
+        if ddoc.get('views', {}).get(name) == view and ddoc.get('options', {}) == options:
+            return {'result': 'exists', 'id': ddoc_id, 'name': name}
+        ddoc['views'] = dict(ddoc.get('views', {}), **{name: view})
+        if options:
+            ddoc['options'] = options
+        self.write(ddoc_id, ddoc, ddoc.get('_rev'))
+        return {'result': 'created', 'id': ddoc_id, 'name': name}
+
+    def delete_index(self, ddoc_id, name):
+        """ Removes a Mango index """
+        ddoc = self.get(ddoc_id)
+        if name not in ddoc.get('views', {}):
+            raise CouchError(404, 'not_found', 'Index not found')
+        ddoc = dict(ddoc, views=dict((key, value) for key, value in ddoc['views'].items()
+                                     if key != name))
+        if ddoc['views']:
+            self.write(ddoc_id, ddoc, ddoc['_rev'])
+        else:
+            self.write(ddoc_id, {}, ddoc['_rev'], deleted=True)
+        return {'ok': True}
+
+    def list_indexes(self):
+        """ Returns the _index response """
+        indexes = [{'ddoc': None, 'name': '_all_docs', 'type': 'special',
+                    'def': {'fields': [{'_id': 'asc'}]}}]
+        for ddoc_id, name, fields in sorted(self.indexes()):
+            index = {'ddoc': ddoc_id, 'name': name, 'type': 'json',
+                     'def': {'fields': [{field: direction} for field, direction in fields]}}
+            if self.partitioned:
+                index['partitioned'] = self.is_partitioned(self.docs[ddoc_id])
+            indexes.append(index)
+        return {'total_rows': len(indexes), 'indexes': indexes}
+
+    ##################################################################
+    # Queries
+    ##################################################################
+
+    def find(self, query, partition=None):
+        """ Runs a Mango query, in one partition if given """
+        selector = query.get('selector')
+        if not isinstance(selector, dict):
+            raise CouchError(400, 'missing_required_key', 'Missing required key: selector')
+        sort = sort_fields(query.get('sort'))
+        response = {}
+        # a partitioned database keeps separate indexes for partition queries
+        indexes = self.indexes(partition is not None if self.partitioned else None)
+        if sort:
+            directions = set(direction for _, direction in sort)
+            if len(directions) > 1:
+                raise CouchError(400, 'unsupported_mixed_sort',
+                                 'Sorts currently only support a single direction '
+                                 'for all fields.')
+            names = [field for field, _ in sort]
+            if not any([field for field, _ in fields][:len(names)] == names
+                       for _, _, fields in indexes):
+                raise CouchError(400, 'no_usable_index',
+                                 'No index exists for this sort, try indexing by '
+                                 'the sort field.')
+        elif not any(field in selector for _, _, fields in indexes
+                     for field, _ in fields[:1]):
+            response['warning'] = ('no matching index found, create an index to '
+                                   'optimize query time')
+        use_index = query.get('use_index')
+        if use_index:
+            if not isinstance(use_index, list):
+                use_index = [use_index]
+            ddoc_id = use_index[0] if use_index[0].startswith('_design/') \
+                else '_design/' + use_index[0]
+            if not any(ddoc == ddoc_id and (len(use_index) < 2 or name == use_index[1])
+                       for ddoc, name, _ in indexes):
+                response['warning'] = '{} was not used because it does not exist'.format(
+                    '/'.join(use_index))
+        docs = [doc for doc_id, doc in sorted(self.docs.items())
+                if not doc_id.startswith('_design/') and in_partition(doc_id, partition) and
+                matches(doc, selector)]
+        if sort:
+            # like a json index, only documents with every sort field take part
+            docs = [doc for doc in docs
+                    if all(field_value(doc, field) is not MISSING for field, _ in sort)]
+            docs.sort(key=lambda doc: [collate(field_value(doc, field)) for field, _ in sort],
+                      reverse=sort[0][1] == 'desc')
+        # bookmarks are opaque to clients; here they are just an offset
+        skip = query.get('skip', 0)
+        bookmark = query.get('bookmark')
+        if bookmark and bookmark != 'nil':
+            try:
+                skip += int(bookmark)
+            except ValueError:
+                raise CouchError(400, 'invalid_bookmark', 'Invalid bookmark value')
+        docs = docs[skip:skip + query.get('limit', 25)]
+        response['bookmark'] = str(skip + len(docs))
+        fields = query.get('fields')
+        if fields:
+            docs = [dict((field, doc[field]) for field in fields if field in doc)
+                    for doc in docs]
+        response['docs'] = docs
+        return response
+
+    def view(self, ddoc_id, view_name, params, keys=None):
+        """ Runs a view over every document """
+        ddoc = self.get(ddoc_id)
+        definition = ddoc.get('views', {}).get(view_name)
+        if definition is None:
+            raise CouchError(404, 'not_found', 'missing_named_view')
+        if self.is_partitioned(ddoc):
+            raise CouchError(400, 'query_parse_error',
+                             '`partitioned` design documents only support partitioned '
+                             'queries')
+        function = MAP_FUNCTIONS.get(definition.get('map'))
+        if function is None:
+            raise CouchError(501, 'not_implemented',
+                             'view {} has no Python map function registered'.format(view_name))
+        rows = []
+        for doc_id, doc in self.docs.items():
+            if doc_id.startswith('_design/'):
+                continue
+            for key, value in function(doc):
+                rows.append({'id': doc_id, 'key': key, 'value': value})
+        rows.sort(key=lambda row: (collate(row['key']), row['id']))
+        if keys is not None:
+            rows = [row for key in keys for row in rows if compare(row['key'], key) == 0]
+        reduce_function = definition.get('reduce')
+        if reduce_function and params.get('reduce', True):
+            # like CouchDB, the key range selects the rows that are reduced
+            rows = key_range(rows, lambda row: row['key'],
+                             dict((name, value) for name, value in params.items()
+                                  if name not in ('skip', 'limit')), collate)
+            return {'rows': reduce_rows(rows, reduce_function, params)}
+        rows = key_range(rows, lambda row: row['key'], params, collate)
+        if params.get('include_docs'):
+            for row in rows:
+                row['doc'] = self.docs[row['id']]
+        return {'total_rows': len(rows), 'offset': params.get('skip', 0), 'rows': rows}
+
+    ##################################################################
+    # Changes
+    ##################################################################
+
+    def changes_since(self, since, limit=None):
+        """ Returns the latest change of each document changed after since """
+        changed = sorted((seq, doc_id) for doc_id, seq in self.changes.items() if seq > since)
+        if limit is not None:
+            changed = changed[:limit]
+        return changed
+
+    def change(self, seq, doc_id, include_docs):
+        """ Returns one row of the _changes feed """
+        if doc_id in self.docs:
+            row = {'seq': str(seq), 'id': doc_id,
+                   'changes': [{'rev': self.docs[doc_id]['_rev']}]}
+            if include_docs:
+                row['doc'] = self.docs[doc_id]
+        else:
+            rev = self.deleted[doc_id]
+            row = {'seq': str(seq), 'id': doc_id, 'changes': [{'rev': rev}], 'deleted': True}
+            if include_docs:
+                row['doc'] = {'_id': doc_id, '_rev': rev, '_deleted': True}
+        return row
+
+
+def in_partition(doc_id, partition):
+    """ Returns True if a document id is in a partition, or partition is None """
+    return partition is None or doc_id.startswith(partition + ':')
+
+def key_range(rows, key, params, collation=None):
+    """ Applies startkey, endkey, descending, skip and limit to sorted rows """
+    collation = collation or (lambda value: value)
+    descending = params.get('descending', False)
+    if descending:
+        rows = list(reversed(rows))
+    start = params.get('startkey', params.get('start_key', MISSING))
+    end = params.get('endkey', params.get('end_key', MISSING))
+    exact = params.get('key', MISSING)
+    inclusive_end = params.get('inclusive_end', True)
+    selected = []
+    for row in rows:
+        value = collation(key(row))
+        if exact is not MISSING and value != collation(exact):
+            continue
+        if start is not MISSING:
+            if (value < collation(start)) if not descending else (value > collation(start)):
+                continue
+        if end is not MISSING:
+            bound = collation(end)
+            if descending:
+                if value < bound or (value == bound and not inclusive_end):
+                    continue
+            elif value > bound or (value == bound and not inclusive_end):
+                continue
+        selected.append(row)
+    skip = params.get('skip', 0)
+    limit = params.get('limit')
+    return selected[skip:] if limit is None else selected[skip:skip + limit]
+
+def reduce_rows(rows, function, params):
+    """ Applies a built in _count or _sum reduce, grouped by key if asked """
+    if function not in ('_count', '_sum'):
+        raise CouchError(501, 'not_implemented', 'only _count and _sum reduces are supported')
+    group_level = params.get('group_level')
+    if group_level is not None:
+        grouping = lambda key: key[:group_level] if isinstance(key, list) else key
+    elif params.get('group'):
+        grouping = lambda key: key
+    else:
+        grouping = lambda key: None
+    groups = []
+    for row in rows:
+        group = grouping(row['key'])
+        value = 1 if function == '_count' else row['value']
+        if groups and compare(groups[-1]['key'], group) == 0:
+            groups[-1]['value'] += value
+        else:
+            groups.append({'key': group, 'value': value})
+    return groups
+
+
+######################################################################
+#  S E R V E R
+######################################################################
+
+class MemoryServer(object):
+    """ The databases of one process """
+
+    def __init__(self):
+        self.databases = {}
+        self.seq = 0
+        self.lock = threading.RLock()
+        self.changed = threading.Condition(self.lock)
+
+    def next_seq(self):
+        """
+        Returns the next update sequence
+
+        Sequences are shared by every database so that a checkpoint taken
+        before a database was recreated is still behind all of its changes.
+        """
+        self.seq += 1
+        self.changed.notify_all()
+        return self.seq
+
+    def database(self, name):
+        """ Returns a database by name """
+        if name not in self.databases:
+            raise CouchError(404, 'not_found', 'Database does not exist.')
+        return self.databases[name]
+
+    def handle(self, method, parts, params, body):
+        """ Routes a request; returns (status, response body) """
+        if not parts:
+            return 200, {'couchdb': 'Welcome', 'version': 'memory'}
+        if parts[0] == '_session':
+            return 200, {'ok': True, 'userCtx': {'name': 'admin', 'roles': ['_admin']}}
+        if parts[0] == '_all_dbs':
+            return 200, sorted(self.databases)
+        name = parts[0]
+        if len(parts) == 1:
+            return self.handle_database(method, name, params, body)
+        database = self.database(name)
+        resource = parts[1]
+        if resource == '_partition' and len(parts) >= 3:
+            return self.handle_partition(database, parts[2], parts[3:], params, body)
+        if resource == '_all_docs':
+            return 200, database.all_docs(params, body.get('keys') if body else None)
+        if resource == '_bulk_docs':
+            return 201, database.bulk_docs(body.get('docs', []))
+        if resource == '_find':
+            return 200, database.find(body)
+        if resource == '_index':
+            if method == 'POST':
+                return 200, database.create_index(body)
+            if method == 'DELETE' and len(parts) == 5:
+                return 200, database.delete_index('_design/' + parts[2], parts[4])
+            return 200, database.list_indexes()
+        if resource == '_changes':
+            since = parse_seq(params.get('since', 0), self.seq)
+            changed = database.changes_since(since, params.get('limit'))
+            last_seq = changed[-1][0] if changed and params.get('limit') else self.seq
+            return 200, {'results': [database.change(seq, doc_id,
+                                                     params.get('include_docs', False))
+                                     for seq, doc_id in changed],
+                         'last_seq': str(last_seq), 'pending': 0}
+        if resource == '_design' and len(parts) >= 3:
+            doc_id = '_design/' + parts[2]
+            if len(parts) == 5 and parts[3] == '_view':
+                return 200, database.view(doc_id, parts[4], params,
+                                          body.get('keys') if body else None)
+            return self.handle_document(method, database, doc_id, params, body)
+        return self.handle_document(method, database, '/'.join(parts[1:]), params, body)
+
+    @staticmethod
+    def handle_partition(database, partition, parts, params, body):
+        """ Handles requests on one partition of a partitioned database """
+        if not database.partitioned:
+            raise CouchError(400, 'bad_request', 'database is not partitioned')
+        if partition.startswith('_'):
+            raise CouchError(400, 'bad_request', 'Partition name must not begin with an '
+                             'underscore.')
+        if not parts:
+            count = sum(1 for doc_id in database.docs if in_partition(doc_id, partition))
+            return 200, {'db_name': database.name, 'partition': partition,
+                         'doc_count': count, 'doc_del_count': 0}
+        if parts == ['_all_docs']:
+            return 200, database.all_docs(params, body.get('keys') if body else None,
+                                          partition)
+        if parts == ['_find']:
+            return 200, database.find(body, partition)
+        raise CouchError(404, 'not_found', 'missing')
+
+    def handle_database(self, method, name, params, body):
+        """ Handles requests on a database itself """
+        if method == 'PUT':
+            if name in self.databases:
+                raise CouchError(412, 'file_exists', 'The database could not be created, '
+                                 'the file already exists.')
+            self.databases[name] = MemoryDatabase(self, name, params.get('partitioned', False))
+            return 201, {'ok': True}
+        database = self.database(name)
+        if method == 'DELETE':
+            database.dropped = True
+            del self.databases[name]
+            self.changed.notify_all()
+            return 200, {'ok': True}
+        if method == 'POST':
+            doc_id = body.get('_id') or uuid.uuid4().hex
+            rev = database.write(doc_id, body)
+            return 201, {'ok': True, 'id': doc_id, 'rev': rev}
+        return 200, {'db_name': name, 'doc_count': len(database.docs),
+                     'doc_del_count': len(database.deleted),
+                     'update_seq': str(self.seq),
+                     'props': {'partitioned': True} if database.partitioned else {}}
+
+    @staticmethod
+    def handle_document(method, database, doc_id, params, body):
+        """ Handles requests on one document """
+        if method in ('GET', 'HEAD'):
+            return 200, database.get(doc_id)
+        if method == 'PUT':
+            rev = database.write(doc_id, body, body.get('_rev') or params.get('rev'))
+            return 201, {'ok': True, 'id': doc_id, 'rev': rev}
+        if method == 'DELETE':
+            rev = database.write(doc_id, {}, params.get('rev'), deleted=True)
+            return 200, {'ok': True, 'id': doc_id, 'rev': rev}
+        raise CouchError(405, 'method_not_allowed', 'Only GET, HEAD, PUT, DELETE allowed')
+
+
+def parse_seq(since, current):
+    """ Returns the integer update sequence of a since parameter """
+    if since == 'now':
+        return current
+    try:
+        return int(str(since).split('-')[0])
+    except ValueError:
+        raise CouchError(400, 'bad_request', 'Malformed sequence supplied in \'since\' parameter.')
+
+def parse_params(query):
+    """ Decodes query string parameters """
+    params = {}
+    for name, value in parse_qsl(query, keep_blank_values=True):
+        if name in JSON_PARAMS:
+            value = json.loads(value)
+        elif value in ('true', 'false'):
+            value = value == 'true'
+        elif name in ('limit', 'skip', 'heartbeat', 'timeout', 'group_level'):
+            value = int(value)
+        params[name] = value
+    return params
+
+
+class ContinuousChanges(object):
+    """
+    The body of a continuous _changes feed
+
+    It is read like a socket: read() blocks until there are changes to
+    send, sending a newline every heartbeat milliseconds meanwhile. The
+    feed ends after limit rows, after timeout milliseconds without changes,
+    or when the database is deleted.
+    """
+
+    def __init__(self, server, database, since, params):
+        self.server = server
+        self.database = database
+        self.since = since
+        self.include_docs = params.get('include_docs', False)
+        self.remaining = params.get('limit')
+        heartbeat = params.get('heartbeat')
+        self.heartbeat = heartbeat / 1000.0 if isinstance(heartbeat, int) and \
+            not isinstance(heartbeat, bool) else (60.0 if heartbeat else None)
+        timeout = params.get('timeout')
+        self.timeout = timeout / 1000.0 if timeout else None
+        self.pending = b''
+        self.finished = False
+
+    def _next_chunk(self):
+        """ Waits for and returns the next lines of the feed """
+        deadline = time.time() + self.timeout if self.timeout is not None else None
+        with self.server.lock:
+            while True:
+                if self.database.dropped:
+                    return self._finish()
+                changed = self.database.changes_since(self.since, self.remaining)
+                if changed:
+                    lines = []
+                    for seq, doc_id in changed:
+                        lines.append(json.dumps(self.database.change(seq, doc_id,
+                                                                     self.include_docs)))
+                        self.since = seq
+                    if self.remaining is not None:
+                        self.remaining -= len(changed)
+                        if not self.remaining:
+                            return '\n'.join(lines).encode('utf-8') + b'\n' + self._finish()
+                    return '\n'.join(lines).encode('utf-8') + b'\n'
+                wait = self.heartbeat
+                if deadline is not None:
+                    left = deadline - time.time()
+                    if left <= 0:
+                        return self._finish()
+                    wait = min(wait, left) if wait else left
+                started = time.time()
+                self.server.changed.wait(wait)
+                if self.heartbeat and time.time() - started >= self.heartbeat:
+                    return b'\n'
+
+    def _finish(self):
+        """ Ends the feed with its last sequence """
+        self.finished = True
+        return (json.dumps({'last_seq': str(self.since)}) + '\n').encode('utf-8')
+
+    def read(self, amount=None, **_):
+        """ Returns up to amount bytes, blocking until some are available """
+        if not self.pending:
+            if self.finished:
+                return b''
+            self.pending = self._next_chunk()
+        if amount is None:
+            amount = len(self.pending)
+        data, self.pending = self.pending[:amount], self.pending[amount:]
+        return data
+
+    def close(self):
+        """ Ends the feed """
+        self.finished = True
+        self.pending = b''
+
+
+class MemoryAdapter(BaseAdapter):
+    """ A requests transport adapter answering CouchDB requests from memory """
+
+    def __init__(self, server=None):
+        super(MemoryAdapter, self).__init__()
+        self.server = server or MemoryServer()
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None,
+             proxies=None):
+        """ Answers a prepared request """
+        url = urlparse(request.url)
+        parts = [unquote(part) for part in url.path.split('/') if part]
+        if parts:
+            parts[0] = unquote_plus(parts[0])
+        params = parse_params(url.query)
+        body = request.body
+        if isinstance(body, bytes):
+            body = body.decode('utf-8')
+        if 'json' not in request.headers.get('Content-Type', 'application/json'):
+            body = None     # e.g. the form posted to _session
+        try:
+            body = json.loads(body) if body else None
+        except ValueError:
+            return self._respond(request, 400, {'error': 'bad_request',
+                                                'reason': 'invalid UTF-8 JSON'})
+        try:
+            with self.server.lock:
+                if (len(parts) == 2 and parts[1] == '_changes' and
+                        params.get('feed') == 'continuous'):
+                    database = self.server.database(parts[0])
+                    since = parse_seq(params.get('since', 0), self.server.seq)
+                    return self._respond(request, 200, stream=ContinuousChanges(
+                        self.server, database, since, params))
+                status, result = self.server.handle(request.method, parts, params, body)
+        except CouchError as err:
+            return self._respond(request, err.status, {'error': err.error,
+                                                       'reason': err.reason})
+        if request.method == 'HEAD':
+            result = None
+        elif isinstance(result, dict) and parts and parts[1:2] == ['_changes']:
+            return self._respond(request, status, stream=io.BytesIO(normal_feed(result)))
+        return self._respond(request, status, result)
+
+    @staticmethod
+    def _respond(request, status, result=None, stream=None):
+        """ Builds a requests Response """
+        response = Response()
+        response.status_code = status
+        response.reason = REASONS.get(status, '')
+        response.headers = CaseInsensitiveDict({'Content-Type': 'application/json'})
+        if stream is None:
+            data = json.dumps(result).encode('utf-8') if result is not None else b''
+            stream = io.BytesIO(data)
+        response.raw = stream
+        response.url = request.url
+        response.request = request
+        response.encoding = 'utf-8'
+        return response
+
+    def close(self):
+        """ Nothing to release """
+        pass
+
+def normal_feed(result):
+    """ Formats a _changes response one row per line, as CouchDB does """
+    lines = ['{"results":[']
+    rows = [json.dumps(row) for row in result['results']]
+    lines.extend(row + ',' for row in rows[:-1])
+    lines.extend(rows[-1:])
+    lines.append('],')
+    lines.append('"last_seq":{},"pending":0}}'.format(json.dumps(result['last_seq'])))
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+_adapter = None
+_adapter_lock = threading.Lock()
+
+def adapter():
+    """ Returns this process's adapter, so every client sees the same data """
+    global _adapter
+    with _adapter_lock:
+        if _adapter is None:
+            _adapter = MemoryAdapter()
+        return _adapter
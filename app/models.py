@@ -45,11 +45,27 @@ count (int) - The quantity in stock
 #pip install -r requirements.txt
 import logging
 import os
+import re
 import json
+import uuid
+import numbers
+from array import array
+from functools import partial
+import numpy as np
 from retry import retry
 from cloudant.client import Cloudant
 from cloudant.query import Query
-from requests import HTTPError, ConnectionError
+from cloudant.database import CloudantDatabase
+from cloudant.design_document import DesignDocument
+from cloudant.error import CloudantDatabaseException
+from requests import HTTPError, ConnectionError, RequestException
+from requests.adapters import HTTPAdapter
+from cloudant.document import Document
+from . import encoding, hedging, memory, routing, sharedcache, tracing
+try:
+    from urllib.parse import quote
+except ImportError:
+    from urllib import quote
 
 # get configruation from enviuronment (12-factor)
 ADMIN_PARTY = os.environ.get('ADMIN_PARTY', 'False').lower() == 'true'
@@ -62,43 +78,258 @@ RETRY_COUNT = int(os.environ.get('RETRY_COUNT', 15))
 RETRY_DELAY = int(os.environ.get('RETRY_DELAY', 3))
 RETRY_BACKOFF = int(os.environ.get('RETRY_BACKOFF', 2))
 
+# 'cloudant' talks to CLOUDANT_HOST; 'memory' keeps the databases in process.
+# init_db() reads the environment again, so it may be set after this import
+DATABASE_BACKEND = os.environ.get('DATABASE_BACKEND', 'cloudant')
+# appended to database names, e.g. to give each parallel test worker its own
+DATABASE_SUFFIX = os.environ.get('DATABASE_SUFFIX', '')
+# create new databases partitioned by category (CouchDB 3 and Cloudant)
+DATABASE_PARTITIONED = os.environ.get('DATABASE_PARTITIONED', 'False').lower() == 'true'
+
+# connections to the database kept alive for reuse by each worker
+CLOUDANT_POOL_SIZE = int(os.environ.get('CLOUDANT_POOL_SIZE', 100))
+
+# default page size for bounded index queries
+QUERY_LIMIT = int(os.environ.get('QUERY_LIMIT', 100))
+
+# categories accepted from clients, comma separated (empty accepts any)
+INVENTORY_CATEGORIES = [category.strip() for category in
+                        os.environ.get('INVENTORY_CATEGORIES', '').split(',')
+                        if category.strip()]
+
+STRING_TYPES = (type(u''), type(''))
+
+# a _changes checkpoint: now, a CouchDB 1.x number or a 2.x N-opaque string
+SINCE_PATTERN = re.compile(r'^(now|\d+(-[A-Za-z0-9_=-]+)?)$')
+
+# partition of the Inventory without a category in a partitioned database
+DEFAULT_PARTITION = 'uncategorized'
+
+def check_since(since):
+    """ Returns since if it is a _changes checkpoint, else raises DataValidationError """
+    if not SINCE_PATTERN.match(str(since)):
+        raise DataValidationError('since must be a checkpoint, got {!r}'.format(since))
+    return since
+
+def partition_key(category):
+    """
+    Returns the partition an Inventory of a category is stored in
+
+    Partition names cannot contain ':' or start with '_', so those are
+    escaped or dropped. Categories that share a partition this way still
+    only match their own Inventory, since partition queries select on the
+    category as well.
+    """
+    if category is None:
+        category = u''
+    elif not isinstance(category, STRING_TYPES):
+        category = u'{}'.format(category)
+    return category.replace(u'%', u'%25').replace(u':', u'%3A').lstrip(u'_') \
+        or DEFAULT_PARTITION
+
+def partition_of(doc_id):
+    """ Returns the partition of a document id, or None if it has none """
+    if doc_id and ':' in doc_id and not doc_id.startswith('_design/'):
+        return doc_id.split(':', 1)[0]
+    return None
+
 class DataValidationError(Exception):
     """ Custom Exception with data validation fails """
     pass
 
+class InventorySchema(object):
+    """
+    Validates and coerces Inventory data sent by clients
+
+    The check for each field is chosen once when the schema is built, and
+    values that already have the right type pass a single type test, so a
+    batch of well formed records costs little more than a dictionary copy.
+    Every problem with a record is reported, not just the first.
+    """
+    TRUE = ('true', '1', 'yes', 'on')
+    FALSE = ('false', '0', 'no', 'off')
+
+    def __init__(self, categories=None):
+        self.categories = frozenset(categories or ())
+        self.checks = (
+            ('name', self.check_name),
+            ('category', self.check_category if self.categories else self.check_string),
+            ('available', self.check_available),
+            ('condition', self.check_string),
+            ('count', self.check_count),
+        )
+
+    @staticmethod
+    def check_name(value):
+        """ Names are non-empty strings """
+        if not isinstance(value, STRING_TYPES) or not value.strip():
+            raise ValueError('must be a non-empty string')
+        return value
+
+    @staticmethod
+    def check_string(value):
+        """ Optional fields are strings or null """
+        if value is not None and not isinstance(value, STRING_TYPES):
+            raise ValueError('must be a string')
+        return value
+
+    def check_category(self, value):
+        """ Categories come from the allowed set """
+        if value not in self.categories:
+            raise ValueError('must be one of ' + ', '.join(sorted(self.categories)))
+        return value
+
+    @classmethod
+    def check_available(cls, value):
+        """ Availability is a boolean, or a string or 0/1 that spells one """
+        if value is True or value is False:
+            return value
+        if isinstance(value, STRING_TYPES):
+            text = value.strip().lower()
+            if text in cls.TRUE:
+                return True
+            if text in cls.FALSE:
+                return False
+        elif value in (0, 1) and isinstance(value, numbers.Integral):
+            return value == 1
+        raise ValueError('must be true or false')
+
+    @staticmethod
+    def check_count(value):
+        """ Counts are non-negative integers, possibly sent as strings """
+        if type(value) is not int:
+            if isinstance(value, bool):
+                raise ValueError('must be an integer')
+            if isinstance(value, STRING_TYPES):
+                try:
+                    value = int(value.strip())
+                except ValueError:
+                    raise ValueError('must be an integer')
+            elif not isinstance(value, numbers.Integral):
+                raise ValueError('must be an integer')
+        if value < 0:
+            raise ValueError('must not be negative')
+        return value
+
+    def validate(self, data):
+        """ Returns the coerced fields of a record and a list of its errors """
+        if not isinstance(data, dict):
+            return None, ['body of request contained bad or no data']
+        values = {}
+        errors = []
+        for field, check in self.checks:
+            if field not in data:
+                errors.append('missing ' + field)
+                continue
+            try:
+                values[field] = check(data[field])
+            except ValueError as error:
+                errors.append('{} {}'.format(field, error))
+        return values, errors
+
+    def validate_many(self, records):
+        """ Returns (values, errors) for each record of a batch """
+        validate = self.validate
+        return [validate(data) for data in records]
+
+    def validate_changes(self, data):
+        """ Returns the coerced fields of a partial update and a list of its errors """
+        if not isinstance(data, dict) or not data:
+            return None, ['body of request contained bad or no data']
+        checks = dict(self.checks)
+        values = {}
+        errors = []
+        for field in sorted(data):
+            if field not in checks:
+                errors.append('unknown field ' + field)
+                continue
+            try:
+                values[field] = checks[field](data[field])
+            except ValueError as error:
+                errors.append('{} {}'.format(field, error))
+        return values, errors
+
 class Inventory(object):
     """
     Inventory interface to database
     """
+    __slots__ = ('id', 'rev', 'name', 'category', 'available', 'condition', 'count')
+
     logger = logging.getLogger(__name__)
     client = None   # cloudant.client.Cloudant
     database = None # cloudant.database.CloudantDatabase
+    cache = None    # sharedcache.SharedCache, if SHARED_CACHE_PATH is set
+    partitioned = False # True if the database is partitioned by category
+    router = None   # routing.ReadRouter, if CLOUDANT_ENDPOINTS lists replicas
+    hedger = None   # hedging.Hedger, if HEDGE_READS is set
+    schema = InventorySchema(INVENTORY_CATEGORIES)
+
+    # Mango indexes created by init_db(): (design document, index name, fields,
+    # True if it serves partition rather than global queries when partitioned)
+    QUERY_INDEXES = [
+        ('inventory-count', 'count', [{'count': 'asc'}], False),
+        ('inventory-category-count', 'category-count',
+         [{'category': 'asc'}, {'count': 'asc'}], True),
+    ]
 
+    # MapReduce views created by init_db(): {design document: {view: definition}}
+    VIEWS = {
+        '_design/inventory': {
+            'by_name': {
+                'map': "function (doc) { if (typeof doc.name === 'string') "
+                       "{ emit(doc.name.toLowerCase(), null); } }",
+                # the same map function for the memory backend
+                'python': lambda doc: ([(doc['name'].lower(), None)]
+                                       if isinstance(doc.get('name'), STRING_TYPES) else []),
+            },
+        },
+    }
 
     def __init__(self, name=None, category=None, available=True, condition=None, count=0):
         """ Constructor """
         self.id = None
+        self.rev = None     # _rev of the document this was read from, if unchanged
         self.name = name
         self.category = category
         self.available = available
         self.condition = condition
         self.count = count
 
+    @tracing.traced('Inventory.create')
     @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT,
            logger=logger)
-    def create(self):
-        """Creates a new inventory in the database"""
+    def create(self, seed=None):
+        """
+        Creates a new inventory in the database
+
+        With a seed (see idempotency.request_seed) the document id is
+        derived from it, so only the first create with a seed succeeds.
+        Later ones load the Inventory it created and return False.
+        """
         if self.name is None:   # name is the only required field
             raise DataValidationError('name attribute is not set')
+        data = self.serialize()
+        if self.partitioned or seed is not None:
+            data['_id'] = self.new_id(self.category, seed)
         try:
-            document = self.database.create_document(self.serialize())
+            document = self.database.create_document(data,
+                                                     throw_on_exists=seed is not None)
+        except CloudantDatabaseException:
+            stored = self.from_document(self.database[data['_id']])
+            for name in self.__slots__:
+                setattr(self, name, getattr(stored, name))
+            return False
         except HTTPError as err:
             Inventory.logger.warning('Create failed: %s', err)
             return
 
         if document.exists():
             self.id = document['_id']
+            self.rev = document['_rev']
+            self.record_write(document)
+        return True
     
+    @tracing.traced('Inventory.update')
     @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT,
            logger=logger)
     def update(self):
@@ -109,10 +340,47 @@ class Inventory(object):
             document = self.database[self.id]
         except KeyError:
             document = None
-        if document:
+        if document and self.partitioned and \
+                partition_of(self.id) != partition_key(self.category):
+            self.move(document)
+        elif document:
             document.update(self.serialize())
             document.save()
+            self.rev = document['_rev']
+            self.record_write(document)
+
+    @tracing.traced('Inventory.move')
+    def move(self, document):
+        """
+        Moves Inventory whose category changed to the partition of the new one
+
+        A document cannot change partitions, so it is copied under a new id
+        and the old one is deleted in the same _bulk_docs request. The
+        Inventory takes the new id.
+        """
+        old_id = self.id
+        data = self.serialize()
+        data.pop('id')
+        data['_id'] = self.new_id(self.category)
+        deletion = {'_id': old_id, '_rev': document['_rev'], '_deleted': True}
+        created, deleted = self.database.bulk_docs([data, deletion])
+        if 'error' in created:
+            raise DataValidationError('Could not move inventory: ' + created['error'])
+        if 'error' in deleted:
+            Inventory.logger.warning('Moved %s to %s but could not delete it: %s',
+                                     old_id, created['id'], deleted['error'])
+        self.database.pop(old_id, None)
+        self.id = created['id']
+        self.rev = created['rev']
+        data['_rev'] = created['rev']
+        self.record_write(data)
+        if 'error' not in deleted:
+            if self.cache is not None:
+                self.cache.discard(old_id, deleted['rev'])
+            if self.router is not None:
+                self.router.note_write(old_id, deleted['rev'])
     
+    @tracing.traced('Inventory.save')
     @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT,
            logger=logger)
     def save(self):
@@ -124,6 +392,7 @@ class Inventory(object):
         else:
             self.create()
     
+    @tracing.traced('Inventory.delete')
     @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT,
            logger=logger)
     def delete(self):
@@ -133,7 +402,22 @@ class Inventory(object):
         except KeyError:
             document = None
         if document:
+            rev = document['_rev']
             document.delete()
+            # the tombstone is the next generation of the last revision
+            tombstone = '{}-'.format(sharedcache.generation(rev) + 1)
+            if self.cache is not None:
+                self.cache.discard(self.id, tombstone)
+            if self.router is not None:
+                self.router.note_write(self.id, tombstone)
+
+    @classmethod
+    def record_write(cls, document):
+        """ Records a document this worker wrote in the shared cache and router """
+        if cls.cache is not None:
+            cls.cache.put(dict(document))
+        if cls.router is not None:
+            cls.router.note_write(document['_id'], document['_rev'])
 
     def serialize(self):
         """ Serializes Inventory into a dictionary """
@@ -144,28 +428,65 @@ class Inventory(object):
                 "condition": self.condition,
                 "count": self.count}
 
+    def matches(self, selector):
+        """ Returns True if every field in selector equals this Inventory's """
+        return all(getattr(self, field, None) == value
+                   for field, value in selector.items())
+
     def deserialize(self, data):
         """
         Deserializes Inventory from a dictionary
 
+        The data is validated and coerced by the schema: count becomes an
+        int and available a bool, and every error is reported at once.
+
         Args:
             data (dict): A dictionary containing the Inventory data
         """
-        try:
-            self.name = data['name']
-            self.category = data['category']
-            self.available = data['available']
-            self.condition = data['condition']
-            self.count = data['count']
-        except KeyError as error:
-            raise DataValidationError('Invalid inventory: missing ' + error.args[0])
-        except TypeError as error:
-            raise DataValidationError('Invalid inventory: body of request contained' \
-                                      'bad or no data')
+        values, errors = self.schema.validate(data)
+        if errors:
+            raise DataValidationError('Invalid inventory: ' + '; '.join(errors))
+        self._assign(values, data)
+        return self
+
+    def _assign(self, values, data):
+        """ Sets validated values, and the id and rev of a document """
+        self.name = values['name']
+        self.category = values['category']
+        self.available = values['available']
+        self.condition = values['condition']
+        self.count = values['count']
         if not self.id and '_id' in data:
             self.id = data['_id']
+        self.rev = data.get('_rev')
 
-        return self
+    @classmethod
+    def deserialize_many(cls, records):
+        """
+        Deserializes a batch of dictionaries
+
+        Returns an (inventory, error) tuple per record: the Inventory and
+        None when it is valid, else None and a message listing every error.
+        """
+        results = []
+        for data, (values, errors) in zip(records, cls.schema.validate_many(records)):
+            if errors:
+                results.append((None, 'Invalid inventory: ' + '; '.join(errors)))
+            else:
+                inventory = cls()
+                inventory._assign(values, data)
+                results.append((inventory, None))
+        return results
+
+    @classmethod
+    def from_document(cls, document):
+        """ Returns the Inventory stored in a database document, as stored """
+        inventory = cls(document.get('name'), document.get('category'),
+                        document.get('available'), document.get('condition'),
+                        document.get('count'))
+        inventory.id = document['_id']
+        inventory.rev = document.get('_rev')
+        return inventory
 
 
     @classmethod
@@ -185,6 +506,54 @@ class Inventory(object):
         """ Creates a new query index for searching """
         cls.database.create_query_index(index_name=field_name, fields=[{field_name: order}])
 
+    @classmethod
+    @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT,
+           logger=logger)
+    def ensure_indexes(cls):
+        """ Creates the declared query indexes (a no-op if they exist) """
+        for ddoc, name, fields, partitioned in cls.QUERY_INDEXES:
+            if cls.partitioned:
+                # the cloudant library cannot create partitioned indexes yet
+                cls.database_request('POST', '_index', json={
+                    'ddoc': ddoc, 'name': name, 'type': 'json',
+                    'index': {'fields': fields}, 'partitioned': partitioned})
+            else:
+                cls.database.create_query_index(design_document_id=ddoc,
+                                                index_name=name, fields=fields)
+
+    @classmethod
+    @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT,
+           logger=logger)
+    def ensure_views(cls, database=None, declared=None):
+        """
+        Creates or updates the declared design document views
+
+        By default these are the VIEWS of the Inventory database; another
+        database and its views can be given, e.g. the reservations'.
+        """
+        database = cls.database if database is None else database
+        partitioned = cls.partitioned if database is cls.database else False
+        for ddoc_id, views in (declared or cls.VIEWS).items():
+            ddoc = DesignDocument(database, ddoc_id)
+            if ddoc.exists():
+                ddoc.fetch()
+            changed = False
+            if partitioned and ddoc.get('options', {}).get('partitioned') is not False:
+                ddoc['options'] = {'partitioned': False}    # the views are global
+                changed = True
+            for name, view in views.items():
+                current = ddoc.get_view(name)
+                if current is None:
+                    ddoc.add_view(name, view['map'], view.get('reduce'))
+                elif (current.get('map') != view['map'] or
+                      current.get('reduce') != view.get('reduce')):
+                    ddoc.update_view(name, view['map'], view.get('reduce'))
+                else:
+                    continue
+                changed = True
+            if changed:
+                ddoc.save()
+
     @classmethod
     @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT,
            logger=logger)
@@ -193,49 +562,454 @@ class Inventory(object):
         return cls.query.all()
 
     @classmethod
+    def new_id(cls, category=None, seed=None):
+        """
+        Returns a new document id, in the partition of category if partitioned
+
+        The id is random unless a seed is given, which is used instead.
+        """
+        suffix = seed or uuid.uuid4().hex
+        if cls.partitioned:
+            return u'{}:{}'.format(partition_key(category), suffix)
+        return suffix
+
+    @classmethod
+    @tracing.traced('Inventory.create_many')
+    def create_many(cls, inventories, seeds=None):
+        """
+        Creates many Inventory in a single _bulk_docs request
+
+        Ids are assigned before the request so that a retried request
+        cannot create duplicates; with seeds, one per Inventory, they are
+        derived from the seeds (see new_id) so that a repeated request
+        cannot either. Returns the _bulk_docs result for each Inventory,
+        in order; failed items carry an 'error' key.
+        """
+        documents = []
+        generated = set()
+        for index, inventory in enumerate(inventories):
+            if inventory.name is None:
+                raise DataValidationError('name attribute is not set')
+            if not inventory.id:
+                inventory.id = cls.new_id(inventory.category,
+                                          seeds[index] if seeds else None)
+                generated.add(inventory.id)
+            document = inventory.serialize()
+            document['_id'] = inventory.id
+            documents.append(document)
+        results = cls.bulk_docs(documents)
+        for result in results:
+            # a conflict on an id we generated means an earlier try wrote it
+            if result.get('error') == 'conflict' and result.get('id') in generated:
+                result.pop('error')
+                result.pop('reason', None)
+            elif cls.router is not None and 'rev' in result:
+                cls.router.note_write(result['id'], result['rev'])
+        return results
+
+    @classmethod
+    @tracing.traced('Inventory.bulk_docs')
+    @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT,
+           logger=logger)
+    def bulk_docs(cls, documents):
+        """ Writes a batch of raw documents with one _bulk_docs request """
+        return cls.database.bulk_docs(documents)
+
+    @classmethod
+    @tracing.traced('Inventory.save_many')
+    def save_many(cls, documents):
+        """
+        Writes back changed documents in a single _bulk_docs request
+
+        Each document must carry the _rev it was read at. Returns the
+        _bulk_docs result for each document, in order; documents that
+        changed in the meantime fail with a 'conflict' error.
+        """
+        results = cls.bulk_docs(documents)
+        for document, result in zip(documents, results):
+            # the client's own document cache would hold the old revision
+            cls.database.pop(document['_id'], None)
+            if 'error' not in result:
+                document['_rev'] = result['rev']
+                cls.record_write(document)
+        return results
+
+    @classmethod
+    def snapshot(cls, path, compress=False):
+        """ Writes every Inventory to a binary snapshot file at path """
+        from .snapshot import snapshot   # the snapshot module imports this one
+        return snapshot(path, cls.iterate(), compress=compress)
+
+    @classmethod
+    def restore(cls, path, progress=None):
+        """ Bulk loads a binary snapshot file written by snapshot() """
+        from .snapshot import restore
+        return restore(path, progress=progress)
+
+    @classmethod
+    @tracing.traced('Inventory.remove_all')
     @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT,
            logger=logger)
     def remove_all(cls):
-        """ Removes all documents from the database (use for testing)  """
-        for document in cls.database:
-            document.delete()
+        """
+        Removes all documents from the database (use for testing)
+
+        The database is dropped and recreated with its indexes and views,
+        which takes a constant number of requests and leaves no tombstones.
+        Without permission to drop databases the documents are deleted in
+        _bulk_docs batches instead.
+        """
+        try:
+            cls.recreate_database()
+        except HTTPError as err:
+            if err.response is None or err.response.status_code not in (401, 403):
+                raise
+            cls.logger.info('Cannot drop database, deleting documents instead: %s', err)
+            cls.delete_all_documents()
+        cls.database.clear()
+        if cls.cache is not None:
+            cls.cache.clear()
+
+    @classmethod
+    def recreate_database(cls):
+        """ Drops and recreates the database with its indexes and views """
+        dbname = cls.database.database_name
+        cls.database.delete()
+        cls.database = cls.create_database(dbname, cls.partitioned)
+        cls.ensure_indexes()
+        cls.ensure_views()
+
+    @classmethod
+    def create_database(cls, dbname, partitioned=False):
+        """ Creates a database, partitioned by category if asked """
+        if not partitioned:
+            return cls.client.create_database(dbname)
+        database = CloudantDatabase(cls.client, dbname)
+        response = cls.client.r_session.put(database.database_url,
+                                            params={'partitioned': 'true'})
+        response.raise_for_status()
+        cls.client[dbname] = database
+        return database
+
+    @classmethod
+    def database_request(cls, method, path, partition=None, database=None, **kwargs):
+        """
+        Sends a request to the database that the cloudant library has no call for
+
+        With a partition the path is relative to the partition, e.g.
+        _partition/{partition}/_find. The request goes to the primary
+        unless another database (a replica) is given. Returns the decoded
+        JSON response.
+        """
+        database = database or cls.database
+        url = database.database_url
+        if partition is not None:
+            url += '/_partition/' + quote(partition.encode('utf-8'), safe='')
+        response = database.r_session.request(method, url + '/' + path, **kwargs)
+        response.raise_for_status()
+        return response.json()
+
+    @classmethod
+    def partition_query(cls, selector, database=None, **options):
+        """
+        Yields the documents matching a selector that has a category
+
+        In a partitioned database the query runs in the category's
+        partition, on one shard, paging through it with bookmarks;
+        otherwise it is an ordinary query.
+        """
+        database = cls.database if database is None else database
+        if not cls.partitioned:
+            for doc in Query(database, selector=selector, **options).result:
+                yield doc
+            return
+        for doc in cls.query_pages(selector, partition_key(selector['category']),
+                                   database, **options):
+            yield doc
+
+    @classmethod
+    def query_pages(cls, selector, partition=None, database=None, **options):
+        """
+        Yields the documents matching a selector, paging with bookmarks
+
+        Each page resumes where the last ended, so reading N matches takes
+        N/limit requests, where paging with skip would rescan every
+        earlier page. With a partition the query stays in it.
+        """
+        database = cls.database if database is None else database
+        query = dict(options, selector=selector)
+        limit = query.setdefault('limit', QUERY_LIMIT)
+        while True:
+            result = cls.database_request('POST', '_find', partition, database, json=query)
+            for doc in result['docs']:
+                yield doc
+            if len(result['docs']) < limit or not result.get('bookmark'):
+                return
+            query['bookmark'] = result['bookmark']
+
+    @classmethod
+    @tracing.traced('Inventory.delete_all_documents')
+    def delete_all_documents(cls):
+        """ Deletes every document except design documents in batches """
+        startkey = u'\u0000'
+        while startkey is not None:
+            rows = cls.all_docs_page(startkey, QUERY_LIMIT, include_docs=False)
+            startkey = rows[-1]['id'] + u'\u0000' if len(rows) == QUERY_LIMIT else None
+            deletions = [{'_id': row['id'], '_rev': row['value']['rev'], '_deleted': True}
+                         for row in rows if not row['id'].startswith('_design/')]
+            if deletions:
+                cls.bulk_docs(deletions)
 
     @classmethod
     @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT,
            logger=logger)
     def all(cls):
         """ Query that returns all inventory """
-        results = []
-        for doc in cls.database:
-            inventory = Inventory().deserialize(doc)
-            inventory.id = doc['_id']
-            results.append(inventory)
-        return results
+        return list(cls.iterate())
+
+    @classmethod
+    @tracing.traced('Inventory.collection')
+    def collection(cls, **kwargs):
+        """
+        Returns the Inventory matching a selector as an InventoryCollection
+
+        Documents are read straight into columns without creating an
+        Inventory per row; with no selector every document is returned.
+        """
+        collection = InventoryCollection()
+        if 'category' in kwargs:
+            for doc in cls.partition_query(kwargs):
+                collection.append(doc)
+            return collection
+        if kwargs:
+            for doc in Query(cls.database, selector=kwargs).result:
+                collection.append(doc)
+            return collection
+        startkey = u'\u0000'
+        while startkey is not None:
+            rows = cls.all_docs_page(startkey, QUERY_LIMIT)
+            startkey = rows[-1]['id'] + u'\u0000' if len(rows) == QUERY_LIMIT else None
+            for row in rows:
+                if not row['id'].startswith('_design/'):
+                    collection.append(row['doc'])
+        return collection
+
+    @classmethod
+    def iterate(cls, page_size=QUERY_LIMIT):
+        """
+        Yields every Inventory in the database, one _all_docs page at a time
+
+        Unlike all() this holds only one page in memory and does not fill
+        the client's document cache, so it suits exports of any size.
+        """
+        startkey = u'\u0000'
+        while startkey is not None:
+            rows = cls.all_docs_page(startkey, page_size)
+            startkey = rows[-1]['id'] + u'\u0000' if len(rows) == page_size else None
+            for row in rows:
+                if not row['id'].startswith('_design/'):
+                    yield Inventory.from_document(row['doc'])
 
     @classmethod
+    @tracing.traced('Inventory.all_docs_page')
+    @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT,
+           logger=logger)
+    def all_docs_page(cls, startkey, limit, include_docs=True):
+        """ Returns one page of _all_docs rows, by default with their documents """
+        result = cls.read(lambda database: database.all_docs(
+            startkey=startkey, limit=limit, include_docs=include_docs))
+        return result.get('rows', [])
+
+    @classmethod
+    def read(cls, function, accept=None, operation=None):
+        """
+        Returns function(database) from a replica, or from the primary
+
+        Without replicas this is just function(Inventory.database). Pass
+        accept to check a result for read-your-writes; queries without it
+        read the primary for a while after this process wrote anything.
+        Reads named by an operation are hedged if hedging is on.
+        """
+        if cls.router is None:
+            attempt = hedge = lambda: function(cls.database)
+        else:
+            primary = accept is None and cls.router.recently_written()
+            attempt = lambda: cls.router.read(function, primary=primary, accept=accept)
+            hedge = lambda: cls.router.read(function, primary=primary, accept=accept,
+                                            hedge=True)
+        if cls.hedger is None or operation is None:
+            return attempt()
+        return cls.hedger.run(operation, attempt, hedge)
+
+    @classmethod
+    @tracing.traced('Inventory.find_by')
     @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT,
            logger=logger)
     def find_by(cls, **kwargs):
-        """ Find records using selector """
-        query = Query(cls.database, selector=kwargs)
+        """ Find records using selector, in one partition if it has a category """
+        def query(database):
+            """ Runs the query on one database """
+            if 'category' in kwargs:
+                return list(cls.partition_query(kwargs, database))
+            return list(Query(database, selector=kwargs).result)
+        return [Inventory.from_document(doc) for doc in cls.read(query, operation='find_by')]
+
+    @classmethod
+    @tracing.traced('Inventory.find_ids')
+    @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT,
+           logger=logger)
+    def find_ids(cls, selector, page_size=QUERY_LIMIT):
+        """
+        Returns the ids of every Inventory matching a selector
+
+        The query runs on the primary and returns only ids, page_size at a
+        time with bookmarks, so it is cheap even for many matches, and can
+        be taken before writing to them.
+        """
+        partition = None
+        if cls.partitioned and 'category' in selector:
+            partition = partition_key(selector['category'])
+        docs = cls.query_pages(selector, partition, fields=['_id'], limit=page_size)
+        return [doc['_id'] for doc in docs if not doc['_id'].startswith('_design/')]
+
+    @classmethod
+    @tracing.traced('Inventory.documents')
+    @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT,
+           logger=logger)
+    def documents(cls, inventory_ids):
+        """ Returns {id: document} for the ids that exist, read from the primary """
+        result = cls.database.all_docs(keys=list(inventory_ids), include_docs=True)
+        return dict((row['key'], row['doc']) for row in result.get('rows', [])
+                    if row.get('doc'))
+
+    @classmethod
+    @tracing.traced('Inventory.changes')
+    @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT,
+           logger=logger)
+    def changes(cls, since=0, limit=None):
+        """
+        Returns the documents changed after the update sequence since
+
+        Returns a (changes, last_seq, complete) tuple where changes is a list
+        of (seq, id, inventory) tuples in sequence order; inventory is None
+        for a deleted document. Pass last_seq back as since to resume while
+        complete is False: design documents count against limit but are left
+        out, so a short list alone does not mean the feed is exhausted.
+        Raises DataValidationError for a malformed since.
+        """
+        options = {'since': check_since(since), 'include_docs': True}
+        if limit is not None:
+            options['limit'] = limit
+        feed = cls.database.changes(**options)
+        rows = 0
         results = []
-        for doc in query.result:
-            inventory = Inventory()
-            inventory.deserialize(doc)
-            results.append(inventory)
-        return results
+        try:
+            for change in feed:
+                rows += 1
+                if change['id'].startswith('_design/'):
+                    continue
+                inventory = None
+                if not change.get('deleted'):
+                    inventory = Inventory.from_document(change['doc'])
+                results.append((change['seq'], change['id'], inventory))
+        except HTTPError as err:
+            if not routing.is_client_error(err):
+                raise
+            if err.response.status_code == 400:
+                raise DataValidationError('since {!r} is not a checkpoint of this '
+                                          'database'.format(since))
+            # not an HTTPError, so @retry gives up at once: a retry would fail alike
+            raise RequestException(str(err), response=err.response)
+        return results, feed.last_seq, limit is None or rows < limit
 
     @classmethod
+    @tracing.traced('Inventory.find')
     @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT,
            logger=logger)
     def find(cls, inventory_id):
         """ Query that finds Inventory by their id """
+        if cls.cache is not None and cls.cache.fresh():
+            return cls.find_shared(inventory_id)
+        if cls.router is not None or cls.hedger is not None:
+            document = cls.fetch(inventory_id)
+            return Inventory.from_document(document) if document else None
         try:
             document = cls.database[inventory_id]
-            return Inventory().deserialize(document)
+            return Inventory.from_document(document)
         except KeyError:
             return None
 
+    @classmethod
+    @tracing.traced('Inventory.find_many')
+    @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT,
+           logger=logger)
+    def find_many(cls, inventory_ids):
+        """ Query that finds many Inventory by id in a single request """
+        inventory_ids = list(inventory_ids)
+        cached = {}
+        if cls.cache is not None and cls.cache.fresh():
+            cached = cls.cache.get_many(inventory_ids)
+        missing = [inventory_id for inventory_id in inventory_ids if inventory_id not in cached]
+        if missing:
+            result = cls.read(lambda database: database.all_docs(keys=missing,
+                                                                 include_docs=True),
+                              accept=lambda result: all(cls.is_current(row['key'], row.get('doc'))
+                                                        for row in result.get('rows', [])),
+                              operation='find_many')
+            for row in result.get('rows', []):
+                document = row.get('doc')
+                if document and cls.cache is not None:
+                    cls.cache.put(document)
+                cached[row['key']] = document
+        return [Inventory.from_document(cached[inventory_id]) for inventory_id in inventory_ids
+                if cached.get(inventory_id) and not inventory_id.startswith('_design/')]
+
+    @classmethod
+    def find_shared(cls, inventory_id):
+        """
+        Finds Inventory by id in the shared cache, reading misses from the database
+
+        Misses bypass the client's own document cache, which may be older
+        than the shared one.
+        """
+        found, document = cls.cache.get(inventory_id)
+        if not found:
+            document = cls.fetch(inventory_id)
+            if document is None:
+                return None
+            cls.cache.put(document)
+        return Inventory.from_document(document) if document else None
+
+    @classmethod
+    @tracing.traced('Inventory.fetch')
+    def fetch(cls, inventory_id):
+        """
+        Reads a document from a replica or the primary, or returns None
+
+        This bypasses the client's own document cache. A replica's copy is
+        only used if it is at least as new as what this process wrote.
+        """
+        def get(database):
+            """ Reads the document from one database """
+            document = Document(database, inventory_id)
+            try:
+                document.fetch()
+            except HTTPError as err:
+                if err.response is None or err.response.status_code != 404:
+                    raise
+                return None
+            return dict(document)
+        return cls.read(get, accept=lambda document: cls.is_current(inventory_id, document),
+                        operation='find')
+
+    @classmethod
+    def is_current(cls, inventory_id, document):
+        """ Returns True unless this process wrote a newer revision of the document """
+        written = cls.router.written_generation(inventory_id) if cls.router else 0
+        if not written:
+            return True
+        return document is not None and routing.generation(document['_rev']) >= written
+
     @classmethod
     @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT,
            logger=logger)
@@ -264,16 +1038,69 @@ class Inventory(object):
         """ Query that finds Inventory by their condition """
         return cls.find_by(condition=condition)
 
+    @classmethod
+    @tracing.traced('Inventory.find_low_stock')
+    @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT,
+           logger=logger)
+    def find_low_stock(cls, threshold, category=None, limit=QUERY_LIMIT):
+        """
+        Query that finds Inventory with a count below threshold
+
+        Results are sorted by count ascending and read from the count or
+        (category, count) index, so only the first `limit` rows are scanned.
+        """
+        selector = {'count': {'$lt': threshold}}
+        if category is None:
+            sort = [{'count': 'asc'}]
+            use_index = 'inventory-count'
+        else:
+            selector['category'] = category
+            sort = [{'category': 'asc'}, {'count': 'asc'}]
+            use_index = 'inventory-category-count'
+            if cls.partitioned:
+                result = cls.database_request('POST', '_find', partition_key(category), json={
+                    'selector': selector, 'sort': sort, 'limit': limit,
+                    'use_index': use_index})
+                return [Inventory.from_document(doc) for doc in result['docs']]
+        result = cls.database.get_query_result(selector, raw_result=True, sort=sort,
+                                               limit=limit, use_index=use_index)
+        return [Inventory.from_document(doc) for doc in result['docs']]
+
+    @classmethod
+    @tracing.traced('Inventory.search_by_name')
+    @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT,
+           logger=logger)
+    def search_by_name(cls, prefix, limit=QUERY_LIMIT):
+        """
+        Query that finds Inventory whose name starts with prefix
+
+        Matching is case-insensitive and reads a bounded key range of the
+        by_name view, so it never scans the whole database.
+        """
+        prefix = prefix.lower()
+        result = cls.database.get_view_result('_design/inventory', 'by_name',
+                                              raw_result=True, include_docs=True,
+                                              startkey=prefix,
+                                              endkey=prefix + u'\ufff0',
+                                              limit=limit)
+        return [Inventory.from_document(row['doc']) for row in result['rows']]
+
 
 ############################################################
 #  C L O U D A N T   D A T A B A S E   C O N N E C T I O N
 ############################################################
 
     @staticmethod
-    def init_db(dbname='inventory'):
+    def init_db(dbname='inventory', partitioned=None):
         """
         Initialized Cloundant database connection
+
+        A database that does not exist yet is created partitioned by
+        category if partitioned (by default DATABASE_PARTITIONED) is True;
+        an existing one is used in the layout it has.
         """
+        if partitioned is None:
+            partitioned = DATABASE_PARTITIONED
         opts = {}
         vcap_services = {}
         # Try and get VCAP from the environment or a file if developing
@@ -302,6 +1129,22 @@ class Inventory(object):
                 opts['port'] = cloudant_service['credentials']['port']
                 opts['url'] = cloudant_service['credentials']['url']
 
+        # with several endpoints the primary takes the writes
+        endpoints = routing.parse_endpoints()
+        for role, url in endpoints:
+            if role == 'primary':
+                opts['url'] = url
+
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=CLOUDANT_POOL_SIZE)
+        if os.environ.get('DATABASE_BACKEND', DATABASE_BACKEND) == 'memory':
+            Inventory.logger.info('Using the in-memory database backend')
+            opts['url'] = memory.MEMORY_URL
+            adapter = memory.adapter()
+            memory.register_views(Inventory.VIEWS)
+            endpoints = []
+        adapter = tracing.instrument(adapter)
+        dbname += DATABASE_SUFFIX
+
         try:
             if ADMIN_PARTY:
                 Inventory.logger.info('Running in Admin Party Mode...')
@@ -310,7 +1153,8 @@ class Inventory(object):
                                   url=opts['url'],
                                   connect=True,
                                   auto_renew=True,
-                                  admin_party=ADMIN_PARTY
+                                  admin_party=ADMIN_PARTY,
+                                  adapter=adapter
                                  )
         except ConnectionError:
             raise AssertionError('Cloudant service could not be reached')
@@ -320,7 +1164,212 @@ class Inventory(object):
             Inventory.database = Inventory.client[dbname]
         except KeyError:
             # Create a database using an initialized client
-            Inventory.database = Inventory.client.create_database(dbname)
+            Inventory.database = Inventory.create_database(dbname, partitioned)
         # check for success
         if not Inventory.database.exists():
             raise AssertionError('Database [{}] could not be obtained'.format(dbname))
+        props = Inventory.database.metadata().get('props', {})
+        Inventory.partitioned = bool(props.get('partitioned'))
+        Inventory.cache = sharedcache.open_cache(Inventory.database)
+        Inventory.router = Inventory.connect_replicas(opts, endpoints, dbname)
+        if hedging.HEDGE_READS and Inventory.hedger is None:
+            Inventory.hedger = hedging.Hedger()
+        Inventory.ensure_indexes()
+        Inventory.ensure_views()
+
+    @staticmethod
+    def connect_replicas(opts, endpoints, dbname):
+        """
+        Connects to the replicas among endpoints
+
+        Returns a ReadRouter over them, or None if there are none. A
+        replica that cannot be reached now is left out with a warning.
+        """
+        replicas = []
+        for role, url in endpoints:
+            if role != 'replica':
+                continue
+            try:
+                client = Cloudant(opts['username'], opts['password'], url=url,
+                                  connect=True, auto_renew=True, admin_party=ADMIN_PARTY,
+                                  adapter=tracing.instrument(HTTPAdapter(
+                                      pool_connections=1, pool_maxsize=CLOUDANT_POOL_SIZE)))
+                replicas.append(routing.Node(url, client[dbname]))
+            except (HTTPError, ConnectionError, KeyError) as err:
+                Inventory.logger.warning('Replica %s is not available: %s', url, err)
+        if not replicas:
+            return None
+        Inventory.logger.info('Reading from %d replicas', len(replicas))
+        return routing.ReadRouter(routing.Node(opts['url'], Inventory.database), replicas)
+
+
+class InventoryCollection(object):
+    """
+    Column-wise store for bulk query results
+
+    Counts and availability are kept in typed arrays and categories and
+    conditions as codes into a shared table of distinct values, so a large
+    result costs a few bytes per row rather than an object per row.
+    Filters and sums run on numpy views of the typed arrays.
+    """
+    __slots__ = ('ids', 'revs', 'names', 'categories', 'conditions', 'available', 'counts',
+                 'others', 'values', 'codes')
+
+    AVAILABLE = {True: 1, False: 0, None: -1}
+    FLAGS = {1: True, 0: False, -1: None}
+
+    def __init__(self):
+        self.ids = []
+        self.revs = []
+        self.names = []
+        self.categories = array('i')
+        self.conditions = array('i')
+        self.available = array('b')
+        self.counts = array('l')
+        self.others = {}        # (row, field) -> value that does not fit a column
+        self.values = []        # distinct categories and conditions
+        self.codes = {}         # value -> index into values
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _code(self, value):
+        """ Returns the code of a category or condition """
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def append(self, doc):
+        """ Adds a database document to the collection """
+        try:
+            self.ids.append(doc['_id'])
+            self.revs.append(doc.get('_rev'))
+            self.names.append(doc['name'])
+            self.categories.append(self._code(doc['category']))
+            self.conditions.append(self._code(doc['condition']))
+            available = doc['available']
+            count = doc['count']
+        except KeyError as error:
+            raise DataValidationError('Invalid inventory: missing ' + error.args[0])
+        row = len(self.counts)
+        if isinstance(available, bool) or available is None:
+            self.available.append(self.AVAILABLE[available])
+        else:
+            self.others[row, 'available'] = available
+            self.available.append(-1)
+        if isinstance(count, numbers.Integral) and not isinstance(count, bool):
+            self.counts.append(count)
+        else:
+            self.others[row, 'count'] = count
+            self.counts.append(0)
+
+    @staticmethod
+    def _column(column):
+        """ Returns a numpy view of a typed array column """
+        return np.frombuffer(column, dtype=column.typecode)
+
+    def _mask(self, selector):
+        """ Returns a boolean array of the rows matching an equality selector """
+        mask = np.ones(len(self), dtype=bool)
+        for field, value in selector.items():
+            if field in ('category', 'condition'):
+                column = self.categories if field == 'category' else self.conditions
+                mask &= self._column(column) == self.codes.get(value, -1)
+            elif field in ('id', 'name'):
+                column = self.ids if field == 'id' else self.names
+                mask &= np.array(column, dtype=object) == value
+            elif field in ('available', 'count'):
+                if field == 'available':
+                    column = self.available
+                    code = self.AVAILABLE[value] if value in self.AVAILABLE else None
+                else:
+                    column = self.counts
+                    code = value if isinstance(value, numbers.Number) else None
+                if code is None:
+                    matches = np.zeros(len(self), dtype=bool)
+                else:
+                    matches = self._column(column) == code
+                for (row, name), other in self.others.items():
+                    if name == field:   # the column holds a placeholder
+                        matches[row] = other == value
+                mask &= matches
+            else:
+                raise DataValidationError('Unknown field: {}'.format(field))
+        return mask
+
+    def available_at(self, row):
+        """ Returns the availability of a row as it was stored """
+        if (row, 'available') in self.others:
+            return self.others[row, 'available']
+        return self.FLAGS[self.available[row]]
+
+    def count_at(self, row):
+        """ Returns the count of a row as it was stored """
+        if (row, 'count') in self.others:
+            return self.others[row, 'count']
+        return self.counts[row]
+
+    def filter(self, **selector):
+        """ Returns a new collection with the rows matching the selector """
+        rows = np.flatnonzero(self._mask(selector))
+        result = InventoryCollection()
+        result.values = list(self.values)
+        result.codes = dict(self.codes)
+        for name in ('categories', 'conditions', 'available', 'counts'):
+            column = getattr(self, name)
+            setattr(result, name, array(column.typecode,
+                                        self._column(column)[rows].tobytes()))
+        rows = rows.tolist()
+        result.ids = [self.ids[row] for row in rows]
+        result.revs = [self.revs[row] for row in rows]
+        result.names = [self.names[row] for row in rows]
+        if self.others:
+            position = dict((row, index) for index, row in enumerate(rows))
+            for (row, field), value in self.others.items():
+                if row in position:
+                    result.others[position[row], field] = value
+        return result
+
+    def sum(self, **selector):
+        """ Returns the total integer count of the rows matching the selector """
+        counts = self._column(self.counts)
+        if selector:
+            counts = counts[self._mask(selector)]
+        return int(counts.sum())
+
+    def __iter__(self):
+        """ Yields the rows as Inventory """
+        for row in range(len(self)):
+            inventory = Inventory(self.names[row], self.values[self.categories[row]],
+                                  self.available_at(row),
+                                  self.values[self.conditions[row]], self.count_at(row))
+            inventory.id = self.ids[row]
+            inventory.rev = self.revs[row]
+            yield inventory
+
+    def serialize_row(self, row):
+        """ Serializes one row into a dictionary """
+        return {'id': self.ids[row],
+                'name': self.names[row],
+                'category': self.values[self.categories[row]],
+                'available': self.available_at(row),
+                'condition': self.values[self.conditions[row]],
+                'count': self.count_at(row)}
+
+    def serialize(self):
+        """ Serializes the collection into a list of dictionaries """
+        return [self.serialize_row(row) for row in range(len(self))]
+
+    def to_json(self):
+        """
+        Serializes the collection into a JSON array, as bytes
+
+        Rows are encoded straight from the columns, and rows whose revision
+        was encoded before are taken from the fragment cache.
+        """
+        ids, revs = self.ids, self.revs
+        return b'[' + b','.join(encoding.encode(ids[row], revs[row],
+                                                partial(self.serialize_row, row))
+                                for row in range(len(self))) + b']'
@@ -0,0 +1,229 @@
+"""
+On-demand profiling of a running worker
+
+With PROFILING=true and a PROFILING_TOKEN, the /debug endpoints let an
+operator profile a production worker without attaching anything to it:
+
+    POST /debug/profile?seconds=30&format=collapsed|speedscope
+        samples the stacks of every thread of the worker and returns
+        them as collapsed stacks (for flamegraph.pl and most flame graph
+        tools) or as a speedscope file
+    GET /debug/memory?limit=25
+        returns the lines that allocated the most memory according to
+        tracemalloc, and how much each grew since the previous call
+
+Sampling reads sys._current_frames() every PROFILE_INTERVAL seconds from
+a thread of its own, so the profiled code runs unmodified and the
+overhead is that one thread. In a gevent worker, whose threads are
+greenlets on one OS thread, the sampler runs on a native thread of the
+gevent thread pool instead, and sees whichever greenlet is running.
+tracemalloc only sees allocations made after it started, so the first
+memory call starts it; it needs Python 3.
+"""
+import os
+import sys
+import time
+import importlib
+import threading
+from collections import Counter
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+try:
+    from gevent import monkey as gevent_monkey
+except ImportError:
+    gevent_monkey = None
+
+# serve the /debug endpoints; off by default
+PROFILING = os.environ.get('PROFILING', 'False').lower() == 'true'
+# bearer token the /debug endpoints require; they stay off without one
+PROFILING_TOKEN = os.environ.get('PROFILING_TOKEN', '')
+# longest profile, in seconds
+PROFILE_MAX_SECONDS = float(os.environ.get('PROFILE_MAX_SECONDS', 60))
+# seconds between samples
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL', 0.005))
+# frames tracemalloc keeps per allocation
+PROFILE_TRACEMALLOC_FRAMES = int(os.environ.get('PROFILE_TRACEMALLOC_FRAMES', 1))
+
+FORMATS = ('collapsed', 'speedscope')
+
+
+class ProfilerBusy(Exception):
+    """ Raised when a profile is requested while another one runs """
+
+
+def green():
+    """ Returns True if gevent has patched threading, making threads greenlets """
+    return gevent_monkey is not None and gevent_monkey.is_module_patched('threading')
+
+def original(module, name):
+    """ Returns a function of a module as it was before any gevent patching """
+    if green():
+        return gevent_monkey.get_original(module, name)
+    return getattr(importlib.import_module(module), name)
+
+THREAD_MODULE = '_thread' if sys.version_info[0] >= 3 else 'thread'
+
+
+######################################################################
+#  S A M P L I N G
+######################################################################
+
+class Sampler(object):
+    """ Counts the stacks of every other thread, sampled at an interval """
+
+    def __init__(self, interval=None):
+        self.interval = interval or PROFILE_INTERVAL
+        self.stacks = Counter()     # (thread name, frame, ...) root first -> samples
+        self.samples = 0
+        self.labels = {}            # thread ident -> name, for threads threading does not know
+
+    def sample(self, skip=()):
+        """ Records the current stack of every thread but the idents in skip """
+        names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+        names.update(self.labels)
+        for ident, frame in sys._current_frames().items():
+            if ident in skip:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{} ({}:{})'.format(code.co_name, code.co_filename,
+                                                 code.co_firstlineno))
+                frame = frame.f_back
+            stack.append(names.get(ident, 'thread-{}'.format(ident)))
+            self.stacks[tuple(reversed(stack))] += 1
+        self.samples += 1
+
+    def run(self, seconds, caller=None):
+        """ Samples for seconds, leaving out this thread and the caller's """
+        sleep = original('time', 'sleep')
+        skip = (original(THREAD_MODULE, 'get_ident')(), caller)
+        deadline = time.time() + seconds
+        while time.time() < deadline:
+            self.sample(skip)
+            sleep(self.interval)
+
+    def collapsed(self):
+        """ Returns the samples as collapsed stacks, one 'frame;frame count' per line """
+        return ''.join('{} {}\n'.format(';'.join(stack), count)
+                       for stack, count in sorted(self.stacks.items()))
+
+    def speedscope(self, name='inventory'):
+        """ Returns the samples as a speedscope file (a dictionary to encode as JSON) """
+        frames = []
+        indexes = {}
+        samples = []
+        weights = []
+        for stack, count in sorted(self.stacks.items()):
+            sample = []
+            for frame in stack:
+                if frame not in indexes:
+                    indexes[frame] = len(frames)
+                    frames.append({'name': frame})
+                sample.append(indexes[frame])
+            samples.append(sample)
+            weights.append(count * self.interval)
+        return {
+            '$schema': 'https://www.speedscope.app/file-format-schema.json',
+            'shared': {'frames': frames},
+            'profiles': [{'type': 'sampled',
+                          'name': name,
+                          'unit': 'seconds',
+                          'startValue': 0,
+                          'endValue': sum(weights),
+                          'samples': samples,
+                          'weights': weights}],
+            'name': name,
+            'exporter': 'inventory',
+        }
+
+
+_profiling = threading.Lock()
+
+def profile(seconds, interval=None):
+    """
+    Samples every thread but the caller's for seconds on a thread of its own
+
+    Under gevent the sampler runs on a native thread of the hub's thread
+    pool, and every greenlet, the caller's included, shares the one OS
+    thread it samples. Returns the Sampler. Raises ProfilerBusy if a
+    profile is running.
+    """
+    if not _profiling.acquire(False):
+        raise ProfilerBusy('A profile is already running in this worker')
+    try:
+        sampler = Sampler(interval)
+        if green():
+            import gevent
+            hub = gevent.get_hub()
+            sampler.labels[hub.thread_ident] = 'greenlets'
+            hub.threadpool.spawn(sampler.run, seconds).get()
+            return sampler
+        caller = threading.current_thread().ident
+        thread = threading.Thread(target=sampler.run, args=(seconds, caller),
+                                  name='inventory-profiler')
+        thread.daemon = True
+        thread.start()
+        thread.join()
+        return sampler
+    finally:
+        _profiling.release()
+
+
+######################################################################
+#  M E M O R Y
+######################################################################
+
+_snapshot = None    # the tracemalloc snapshot of the previous call
+
+def memory(limit=25):
+    """
+    Returns the top allocations by line, and their growth since the last call
+
+    The first call starts tracemalloc and reports nothing yet. Raises
+    RuntimeError without tracemalloc.
+    """
+    global _snapshot
+    if tracemalloc is None:
+        raise RuntimeError('tracemalloc needs Python 3.4 or later')
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(PROFILE_TRACEMALLOC_FRAMES)
+        _snapshot = None
+        return {'tracing': True, 'started': True, 'top': [], 'growth': []}
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    ))
+    current, peak = tracemalloc.get_traced_memory()
+    result = {
+        'tracing': True,
+        'started': False,
+        'current': current,
+        'peak': peak,
+        'top': [serialize_stat(stat) for stat in snapshot.statistics('lineno')[:limit]],
+        'growth': [],
+    }
+    if _snapshot is not None:
+        result['growth'] = [serialize_stat(stat) for stat
+                            in snapshot.compare_to(_snapshot, 'lineno')[:limit]]
+    _snapshot = snapshot
+    return result
+
+def serialize_stat(stat):
+    """ Serializes a tracemalloc Statistic or StatisticDiff into a dictionary """
+    frame = stat.traceback[0]
+    data = {'file': frame.filename, 'line': frame.lineno,
+            'size': stat.size, 'count': stat.count}
+    if hasattr(stat, 'size_diff'):
+        data['size_diff'] = stat.size_diff
+        data['count_diff'] = stat.count_diff
+    return data
+
+def stop_memory():
+    """ Stops tracemalloc, dropping what it traced """
+    global _snapshot
+    _snapshot = None
+    if tracemalloc is not None and tracemalloc.is_tracing():
+        tracemalloc.stop()
@@ -0,0 +1,406 @@
+"""
+Stock reservations for the Inventory Service
+
+A checkout used to take stock by writing count on the Inventory document,
+so every buyer of a popular item queued on that one document's _rev and
+most of them got conflicts. A reservation is instead a document of its
+own, in a database of its own (the Inventory database name plus
+_reservations), so buyers never write the same document:
+
+    held      - created with a quantity and an expiry time (RESERVATION_TTL)
+    committed - the buyer checked out; the stock is taken but not yet
+                subtracted from count
+
+The available quantity of an Inventory is its count minus its held and
+committed quantities, read from the reduced holds view, which CouchDB
+keeps up to date incrementally. Held reservations are keyed by their
+expiry time, so a hold stops counting when it expires even before it is
+swept.
+
+A ReservationSweeper (python manage.py sweep-reservations, or the gunicorn
+master with RESERVATION_SWEEPER=master, see gunicorn.conf.py) deletes
+expired holds and folds committed reservations into count with a single
+write per Inventory per sweep. A sweeper takes reservations by marking
+them with a fold id, which only one sweeper can do to a revision, and
+records the fold on the Inventory document, so no reservation is folded
+twice. Marked reservations are left to their sweeper for
+RESERVATION_FOLD_LEASE seconds, then taken over in case it stopped half
+way through.
+"""
+import os
+import time
+import uuid
+import logging
+from retry import retry
+from requests import HTTPError, ConnectionError
+from cloudant.document import Document
+from cloudant.error import CloudantDatabaseException
+from . import memory, tracing
+from .models import (Inventory, DataValidationError, RETRY_COUNT, RETRY_DELAY,
+                     RETRY_BACKOFF)
+
+# seconds a hold lasts unless the request asks for less
+RESERVATION_TTL = float(os.environ.get('RESERVATION_TTL', 600))
+# longest hold a request may ask for, in seconds
+RESERVATION_MAX_TTL = float(os.environ.get('RESERVATION_MAX_TTL', 3600))
+# seconds between sweeps
+RESERVATION_SWEEP_INTERVAL = float(os.environ.get('RESERVATION_SWEEP_INTERVAL', 10))
+# reservations expired or folded per request of a sweep
+RESERVATION_SWEEP_BATCH = int(os.environ.get('RESERVATION_SWEEP_BATCH', 500))
+# seconds a sweeper has to fold the reservations it marked before another may
+RESERVATION_FOLD_LEASE = float(os.environ.get('RESERVATION_FOLD_LEASE', 300))
+# fold ids remembered on an Inventory document
+RESERVATION_FOLDS_KEPT = 20
+
+HELD = 'held'
+COMMITTED = 'committed'
+FOLDING = 'folding'         # committed, and being folded into count
+
+VIEWS = {
+    '_design/reservations': {
+        # held reservations by expiry time, committed ones after every time
+        'holds': {
+            'map': "function (doc) { if (doc.type === 'reservation') { "
+                   "emit([doc.inventory_id, doc.state === 'held' ? doc.expires : "
+                   "'committed'], doc.quantity); } }",
+            'reduce': '_sum',
+            'python': lambda doc: ([([doc['inventory_id'], doc['expires']
+                                      if doc['state'] == HELD else COMMITTED],
+                                     doc['quantity'])]
+                                   if doc.get('type') == 'reservation' else []),
+        },
+        # held reservations by [expiry time]; cloudant takes no bare number keys
+        'expiry': {
+            'map': "function (doc) { if (doc.type === 'reservation' && "
+                   "doc.state === 'held') { emit([doc.expires], null); } }",
+            'python': lambda doc: ([([doc['expires']], None)]
+                                   if doc.get('type') == 'reservation' and
+                                   doc['state'] == HELD else []),
+        },
+        'pending': {
+            'map': "function (doc) { if (doc.type === 'reservation' && "
+                   "doc.state !== 'held') { emit(doc.inventory_id, doc.quantity); } }",
+            'python': lambda doc: ([(doc['inventory_id'], doc['quantity'])]
+                                   if doc.get('type') == 'reservation' and
+                                   doc['state'] != HELD else []),
+        },
+    },
+}
+
+logger = logging.getLogger(__name__)
+
+
+class ReservationConflict(Exception):
+    """ Raised when there is not enough stock, or a reservation is not held """
+
+
+class Reservation(object):
+    """ A hold on a quantity of one Inventory """
+
+    database = None     # cloudant.database.CloudantDatabase of the reservations
+    client = None       # the Inventory client the database belongs to
+
+    def __init__(self, document):
+        self.id = document['_id']
+        self.rev = document.get('_rev')
+        self.inventory_id = document['inventory_id']
+        self.quantity = document['quantity']
+        self.state = document['state']
+        self.expires = document['expires']
+
+    def serialize(self):
+        """ Serializes a Reservation into a dictionary """
+        return {'id': self.id,
+                'inventory_id': self.inventory_id,
+                'quantity': self.quantity,
+                'state': self.state,
+                'expires': self.expires}
+
+    ##################################################################
+    # Database
+    ##################################################################
+
+    @classmethod
+    def connect(cls):
+        """ Returns the reservations database, creating it and its views if needed """
+        if cls.database is not None and cls.client is Inventory.client:
+            return cls.database
+        if Inventory.client is None:
+            raise AssertionError('Inventory.init_db() has not been called')
+        dbname = Inventory.database.database_name + '_reservations'
+        try:
+            database = Inventory.client[dbname]
+        except KeyError:
+            database = Inventory.client.create_database(dbname)
+        memory.register_views(VIEWS)
+        Inventory.ensure_views(database, VIEWS)
+        cls.database, cls.client = database, Inventory.client
+        return database
+
+    @classmethod
+    def remove_all(cls):
+        """ Deletes every reservation (use for testing) """
+        database = cls.connect()
+        rows = database.all_docs(include_docs=False).get('rows', [])
+        deletions = [{'_id': row['id'], '_rev': row['value']['rev'], '_deleted': True}
+                     for row in rows if not row['id'].startswith('_design/')]
+        if deletions:
+            database.bulk_docs(deletions)
+        database.clear()
+
+    @classmethod
+    def view(cls, name, **params):
+        """ Returns the rows of a reservations view """
+        return cls.connect().get_view_result('_design/reservations', name,
+                                             raw_result=True, **params)['rows']
+
+    ##################################################################
+    # Holds
+    ##################################################################
+
+    @classmethod
+    @tracing.traced('Reservation.held')
+    @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT,
+           logger=logger)
+    def held(cls, inventory_id, now=None):
+        """ Returns the quantity of an Inventory that is held or committed """
+        now = time.time() if now is None else now
+        rows = cls.view('holds', startkey=[inventory_id, now], endkey=[inventory_id, {}])
+        return rows[0]['value'] if rows else 0
+
+    @classmethod
+    def available(cls, inventory):
+        """ Returns the count of an Inventory less what is held or committed """
+        return inventory.count - cls.held(inventory.id)
+
+    @classmethod
+    @tracing.traced('Reservation.hold')
+    def hold(cls, inventory, quantity, ttl=None, seed=None):
+        """
+        Holds a quantity of an Inventory for ttl seconds
+
+        The hold is written first and the stock checked after, counting
+        every other hold: if there is not enough the hold is withdrawn and
+        ReservationConflict raised. Buyers racing for the last units may
+        then both be turned away, but stock is never held twice.
+
+        With a seed (see idempotency.request_seed) the hold's id is the
+        seed, and a hold already made with it is returned instead.
+        """
+        try:
+            quantity = Inventory.schema.check_count(quantity)
+        except ValueError as error:
+            raise DataValidationError('quantity {}'.format(error))
+        if quantity <= 0:
+            raise DataValidationError('quantity must be positive')
+        ttl = RESERVATION_TTL if ttl is None else ttl
+        if not 0 < ttl <= RESERVATION_MAX_TTL:
+            raise DataValidationError('ttl must be between 0 and {:g} seconds'.format(
+                RESERVATION_MAX_TTL))
+        now = time.time()
+        data = {'_id': seed or uuid.uuid4().hex,
+                'type': 'reservation',
+                'inventory_id': inventory.id,
+                'quantity': quantity,
+                'state': HELD,
+                'created': now,
+                'expires': now + ttl}
+        database = cls.connect()
+        try:
+            document = database.create_document(data, throw_on_exists=seed is not None)
+        except CloudantDatabaseException:
+            return Reservation(database[seed])
+        if cls.held(inventory.id, now) > inventory.count:
+            document.delete()
+            raise ReservationConflict('Only {} of inventory {} are available'.format(
+                max(0, inventory.count - cls.held(inventory.id, now)), inventory.id))
+        return Reservation(document)
+
+    @classmethod
+    def find(cls, inventory_id, reservation_id):
+        """ Returns a Reservation of an Inventory, or None """
+        document = Document(cls.connect(), reservation_id)
+        try:
+            document.fetch()
+        except HTTPError as err:
+            if err.response is None or err.response.status_code != 404:
+                raise
+            return None
+        if document.get('inventory_id') != inventory_id:
+            return None
+        return Reservation(document)
+
+    @tracing.traced('Reservation.commit')
+    def commit(self):
+        """
+        Takes the held stock; it is subtracted from count by the sweeper
+
+        Raises ReservationConflict if the hold expired, was swept or
+        released, or changed since it was read.
+        """
+        if self.state != HELD or self.expires <= time.time():
+            raise ReservationConflict('Reservation {} is {}'.format(
+                self.id, self.state if self.state != HELD else 'expired'))
+        document = Document(self.connect(), self.id)
+        try:
+            document.fetch()
+            if document['_rev'] != self.rev:
+                raise ReservationConflict('Reservation {} changed'.format(self.id))
+            document['state'] = COMMITTED
+            document['committed'] = time.time()
+            document.save()
+        except HTTPError as err:
+            if err.response is None or err.response.status_code not in (404, 409):
+                raise
+            raise ReservationConflict('Reservation {} is {}'.format(
+                self.id, 'gone' if err.response.status_code == 404 else 'changed'))
+        self.state = COMMITTED
+        self.rev = document['_rev']
+
+    @tracing.traced('Reservation.release')
+    def release(self):
+        """ Gives held stock back """
+        if self.state != HELD:
+            raise ReservationConflict('Reservation {} is {}'.format(self.id, self.state))
+        result = self.connect().bulk_docs([{'_id': self.id, '_rev': self.rev,
+                                            '_deleted': True}])[0]
+        if 'error' in result:
+            raise ReservationConflict('Reservation {} changed: {}'.format(
+                self.id, result['error']))
+
+
+######################################################################
+#  S W E E P E R
+######################################################################
+
+class ReservationSweeper(object):
+    """ Deletes expired holds and folds committed reservations into count """
+
+    def __init__(self, interval=None):
+        self.interval = interval or RESERVATION_SWEEP_INTERVAL
+        self.running = False
+
+    def sweep(self):
+        """ Sweeps once; returns (holds expired, reservations folded) """
+        return self.expire(), self.fold()
+
+    def expire(self, now=None):
+        """ Deletes the holds that expired; returns how many """
+        now = time.time() if now is None else now
+        expired = 0
+        while True:
+            rows = Reservation.view('expiry', endkey=[now], include_docs=True,
+                                    limit=RESERVATION_SWEEP_BATCH)
+            if not rows:
+                return expired
+            results = Reservation.connect().bulk_docs(
+                [{'_id': row['id'], '_rev': row['doc']['_rev'], '_deleted': True}
+                 for row in rows])
+            expired += sum(1 for result in results if 'error' not in result)
+            if len(rows) < RESERVATION_SWEEP_BATCH or expired == 0:
+                return expired
+
+    def fold(self):
+        """ Subtracts committed reservations from count; returns how many """
+        rows = Reservation.view('pending', include_docs=True, limit=RESERVATION_SWEEP_BATCH)
+        by_inventory = {}
+        for row in rows:
+            by_inventory.setdefault(row['key'], []).append(row['doc'])
+        return sum(self.fold_inventory(inventory_id, documents)
+                   for inventory_id, documents in sorted(by_inventory.items()))
+
+    def fold_inventory(self, inventory_id, documents):
+        """
+        Folds the committed reservations of one Inventory into its count
+
+        The reservations are first marked with a new fold id, then count
+        is lowered and the fold id recorded in one write of the Inventory,
+        and only then are the reservations deleted. Marking writes the
+        revision the view returned, so of two sweepers only one marks a
+        reservation. Reservations of a fold the Inventory already records
+        are just deleted, so the work of a sweep that was interrupted is
+        finished rather than repeated; those marked but not recorded are
+        left to the sweeper that marked them until its lease runs out.
+        """
+        database = Reservation.connect()
+        item = Document(Inventory.database, inventory_id)
+        try:
+            item.fetch()
+        except HTTPError as err:
+            if err.response is None or err.response.status_code != 404:
+                raise
+            item = None
+        now = time.time()
+        applied = set(item.get('folds', [])) if item is not None else set()
+        done = [document for document in documents if document.get('fold') in applied]
+        if item is not None:
+            fold_id = uuid.uuid4().hex
+            marked = []
+            pending = [document for document in documents
+                       if document.get('fold') not in applied and
+                       (document['state'] == COMMITTED or
+                        document.get('marked', 0) + RESERVATION_FOLD_LEASE <= now)]
+            for document in pending:
+                document['state'] = FOLDING
+                document['fold'] = fold_id
+                document['marked'] = now
+            for document, result in zip(pending, database.bulk_docs(pending)):
+                if 'error' not in result:
+                    document['_rev'] = result['rev']
+                    marked.append(document)
+            if marked and self.lower_count(item, fold_id,
+                                           sum(document['quantity'] for document in marked),
+                                           now + RESERVATION_FOLD_LEASE):
+                done += marked
+        else:
+            done = documents    # the Inventory is gone, and its stock with it
+        database.bulk_docs([{'_id': document['_id'], '_rev': document['_rev'],
+                             '_deleted': True} for document in done])
+        return len(done)
+
+    @staticmethod
+    def lower_count(item, fold_id, quantity, deadline=None):
+        """
+        Lowers the count of an Inventory document and records the fold
+
+        Returns False without writing once deadline (the end of the lease on
+        the reservations) has passed, as another sweeper may have taken them.
+        """
+        for _ in range(RETRY_COUNT):
+            if deadline is not None and time.time() >= deadline:
+                logger.warning('Lease on fold %s of inventory %s ran out', fold_id, item['_id'])
+                return False
+            count = item.get('count') or 0
+            if quantity > count:
+                logger.warning('Inventory %s had %d committed but a count of %d',
+                               item['_id'], quantity, count)
+            item['count'] = max(0, count - quantity)
+            item['folds'] = (item.get('folds') or [])[-(RESERVATION_FOLDS_KEPT - 1):] + \
+                [fold_id]
+            try:
+                item.save()
+            except HTTPError as err:
+                if err.response is None or err.response.status_code != 409:
+                    raise
+                item.fetch()    # changed under us: lower the new count
+                continue
+            Inventory.database.pop(item['_id'], None)
+            Inventory.record_write(dict(item))
+            return True
+        raise ReservationConflict('Could not lower the count of {}'.format(item['_id']))
+
+    def run(self):
+        """ Sweeps every interval until stop() is called """
+        self.running = True
+        while self.running:
+            try:
+                expired, folded = self.sweep()
+                if expired or folded:
+                    logger.info('Expired %d holds, folded %d reservations', expired, folded)
+            except (HTTPError, ConnectionError) as err:
+                logger.warning('Reservation sweep failed: %s', err)
+            time.sleep(self.interval)
+
+    def stop(self):
+        """ Stops run() after the current sweep """
+        self.running = False
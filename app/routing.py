@@ -0,0 +1,282 @@
+"""
+Read routing across CouchDB replicas for the Inventory Service
+
+Writes always go to the primary. Reads can be sent to any replica: the
+ReadRouter picks between two random healthy replicas the one with the
+lower moving average latency ("power of two choices"), so load follows
+capacity without every worker piling onto the single fastest node, and
+adding replicas adds read capacity.
+
+A replica is ejected for a while when a read fails, when a health check
+fails or when it is much slower than the fastest replica, and health
+checks bring it back. Reads fall back to the primary when no replica is
+healthy.
+
+Replicas receive writes through CouchDB replication, so they can lag.
+Update sequences are not comparable between servers, so read-your-writes
+uses what this process last wrote instead: a document read by id must be
+at least at the revision last written here, and queries go to the
+primary for READ_YOUR_WRITES seconds after any write.
+
+Endpoints are configured as CLOUDANT_ENDPOINTS, a comma separated list of
+role=url pairs, e.g.
+
+    primary=http://couch-a:5984,replica=http://couch-b:5984,replica=http://couch-c:5984
+"""
+import os
+import time
+import random
+import logging
+import threading
+from requests import HTTPError, ConnectionError
+
+# role=url pairs of the database servers; empty for a single server
+CLOUDANT_ENDPOINTS = os.environ.get('CLOUDANT_ENDPOINTS', '')
+# seconds after a write during which queries read from the primary; 0 turns it off
+READ_YOUR_WRITES = float(os.environ.get('READ_YOUR_WRITES', 5))
+# seconds between health checks of every replica
+ROUTING_HEALTH_INTERVAL = float(os.environ.get('ROUTING_HEALTH_INTERVAL', 5))
+# seconds a failing or slow replica is left out, doubled per consecutive failure
+ROUTING_EJECT_TIME = float(os.environ.get('ROUTING_EJECT_TIME', 10))
+# a replica this many times slower than the fastest one is ejected
+ROUTING_SLOW_FACTOR = float(os.environ.get('ROUTING_SLOW_FACTOR', 4))
+# ... unless it answers within this many seconds anyway
+ROUTING_SLOW_MIN = float(os.environ.get('ROUTING_SLOW_MIN', 0.05))
+# weight of the latest latency in the moving average
+ROUTING_LATENCY_WEIGHT = 0.2
+# documents whose written revision is remembered for read-your-writes
+ROUTING_WRITTEN_SIZE = 10000
+
+ROLES = ('primary', 'replica')
+
+logger = logging.getLogger(__name__)
+
+
+def parse_endpoints(value=None):
+    """
+    Returns [(role, url)] from a CLOUDANT_ENDPOINTS value
+
+    Raises ValueError for an unknown role or unless there is exactly one
+    primary.
+    """
+    value = CLOUDANT_ENDPOINTS if value is None else value
+    endpoints = []
+    for entry in value.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        role, _, url = entry.partition('=')
+        role = role.strip().lower()
+        if role not in ROLES or not url.strip():
+            raise ValueError('Invalid endpoint {!r}: expected role=url with role '
+                             'primary or replica'.format(entry))
+        endpoints.append((role, url.strip()))
+    if endpoints and [role for role, _ in endpoints].count('primary') != 1:
+        raise ValueError('CLOUDANT_ENDPOINTS needs exactly one primary')
+    return endpoints
+
+def generation(rev):
+    """ Returns the generation number of a revision, e.g. 3 for '3-a1b2' """
+    return int(rev.split('-', 1)[0]) if rev else 0
+
+
+class Node(object):
+    """ One database server and its health """
+
+    def __init__(self, url, database):
+        self.url = url
+        self.database = database    # cloudant.database.CloudantDatabase
+        self.latency = None         # moving average in seconds
+        self.failures = 0           # consecutive failures
+        self.ejected_until = 0
+        self.reads = 0
+        self.errors = 0
+
+    def healthy(self, now=None):
+        """ Returns True unless the node is ejected """
+        return (now or time.time()) >= self.ejected_until
+
+    def succeeded(self, elapsed):
+        """ Records a successful request that took elapsed seconds """
+        self.failures = 0
+        if self.latency is None:
+            self.latency = elapsed
+        else:
+            self.latency += ROUTING_LATENCY_WEIGHT * (elapsed - self.latency)
+
+    def failed(self):
+        """ Records a failed request and ejects the node """
+        self.failures += 1
+        self.errors += 1
+        self.eject(ROUTING_EJECT_TIME * 2 ** min(self.failures - 1, 6))
+
+    def eject(self, seconds):
+        """ Leaves the node out of routing for seconds """
+        self.ejected_until = time.time() + seconds
+        logger.warning('Ejected replica %s for %.0fs', self.url, seconds)
+
+    def readmit(self):
+        """ Brings an ejected node back into routing """
+        if self.ejected_until:
+            self.ejected_until = 0
+            logger.info('Readmitted replica %s', self.url)
+
+    def serialize(self):
+        """ Serializes the node's health into a dictionary """
+        return {'url': self.url,
+                'healthy': self.healthy(),
+                'latency': self.latency,
+                'reads': self.reads,
+                'errors': self.errors}
+
+
+class ReadRouter(object):
+    """ Sends reads to healthy replicas and everything else to the primary """
+
+    def __init__(self, primary, replicas):
+        self.primary = primary          # Node
+        self.replicas = list(replicas)  # [Node]
+        self.lock = threading.Lock()
+        self.written = {}               # id -> (generation, time) of our writes
+        self.last_write = 0
+        self.thread = None
+        self.closed = False
+
+    ##################################################################
+    # Writes
+    ##################################################################
+
+    def note_write(self, doc_id, rev):
+        """ Remembers a document this process wrote, for read-your-writes """
+        now = time.time()
+        with self.lock:
+            if len(self.written) >= ROUTING_WRITTEN_SIZE:
+                self.written.clear()
+            self.written[doc_id] = (generation(rev), now)
+            self.last_write = now
+
+    def written_generation(self, doc_id):
+        """ Returns the generation this process last wrote a document at, or 0 """
+        entry = self.written.get(doc_id)
+        if entry is None or time.time() - entry[1] >= READ_YOUR_WRITES:
+            return 0
+        return entry[0]
+
+    def recently_written(self):
+        """ Returns True if queries should read from the primary """
+        return time.time() - self.last_write < READ_YOUR_WRITES
+
+    ##################################################################
+    # Reads
+    ##################################################################
+
+    def choose(self):
+        """ Returns the replicas to try in order, best first """
+        now = time.time()
+        healthy = [node for node in self.replicas if node.healthy(now)]
+        if len(healthy) > 2:
+            # power of two choices: the faster of two random replicas goes first
+            first, second = random.sample(healthy, 2)
+            best = min(first, second, key=lambda node: node.latency or 0)
+            healthy.remove(best)
+            healthy.sort(key=lambda node: node.latency or 0)
+            healthy.insert(0, best)
+        else:
+            healthy.sort(key=lambda node: node.latency or 0)
+        return healthy
+
+    def read(self, function, primary=False, accept=None, hedge=False):
+        """
+        Returns function(database) from the best replica that answers
+
+        A replica that fails is ejected and the next one is tried, ending
+        with the primary. Errors that are the client's (4xx) are raised at
+        once. With primary=True the primary is read directly; accept, if
+        given, can reject a replica's result as too old, which then reads
+        the primary. A hedge=True read skips the best replica, which the
+        read it hedges is waiting on.
+        """
+        self.start()
+        nodes = [] if primary else self.choose()
+        if hedge:
+            nodes = nodes[1:]
+        for node in nodes:
+            started = time.time()
+            try:
+                result = function(node.database)
+            except (HTTPError, ConnectionError) as err:
+                if is_client_error(err):
+                    raise
+                node.failed()
+                continue
+            self.record(node, time.time() - started)
+            if accept is None or accept(result):
+                return result
+            break
+        self.primary.reads += 1
+        return function(self.primary.database)
+
+    def record(self, node, elapsed):
+        """ Records a successful read and ejects the replica if it is too slow """
+        node.reads += 1
+        node.succeeded(elapsed)
+        with self.lock:
+            healthy = [other for other in self.replicas
+                       if other.healthy() and other.latency is not None]
+            fastest = min(other.latency for other in healthy) if healthy else None
+        if (fastest is not None and len(healthy) > 1 and
+                node.latency > max(ROUTING_SLOW_FACTOR * fastest, ROUTING_SLOW_MIN)):
+            node.eject(ROUTING_EJECT_TIME)
+
+    ##################################################################
+    # Health checks
+    ##################################################################
+
+    def check(self):
+        """ Checks every replica once """
+        for node in self.replicas:
+            started = time.time()
+            try:
+                node.database.r_session.head(node.database.database_url,
+                                             timeout=ROUTING_HEALTH_INTERVAL
+                                            ).raise_for_status()
+            except (HTTPError, ConnectionError) as err:
+                logger.warning('Health check of %s failed: %s', node.url, err)
+                node.failed()
+            else:
+                node.succeeded(time.time() - started)
+                node.readmit()
+
+    def start(self):
+        """ Starts the health checks unless they are running """
+        if self.thread is not None or not self.replicas:
+            return
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._check_forever,
+                                               name='inventory-health')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def _check_forever(self):
+        """ Checks the replicas every ROUTING_HEALTH_INTERVAL seconds until closed """
+        while True:
+            time.sleep(ROUTING_HEALTH_INTERVAL)
+            if self.closed:
+                return
+            self.check()
+
+    def close(self):
+        """ Stops the health checks """
+        self.closed = True
+
+    def serialize(self):
+        """ Serializes the health of every node into a dictionary """
+        return {'primary': self.primary.serialize(),
+                'replicas': [node.serialize() for node in self.replicas]}
+
+
+def is_client_error(err):
+    """ Returns True for an HTTP 4xx error, which another node would repeat """
+    response = getattr(err, 'response', None)
+    return response is not None and 400 <= response.status_code < 500
@@ -18,25 +18,56 @@ Inventory Service
 Paths:
 ------
 GET /inventory - Returns a list all of the Inventory
+GET /inventory?ids={id},{id} - Returns the Inventory with the given ids
+GET /inventory?since={checkpoint} - Returns Inventory changed after a checkpoint
+GET /inventory/low-stock - Returns Inventory with a count below a threshold
+GET /inventory/changes - Streams Inventory changes as Server-Sent Events
+GET /inventory/export?format=ndjson|csv - Streams all of the Inventory as a file
+GET /inventory/analytics - Returns stock totals, percentiles and top items
+GET /inventory/metrics - Returns admission, read hedging and replica routing counters
+GET /inventory/search?q={prefix} - Returns Inventory whose name starts with a prefix
 GET /inventory/{id} - Returns the Inventory with a given id number
 POST /inventory - creates a new Inventory record in the database
+POST /inventory/import - imports Inventory records from a CSV or NDJSON body
 PUT /inventory/{id} - updates an Inventory record in the database
 PUT /inventory/{id}/void - voids Inventory record in the database
+PUT /inventory/void?category={category} - voids every Inventory matching the filters
+PATCH /inventory?category={category} - updates fields of every Inventory matching the filters
 DELETE /inventory/{id} - deletes an Inventory record in the database
+GET /inventory/{id}/reservations - Returns the count, held and available quantity
+POST /inventory/{id}/reservations - holds a quantity of an Inventory for a while
+POST /inventory/{id}/reservations/{rid}/commit - takes the stock of a hold
+DELETE /inventory/{id}/reservations/{rid} - releases a hold
+
+POST /debug/profile?seconds={seconds} - samples the worker's stacks (PROFILING only)
+GET /debug/memory - returns the top allocations of the worker (PROFILING only)
+DELETE /debug/memory - stops tracing allocations (PROFILING only)
+
+POST requests with an Idempotency-Key header are run once per key; retries
+replay the original response.
 """
 
 import os
 import sys
+import hmac
+import json
 import logging
-from flask import Flask, jsonify, request, url_for, make_response, abort
+from flask import Flask, Response, jsonify, request, url_for, make_response, abort
+from flask import stream_with_context, g
 from flask_api import status    # HTTP Status Codes
-from werkzeug.exceptions import NotFound
+from werkzeug.exceptions import NotFound, Conflict
 
 # For this example we'll use SQLAlchemy, a popular ORM that supports a
 # variety of backends including SQLite, MySQL, and PostgreSQL
 from cloudant.client import Cloudant
 from cloudant.query import Query
-from app.models import Inventory, DataValidationError
+from app.models import Inventory, DataValidationError, QUERY_LIMIT
+from app.changes import shared_feed, CHANGES_HEARTBEAT
+from app.compression import compress_response
+from app import admission, bulk, encoding, profiling, tracing
+from app.reservations import Reservation, ReservationConflict
+from app.idempotency import idempotent, body_digest, stream_digest, request_seed
+from app.analytics import current_snapshot, CODED_FIELDS
 
 # Import Flask application
 from . import app
@@ -58,6 +89,15 @@ def bad_request(error):
                    error='Bad Request',
                    message=message), status.HTTP_400_BAD_REQUEST
 
+@app.errorhandler(status.HTTP_401_UNAUTHORIZED)
+def unauthorized(error):
+    """ Handles requests without valid credentials with 401_UNAUTHORIZED """
+    message = error.message or str(error)
+    app.logger.warning(message)
+    return jsonify(status=status.HTTP_401_UNAUTHORIZED,
+                   error='Unauthorized',
+                   message=message), status.HTTP_401_UNAUTHORIZED
+
 @app.errorhandler(status.HTTP_404_NOT_FOUND)
 def not_found(error):
     """ Handles resources not found with 404_NOT_FOUND """
@@ -85,6 +125,15 @@ def method_not_supported(error):
 #                   error='Unsupported media type',
 #                   message=message), status.HTTP_415_UNSUPPORTED_MEDIA_TYPE
 
+@app.errorhandler(status.HTTP_409_CONFLICT)
+def conflict(error):
+    """ Handles requests that conflict with one in progress with 409_CONFLICT """
+    message = error.message or str(error)
+    app.logger.warning(message)
+    return jsonify(status=status.HTTP_409_CONFLICT,
+                   error='Conflict',
+                   message=message), status.HTTP_409_CONFLICT
+
 @app.errorhandler(status.HTTP_500_INTERNAL_SERVER_ERROR)
 def internal_server_error(error):
     """ Handles unexpected server error with 500_SERVER_ERROR """
@@ -94,6 +143,100 @@ def internal_server_error(error):
                    error='Internal Server Error',
                    message=message), status.HTTP_500_INTERNAL_SERVER_ERROR
 
+@app.errorhandler(status.HTTP_501_NOT_IMPLEMENTED)
+def not_implemented(error):
+    """ Handles features this worker cannot provide with 501_NOT_IMPLEMENTED """
+    message = error.message or str(error)
+    app.logger.warning(message)
+    return jsonify(status=status.HTTP_501_NOT_IMPLEMENTED,
+                   error='Not Implemented',
+                   message=message), status.HTTP_501_NOT_IMPLEMENTED
+
+@app.errorhandler(admission.Overloaded)
+def service_unavailable(error):
+    """ Handles shed requests with 503_SERVICE_UNAVAILABLE """
+    message = str(error)
+    app.logger.warning(message)
+    response = jsonify(status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                       error='Service Unavailable',
+                       message=message)
+    response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+
+######################################################################
+# REQUEST TRACING
+######################################################################
+@app.before_request
+def start_trace():
+    """ Opens the span of the request, continuing the client's trace if it sent one """
+    route = request.url_rule.rule if request.url_rule else request.path
+    g.span = tracing.start('{} {}'.format(request.method, route),
+                           traceparent=request.headers.get('traceparent'),
+                           method=request.method, route=route,
+                           target=request.full_path.rstrip('?'))
+
+@app.teardown_request
+def finish_trace(exception):
+    """ Closes the span of the request once the response has been sent """
+    span = g.pop('span', None)
+    if span is not None:
+        span.set(status=g.get('status_code'))
+        tracing.finish(span, exception)
+
+
+######################################################################
+# ADMISSION CONTROL
+######################################################################
+# route classes of the endpoints that are not classed by their method;
+# None leaves an endpoint unlimited
+ROUTE_CLASSES = {
+    'import_inventory': 'bulk',
+    'export_inventory': 'bulk',
+    'void_matching_inventory': 'bulk',
+    'update_matching_inventory': 'bulk',
+    'inventory_reset': 'reset',
+    'stream_changes': None,     # long lived, and served from one shared feed
+    'inventory_metrics': None,  # must answer while overloaded
+    'profile_worker': None,     # ... and so must the profiler
+    'memory_snapshot': None,
+    'stop_memory_snapshot': None,
+    'index': None,
+    'static': None,
+}
+
+def route_class():
+    """ Returns the route class of the current request """
+    if request.endpoint is None:
+        return None
+    if request.endpoint in ROUTE_CLASSES:
+        return ROUTE_CLASSES[request.endpoint]
+    return 'read' if request.method in ('GET', 'HEAD') else 'write'
+
+@app.before_request
+def admit_request():
+    """ Sheds the request if its route class is at its limit """
+    g.ticket = admission.admit(route_class())
+
+@app.teardown_request
+def release_request(exception):
+    """ Releases the request's slot once the response has been sent """
+    ticket = g.pop('ticket', None)
+    if ticket is not None:
+        ticket.release(failed=exception is not None or
+                       g.get('status_code', 200) >= 500)
+
+
+######################################################################
+# RESPONSE COMPRESSION
+######################################################################
+@app.after_request
+def compress(response):
+    """ Compresses large responses for clients that accept it """
+    g.status_code = response.status_code
+    return compress_response(response, request.accept_encodings)
+
 
 ######################################################################
 # GET INDEX
@@ -126,30 +269,284 @@ def void_inventory(inventory_id):
     inventory.save()
     return make_response(jsonify(inventory.serialize()), status.HTTP_200_OK)
 
+######################################################################
+# UPDATE INVENTORY IN BULK
+######################################################################
+@app.route('/inventory/void', methods=['PUT'])
+def void_matching_inventory():
+    """
+    Voids every Inventory matching the query string filters
+
+    The documents are written back in _bulk_docs chunks and a summary of
+    the matched, updated, unchanged, skipped and failed documents is returned
+    """
+    selector = required_selector()
+    app.logger.info('Request to void inventory matching %s', selector)
+    summary = bulk.update_matching(selector, {'available': False})
+    app.logger.info('Voided %d inventory, %d failed', summary.updated, summary.failed)
+    return make_response(jsonify(summary.serialize()), status.HTTP_200_OK)
+
+@app.route('/inventory', methods=['PATCH'])
+def update_matching_inventory():
+    """
+    Updates every Inventory matching the query string filters
+
+    The body holds the fields to set, e.g. {"condition": "used"}
+    """
+    check_content_type('application/json')
+    selector = required_selector()
+    changes = request.get_json()
+    app.logger.info('Request to update inventory matching %s with %s', selector, changes)
+    summary = bulk.update_matching(selector, changes)
+    app.logger.info('Updated %d inventory, %d failed', summary.updated, summary.failed)
+    return make_response(jsonify(summary.serialize()), status.HTTP_200_OK)
+
 ######################################################################
 # LIST ALL INVENTORY
 ######################################################################
 @app.route('/inventory', methods=['GET'])
 def list_inventory():
-    """ Returns all of the Inventory """
+    """
+    Returns all of the Inventory
+
+    With ?since=<checkpoint> only the Inventory modified after the checkpoint
+    is returned, together with the ids deleted since, the ids that no longer
+    match the filters and a new checkpoint
+    """
     app.logger.info('Request for inventory list')
+    since = request.args.get('since')
+    if since is not None:
+        return list_inventory_changes(since)
     inventory = []
+    ids = request.args.get('ids')
     category = request.args.get('category')
     name = request.args.get('name')
     condition = request.args.get('condition')
     count = request.args.get('count')
     available = request.args.get('available')
-    if category:
-        inventory = Inventory.find_by_category(category)
-    elif name:
+    if ids:
+        inventory = Inventory.find_many(ids.split(','))
+    elif name and not category:     # a category takes precedence over a name
         inventory = Inventory.find_by_name(name)
     else:
-        inventory = Inventory.all()
+        # large listings are built column-wise and written straight to JSON
+        if category:
+            inventory = Inventory.collection(category=category)
+        else:
+            inventory = Inventory.collection()
+        return Response(inventory.to_json(), status.HTTP_200_OK,
+                        mimetype='application/json')
+    return inventory_list_response(inventory)
+
+
+def list_inventory_changes(since):
+    """
+    Returns the Inventory modified and deleted after a checkpoint
+
+    With filters, the Inventory that changed but no longer matches them is
+    listed in removed: it may have matched before, so a client drops it.
+    """
+    app.logger.info('Request for inventory changes since %s', since)
+    limit = limit_arg()
+    selector = selector_args()
+    changes, checkpoint, complete = Inventory.changes(since=since, limit=limit)
+    modified = {}
+    deleted = []
+    removed = []
+    for _, inventory_id, inventory in changes:
+        modified.pop(inventory_id, None)
+        if inventory_id in removed:
+            removed.remove(inventory_id)
+        if inventory is None:
+            deleted.append(inventory_id)
+        elif inventory.matches(selector):
+            modified[inventory_id] = inventory.serialize()
+        else:
+            removed.append(inventory_id)
+    return make_response(jsonify(inventory=list(modified.values()),
+                                 deleted=deleted,
+                                 removed=removed,
+                                 checkpoint=checkpoint,
+                                 complete=complete), status.HTTP_200_OK)
+
+
+######################################################################
+# LIST LOW STOCK INVENTORY
+######################################################################
+@app.route('/inventory/low-stock', methods=['GET'])
+def list_low_stock():
+    """
+    Returns Inventory with a count below a threshold
+
+    Results are sorted by count ascending and may be narrowed to a category
+    """
+    app.logger.info('Request for low stock inventory')
+    threshold = int_arg('threshold')
+    if threshold is None:
+        raise DataValidationError('threshold query parameter is required')
+    limit = limit_arg()
+    category = request.args.get('category')
+    inventory = Inventory.find_low_stock(threshold, category=category, limit=limit)
+    return inventory_list_response(inventory)
+
+
+######################################################################
+# EXPORT INVENTORY
+######################################################################
+@app.route('/inventory/export', methods=['GET'])
+def export_inventory():
+    """
+    Streams all of the Inventory as NDJSON or CSV
+
+    The database is read a page at a time and each page is written to the
+    response as soon as it arrives. The list endpoint's filters apply, and
+    ?fields=name,count selects the columns to write.
+    """
+    file_format = request.args.get('format', 'ndjson')
+    app.logger.info('Request to export inventory as %s', file_format)
+    fields = bulk.FIELDS
+    if request.args.get('fields'):
+        fields = [field.strip() for field in request.args['fields'].split(',')]
+    selector = selector_args()
+    inventories = (inventory for inventory in Inventory.iterate()
+                   if inventory.matches(selector))
+    chunks = bulk.export_rows(inventories, file_format, fields)
+    mimetype = bulk.WRITERS[file_format][1]
+    filename = 'inventory.{}'.format(file_format)
+    return Response(stream_with_context(chunks), status.HTTP_200_OK, mimetype=mimetype,
+                    headers={'Content-Disposition': 'attachment; filename=' + filename})
+
+
+######################################################################
+# INVENTORY ANALYTICS
+######################################################################
+@app.route('/inventory/analytics', methods=['GET'])
+def inventory_analytics():
+    """
+    Returns stock analytics over the Inventory matching the list filters
+
+    ?group_by=category|condition totals the count per group,
+    ?percentiles=50,90,99 returns count percentiles and ?top=N returns the
+    N items with the highest count (lowest with ?order=asc)
+    """
+    app.logger.info('Request for inventory analytics')
+    selector = selector_args()
+    group_by = request.args.get('group_by', 'category')
+    if group_by not in CODED_FIELDS:
+        raise DataValidationError('group_by must be one of {}'.format(', '.join(CODED_FIELDS)))
+    try:
+        percents = [float(percent) for percent in
+                    request.args.get('percentiles', '50,90,99').split(',') if percent]
+    except ValueError:
+        raise DataValidationError('percentiles must be numbers')
+    if any(percent < 0 or percent > 100 for percent in percents):
+        raise DataValidationError('percentiles must be between 0 and 100')
+    top = int_arg('top', 10)
+    ascending = request.args.get('order', 'desc') == 'asc'
 
-    results = [inventory.serialize() for inventory in inventory]
+    snapshot = current_snapshot()
+    items, total = snapshot.total(**selector)
+    results = {
+        'items': items,
+        'total': total,
+        'by_' + group_by: snapshot.sum_by(group_by, **selector),
+        'percentiles': dict(('{:g}'.format(percent), value) for percent, value in
+                            snapshot.percentiles(percents, **selector).items()),
+        'top': [{'id': inventory_id, 'name': name, 'count': count}
+                for inventory_id, name, count in snapshot.top(top, ascending, **selector)]
+    }
     return make_response(jsonify(results), status.HTTP_200_OK)
 
 
+######################################################################
+# READ PATH METRICS
+######################################################################
+@app.route('/inventory/metrics', methods=['GET'])
+def inventory_metrics():
+    """ Returns this worker's admission, read hedging and replica routing counters """
+    results = {
+        'admission': admission.controller.serialize(),
+        'hedging': Inventory.hedger.serialize() if Inventory.hedger else None,
+        'routing': Inventory.router.serialize() if Inventory.router else None,
+    }
+    return make_response(jsonify(results), status.HTTP_200_OK)
+
+
+######################################################################
+# SEARCH INVENTORY BY NAME
+######################################################################
+@app.route('/inventory/search', methods=['GET'])
+def search_inventory():
+    """
+    Returns Inventory whose name starts with a prefix
+
+    This endpoint backs the typeahead on the home page
+    """
+    query = request.args.get('q', '').strip()
+    app.logger.info('Request to search inventory for: %s', query)
+    if not query:
+        raise DataValidationError('q query parameter is required')
+    inventory = Inventory.search_by_name(query, limit=limit_arg())
+    return inventory_list_response(inventory)
+
+
+######################################################################
+# STREAM INVENTORY CHANGES
+######################################################################
+@app.route('/inventory/changes', methods=['GET'])
+def stream_changes():
+    """
+    Streams Inventory changes as Server-Sent Events
+
+    Each event carries the update sequence as its id, so a client resumes
+    with the Last-Event-ID header (or ?since=) after reconnecting. Changes
+    may be narrowed with the same filters as the list endpoint; deletions
+    are always sent. Delivery is at-least-once.
+    """
+    since = request.headers.get('Last-Event-ID') or request.args.get('since')
+    selector = selector_args()
+    app.logger.info('Request to stream inventory changes since %s', since)
+    # read the first page now, so a bad checkpoint is answered with 400
+    page = Inventory.changes(since=since, limit=QUERY_LIMIT) if since is not None else None
+
+    def generate():
+        """ Replays changes after since, then relays live ones """
+        subscription = None
+        try:
+            checkpoint, current = since, page
+            while True:
+                while current is not None:
+                    changes, checkpoint, complete = current
+                    for change in changes:
+                        event = change_event(selector, *change)
+                        if event:
+                            yield event
+                    current = None if complete else \
+                        Inventory.changes(since=checkpoint, limit=QUERY_LIMIT)
+                if subscription is not None:
+                    break
+                # a feed started now follows on from the replay; one already
+                # running may have passed it, so catch up once more
+                subscription = shared_feed(Inventory.database).subscribe(checkpoint)
+                if checkpoint is not None:
+                    current = Inventory.changes(since=checkpoint, limit=QUERY_LIMIT)
+            while not subscription.overflowed:
+                change = subscription.get(timeout=CHANGES_HEARTBEAT)
+                if change is None:
+                    yield ': keep-alive\n\n'
+                    continue
+                event = change_event(selector, *change)
+                if event:
+                    yield event
+        finally:
+            if subscription is not None:
+                subscription.close()
+
+    return Response(stream_with_context(generate()), status.HTTP_200_OK,
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 ######################################################################
 # RETRIEVE INVENTORY
 ######################################################################
@@ -171,6 +568,7 @@ def get_inventory(inventory_id):
 # ADD NEW INVENTORY
 ######################################################################
 @app.route('/inventory', methods=['POST'])
+@idempotent(body_digest)
 def create_inventory():
     """
     Creates Inventory
@@ -183,7 +581,7 @@ def create_inventory():
         data = {
             'name': request.form['name'],
             'category': request.form['category'],
-            'available': request.form['available']==True,
+            'available': request.form['available'],
             'condition': request.form['condition'],
             'count': request.form['count']
         }
@@ -193,11 +591,35 @@ def create_inventory():
     app.logger.info(data)
     inventory = Inventory()
     inventory.deserialize(data)
-    inventory.save()
+    headers = {}
+    if inventory.create(request_seed()) is False:
+        # a retry of a request that another worker completed
+        headers['Idempotent-Replayed'] = 'true'
     message = inventory.serialize()
-    location_url = url_for('get_inventory', inventory_id=inventory.id, _external=True)
-    return make_response(jsonify(message), status.HTTP_201_CREATED,
-                         {'Location': location_url})
+    headers['Location'] = url_for('get_inventory', inventory_id=inventory.id, _external=True)
+    return make_response(jsonify(message), status.HTTP_201_CREATED, headers)
+
+
+######################################################################
+# IMPORT INVENTORY
+######################################################################
+@app.route('/inventory/import', methods=['POST'])
+@idempotent(stream_digest)
+def import_inventory():
+    """
+    Imports Inventory
+
+    This endpoint streams a text/csv or application/x-ndjson body into the
+    database in bulk and returns the number of rows imported and rejected
+    """
+    app.logger.info('Request to import inventory from %s', request.mimetype)
+    file_format = bulk.MIMETYPES.get(request.mimetype)
+    if file_format is None:
+        abort(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+              'Content-Type must be one of {}'.format(', '.join(sorted(bulk.MIMETYPES))))
+    summary = bulk.import_file(request.stream, file_format, seed=request_seed())
+    app.logger.info('Imported %d inventory, rejected %d', summary.imported, summary.failed)
+    return make_response(jsonify(summary.serialize()), status.HTTP_200_OK)
 
 
 ######################################################################
@@ -238,13 +660,141 @@ def delete_inventory(inventory_id):
         inventory.delete()
     return make_response('', status.HTTP_204_NO_CONTENT)
 
+######################################################################
+# RESERVE INVENTORY
+######################################################################
+@app.route('/inventory/<string:inventory_id>/reservations', methods=['GET'])
+def get_availability(inventory_id):
+    """ Returns the count of an Inventory, the quantity held and what is available """
+    inventory = Inventory.find(inventory_id)
+    if not inventory:
+        raise NotFound("Inventory with id '{}' was not found.".format(inventory_id))
+    held = Reservation.held(inventory_id)
+    return make_response(jsonify(inventory_id=inventory_id, count=inventory.count,
+                                 held=held, available=inventory.count - held),
+                         status.HTTP_200_OK)
+
+@app.route('/inventory/<string:inventory_id>/reservations', methods=['POST'])
+@idempotent(body_digest)
+def create_reservation(inventory_id):
+    """
+    Holds stock of an Inventory
+
+    The body gives the quantity to hold and, optionally, the seconds to
+    hold it for, e.g. {"quantity": 2, "ttl": 300}. Answers 409 Conflict if
+    not enough is available.
+    """
+    check_content_type('application/json')
+    inventory = Inventory.find(inventory_id)
+    if not inventory:
+        raise NotFound("Inventory with id '{}' was not found.".format(inventory_id))
+    data = request.get_json()
+    if not isinstance(data, dict) or 'quantity' not in data:
+        raise DataValidationError('quantity is required')
+    try:
+        ttl = float(data['ttl']) if data.get('ttl') is not None else None
+    except (TypeError, ValueError):
+        raise DataValidationError('ttl must be a number of seconds')
+    try:
+        reservation = Reservation.hold(inventory, data['quantity'], ttl, request_seed())
+    except ReservationConflict as err:
+        raise Conflict(str(err))
+    app.logger.info('Held %d of inventory %s as %s', reservation.quantity, inventory_id,
+                    reservation.id)
+    location_url = url_for('release_reservation', inventory_id=inventory_id,
+                           reservation_id=reservation.id, _external=True)
+    return make_response(jsonify(reservation.serialize()), status.HTTP_201_CREATED,
+                         {'Location': location_url})
+
+@app.route('/inventory/<string:inventory_id>/reservations/<string:reservation_id>/commit',
+           methods=['POST'])
+def commit_reservation(inventory_id, reservation_id):
+    """ Takes the stock of a hold; the sweeper subtracts it from the count """
+    reservation = Reservation.find(inventory_id, reservation_id)
+    if not reservation:
+        raise NotFound("Reservation with id '{}' was not found.".format(reservation_id))
+    try:
+        reservation.commit()
+    except ReservationConflict as err:
+        raise Conflict(str(err))
+    return make_response(jsonify(reservation.serialize()), status.HTTP_200_OK)
+
+@app.route('/inventory/<string:inventory_id>/reservations/<string:reservation_id>',
+           methods=['DELETE'])
+def release_reservation(inventory_id, reservation_id):
+    """ Releases a hold """
+    reservation = Reservation.find(inventory_id, reservation_id)
+    if reservation:
+        try:
+            reservation.release()
+        except ReservationConflict as err:
+            raise Conflict(str(err))
+    return make_response('', status.HTTP_204_NO_CONTENT)
+
+######################################################################
+# PROFILE THE WORKER (PROFILING only)
+######################################################################
+@app.route('/debug/profile', methods=['POST'])
+def profile_worker():
+    """
+    Profiles this worker
+
+    Samples the stacks of every thread for the given seconds and returns
+    them as collapsed stacks (text/plain) or as a speedscope file
+    """
+    check_profiling()
+    seconds = int_arg('seconds', 10)
+    if not 0 < seconds <= profiling.PROFILE_MAX_SECONDS:
+        raise DataValidationError('seconds must be between 1 and {:g}'.format(
+            profiling.PROFILE_MAX_SECONDS))
+    file_format = request.args.get('format', 'collapsed')
+    if file_format not in profiling.FORMATS:
+        raise DataValidationError('format must be one of ' + ', '.join(profiling.FORMATS))
+    app.logger.warning('Profiling worker %d for %d seconds', os.getpid(), seconds)
+    try:
+        sampler = profiling.profile(seconds)
+    except profiling.ProfilerBusy as err:
+        raise Conflict(str(err))
+    if file_format == 'speedscope':
+        response = make_response(jsonify(sampler.speedscope('worker {}'.format(os.getpid()))),
+                                 status.HTTP_200_OK)
+        response.headers['Content-Disposition'] = \
+            'attachment; filename=profile-{}.speedscope.json'.format(os.getpid())
+        return response
+    return Response(sampler.collapsed(), status.HTTP_200_OK, mimetype='text/plain')
+
+@app.route('/debug/memory', methods=['GET'])
+def memory_snapshot():
+    """
+    Returns the lines that allocated the most memory in this worker
+
+    The first request starts tracing allocations; later ones also report
+    what grew since the previous request, and the number of documents in
+    the cloudant client's own document cache
+    """
+    check_profiling()
+    try:
+        result = profiling.memory(int_arg('limit', 25))
+    except RuntimeError as err:
+        abort(status.HTTP_501_NOT_IMPLEMENTED, str(err))
+    result['cached_documents'] = len(Inventory.database) if Inventory.database else 0
+    return make_response(jsonify(result), status.HTTP_200_OK)
+
+@app.route('/debug/memory', methods=['DELETE'])
+def stop_memory_snapshot():
+    """ Stops tracing allocations in this worker """
+    check_profiling()
+    profiling.stop_memory()
+    return make_response('', status.HTTP_204_NO_CONTENT)
+
 ######################################################################
 # DELETE ALL PET DATA (for testing only)
 ######################################################################
 @app.route('/inventory/reset', methods=['DELETE'])
 def inventory_reset():
-    """ Removes all inventory from the database """
+    """ Removes all inventory and reservations from the database """
     Inventory.remove_all()
+    Reservation.remove_all()
     return make_response('', status.HTTP_204_NO_CONTENT)
 
 ######################################################################
@@ -262,3 +812,63 @@ def check_content_type(content_type):
         return
     app.logger.error('Invalid Content-Type: %s', request.headers['Content-Type'])
     abort(415, 'Content-Type must be {}'.format(content_type))
+
+def check_profiling():
+    """ Hides the /debug endpoints unless enabled, and checks the bearer token """
+    if not profiling.PROFILING or not profiling.PROFILING_TOKEN:
+        raise NotFound('The requested URL was not found on the server.')
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() != 'bearer' or not hmac.compare_digest(
+            token.strip().encode('utf-8'), profiling.PROFILING_TOKEN.encode('utf-8')):
+        abort(status.HTTP_401_UNAUTHORIZED, 'A valid bearer token is required')
+
+def int_arg(name, default=None):
+    """ Returns a query string argument as an int """
+    value = request.args.get(name)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise DataValidationError('{} must be an integer'.format(name))
+
+def limit_arg(default=QUERY_LIMIT):
+    """ Returns the limit query string argument, which must be positive """
+    limit = int_arg('limit', default)
+    if limit <= 0:
+        raise DataValidationError('limit must be a positive integer')
+    return limit
+
+def inventory_list_response(inventories):
+    """ Returns a JSON array of Inventory built from cached fragments """
+    return Response(encoding.encode_list(inventories), status.HTTP_200_OK,
+                    mimetype='application/json')
+
+def selector_args():
+    """ Returns the Inventory field filters given in the query string """
+    selector = {}
+    for field in ('name', 'category', 'condition'):
+        if request.args.get(field):
+            selector[field] = request.args[field]
+    available = request.args.get('available')
+    if available:
+        selector['available'] = available.lower() == 'true'
+    return selector
+
+def required_selector():
+    """ Returns the query string filters of a bulk update, which needs at least one """
+    selector = selector_args()
+    if not selector:
+        raise DataValidationError('At least one of name, category, condition or '
+                                  'available must be given')
+    return selector
+
+def change_event(selector, seq, inventory_id, inventory):
+    """ Formats a change as a Server-Sent Event unless selector excludes it """
+    if inventory is None:
+        event, data = 'delete', {'id': inventory_id}
+    elif inventory.matches(selector):
+        event, data = 'update', inventory.serialize()
+    else:
+        return None
+    return 'id: {}\nevent: {}\ndata: {}\n\n'.format(seq, event, json.dumps(data))
@@ -0,0 +1,292 @@
+"""
+Document cache shared by the worker processes of one host
+
+Every gunicorn worker used to warm a document cache of its own. The
+SharedCache keeps documents in a SQLite file (in WAL mode, so readers
+never wait for the writer) that all the workers open, and a single
+CacheFollower process writes every change from the database _changes
+feed into it. The follower is started by the gunicorn master (see
+gunicorn.conf.py) or runs as a sidecar (python manage.py follow-cache).
+
+Entries carry the generation of their revision and are only ever
+replaced by a newer one, so a worker that read a document just before it
+changed cannot overwrite the follower's copy with its stale one. Deletions
+are kept as tombstones for the same reason. Workers only trust the cache
+while the follower's heartbeat is recent; otherwise they read the
+database as if there were no cache.
+
+Set SHARED_CACHE_PATH to the file to use; the cache is off without it.
+"""
+import os
+import json
+import time
+import logging
+import sqlite3
+import threading
+from requests import HTTPError, ConnectionError
+
+# the SQLite file shared by the workers; no shared cache if empty
+SHARED_CACHE_PATH = os.environ.get('SHARED_CACHE_PATH', '')
+# documents kept before the oldest are evicted
+SHARED_CACHE_SIZE = int(os.environ.get('SHARED_CACHE_SIZE', 100000))
+# seconds without a follower heartbeat after which the cache is not used
+SHARED_CACHE_MAX_LAG = float(os.environ.get('SHARED_CACHE_MAX_LAG', 30))
+# seconds between follower heartbeats (and CouchDB heartbeats)
+SHARED_CACHE_HEARTBEAT = float(os.environ.get('SHARED_CACHE_HEARTBEAT', 10))
+# seconds a tombstone is kept to fence off stale writes
+SHARED_CACHE_TOMBSTONE_AGE = float(os.environ.get('SHARED_CACHE_TOMBSTONE_AGE', 600))
+# seconds a connection waits for the SQLite write lock
+SHARED_CACHE_TIMEOUT = float(os.environ.get('SHARED_CACHE_TIMEOUT', 5))
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS documents ('
+    ' namespace TEXT NOT NULL, id TEXT NOT NULL, generation INTEGER NOT NULL,'
+    ' body TEXT, written REAL NOT NULL, PRIMARY KEY (namespace, id))',
+    'CREATE INDEX IF NOT EXISTS documents_written ON documents (namespace, written)',
+    'CREATE TABLE IF NOT EXISTS followers ('
+    ' namespace TEXT PRIMARY KEY, seq TEXT, heartbeat REAL NOT NULL)',
+)
+
+logger = logging.getLogger(__name__)
+
+
+def generation(rev):
+    """ Returns the generation number of a revision, e.g. 3 for '3-a1b2' """
+    return int(rev.split('-', 1)[0]) if rev else 0
+
+
+class SharedCache(object):
+    """
+    The documents of one database in a SQLite file shared across processes
+
+    Connections are opened per thread and per process, so a cache that was
+    created before gunicorn forked its workers is safe to use in them.
+    """
+
+    def __init__(self, path, namespace):
+        self.path = path
+        self.namespace = namespace      # the database URL
+        self.local = threading.local()
+        self.checked = 0                # when fresh() last read the heartbeat
+        self.is_fresh = False
+
+    def _connection(self):
+        """ Returns this thread's connection, creating the schema if needed """
+        connection = getattr(self.local, 'connection', None)
+        if connection is None or self.local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=SHARED_CACHE_TIMEOUT,
+                                         isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            for statement in SCHEMA:
+                connection.execute(statement)
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return connection
+
+    ##################################################################
+    # Workers
+    ##################################################################
+
+    def fresh(self):
+        """ Returns True while the follower is keeping the cache current """
+        now = time.time()
+        if now - self.checked >= 1:
+            row = self._connection().execute(
+                'SELECT heartbeat FROM followers WHERE namespace = ?',
+                (self.namespace,)).fetchone()
+            self.is_fresh = row is not None and now - row[0] < SHARED_CACHE_MAX_LAG
+            self.checked = now
+        return self.is_fresh
+
+    def get(self, doc_id):
+        """
+        Looks up a document
+
+        Returns (True, document) on a hit, (True, None) for a document that
+        is known to be deleted and (False, None) on a miss.
+        """
+        row = self._connection().execute(
+            'SELECT body FROM documents WHERE namespace = ? AND id = ?',
+            (self.namespace, doc_id)).fetchone()
+        if row is None:
+            return False, None
+        return True, json.loads(row[0]) if row[0] is not None else None
+
+    def get_many(self, doc_ids):
+        """ Returns {id: document or None} for the ids that are cached """
+        found = {}
+        doc_ids = list(doc_ids)
+        for start in range(0, len(doc_ids), 500):   # SQLite caps bound parameters
+            batch = doc_ids[start:start + 500]
+            rows = self._connection().execute(
+                'SELECT id, body FROM documents WHERE namespace = ? AND id IN ({})'
+                .format(','.join('?' * len(batch))), [self.namespace] + batch)
+            for doc_id, body in rows:
+                found[doc_id] = json.loads(body) if body is not None else None
+        return found
+
+    def put(self, document, authoritative=False):
+        """
+        Stores a document unless a newer revision of it is cached
+
+        Workers store what they read or wrote; the follower stores with
+        authoritative=True, which also replaces an entry of the same
+        generation, e.g. the tombstone a worker stored when it deleted.
+        """
+        self._store(document['_id'], generation(document.get('_rev')),
+                    json.dumps(document, separators=(',', ':')), authoritative)
+
+    def discard(self, doc_id, rev, authoritative=False):
+        """ Stores a tombstone for a document deleted at revision rev """
+        self._store(doc_id, generation(rev), None, authoritative)
+
+    def _store(self, doc_id, gen, body, authoritative):
+        """ Inserts an entry, or replaces an older one """
+        connection = self._connection()
+        now = time.time()
+        cursor = connection.execute(
+            'INSERT OR IGNORE INTO documents (namespace, id, generation, body, written) '
+            'VALUES (?, ?, ?, ?, ?)', (self.namespace, doc_id, gen, body, now))
+        if cursor.rowcount == 0:
+            connection.execute(
+                'UPDATE documents SET generation = ?, body = ?, written = ? '
+                'WHERE namespace = ? AND id = ? AND generation {} ?'
+                .format('<=' if authoritative else '<'),
+                (gen, body, now, self.namespace, doc_id, gen))
+
+    def clear(self):
+        """ Removes every document of the database, e.g. after it was dropped """
+        self._connection().execute('DELETE FROM documents WHERE namespace = ?',
+                                   (self.namespace,))
+
+    ##################################################################
+    # Follower
+    ##################################################################
+
+    def seq(self):
+        """ Returns the update sequence the follower has applied, or None """
+        row = self._connection().execute(
+            'SELECT seq FROM followers WHERE namespace = ?', (self.namespace,)).fetchone()
+        return row[0] if row is not None else None
+
+    def checkpoint(self, seq=None):
+        """ Records a heartbeat and, if given, the update sequence applied """
+        connection = self._connection()
+        if seq is None:
+            cursor = connection.execute(
+                'UPDATE followers SET heartbeat = ? WHERE namespace = ?',
+                (time.time(), self.namespace))
+            if cursor.rowcount:
+                return
+        connection.execute(
+            'INSERT OR REPLACE INTO followers (namespace, seq, heartbeat) VALUES (?, ?, ?)',
+            (self.namespace, None if seq is None else json.dumps(seq), time.time()))
+
+    def stop(self):
+        """ Marks the cache stale, so workers stop using it at once """
+        self._connection().execute('DELETE FROM followers WHERE namespace = ?',
+                                   (self.namespace,))
+
+    def trim(self, size=None):
+        """ Evicts the oldest documents above size and expired tombstones """
+        size = SHARED_CACHE_SIZE if size is None else size
+        connection = self._connection()
+        connection.execute(
+            'DELETE FROM documents WHERE namespace = ? AND body IS NULL AND written < ?',
+            (self.namespace, time.time() - SHARED_CACHE_TOMBSTONE_AGE))
+        connection.execute(
+            'DELETE FROM documents WHERE namespace = ? AND id IN ('
+            ' SELECT id FROM documents WHERE namespace = ?'
+            ' ORDER BY written DESC LIMIT -1 OFFSET ?)',
+            (self.namespace, self.namespace, size))
+
+
+def open_cache(database):
+    """ Returns the shared cache of a cloudant database, or None if it is off """
+    if not SHARED_CACHE_PATH:
+        return None
+    return SharedCache(SHARED_CACHE_PATH, database.database_url)
+
+
+######################################################################
+#  F O L L O W E R
+######################################################################
+
+class CacheFollower(object):
+    """ Writes every change of a database into its SharedCache """
+
+    def __init__(self, cache, database):
+        self.cache = cache
+        self.database = database
+        self.since = None
+        self.running = False
+        self.upstream = None
+
+    def apply(self, change):
+        """ Writes one _changes row into the cache """
+        if change['id'].startswith('_design/'):
+            return
+        if change.get('deleted'):
+            self.cache.discard(change['id'], change['changes'][0]['rev'],
+                               authoritative=True)
+        else:
+            self.cache.put(change['doc'], authoritative=True)
+
+    def start(self):
+        """ Resumes from the recorded sequence, or empties the cache if there is none """
+        since = self.cache.seq()
+        if since is None:
+            # nobody has followed this database: the cache may hold anything
+            self.cache.clear()
+            self.since = 'now'
+        else:
+            self.since = json.loads(since)
+
+    def catch_up(self, limit=1000):
+        """ Applies the changes made since the checkpoint; returns how many """
+        if self.since is None:
+            self.start()
+        applied = 0
+        while True:
+            feed = self.database.changes(since=self.since, include_docs=True, limit=limit)
+            rows = 0
+            for change in feed:
+                self.apply(change)
+                rows += 1
+            self.since = feed.last_seq
+            self.cache.checkpoint(self.since)
+            applied += rows
+            if rows < limit:
+                return applied
+
+    def run(self):
+        """ Follows the continuous _changes feed until stop() is called """
+        self.running = True
+        trimmed = time.time()
+        while self.running:
+            try:
+                self.catch_up()
+                self.upstream = self.database.infinite_changes(
+                    since=self.since, include_docs=True,
+                    heartbeat=int(SHARED_CACHE_HEARTBEAT * 1000))
+                for change in self.upstream:
+                    if not self.running:
+                        break
+                    if change is not None and 'id' in change:
+                        self.apply(change)
+                        self.since = change['seq']
+                    self.cache.checkpoint(self.since)
+                    if time.time() - trimmed >= SHARED_CACHE_HEARTBEAT:
+                        self.cache.trim()
+                        trimmed = time.time()
+            except (HTTPError, ConnectionError) as err:
+                logger.warning('Shared cache follower interrupted: %s', err)
+                time.sleep(SHARED_CACHE_HEARTBEAT)
+
+    def stop(self):
+        """ Stops run() and marks the cache stale """
+        self.running = False
+        if self.upstream is not None:
+            self.upstream.stop()
+        self.cache.stop()
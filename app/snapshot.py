@@ -0,0 +1,244 @@
+"""
+Binary snapshots of the Inventory database
+
+A snapshot file starts with an 8 byte magic string and a flags byte, then
+holds a sequence of length-prefixed records:
+
+    <uint32 length><payload>
+
+Every payload starts with a one byte record type:
+
+    'D' <uint8 field><string>   - the next dictionary code of a field
+    'R' <string id><string name><uint16 category><uint16 condition>
+        <uint8 available><count> - one Inventory
+
+Strings are a uint16 byte length (0xFFFF for None) and UTF-8 bytes; from
+0xFFFE bytes on the length is 0xFFFE followed by a uint32 length.
+Category and condition are written as codes into per field dictionaries
+that are defined in the stream just before their first use (0xFFFF for
+None). Available is 0, 1 or 2 for None; values that are not booleans are
+coerced, and written as None if they spell neither. Count is a uint8 kind
+followed by an int64 for integers or a string for anything else. With
+FLAG_ZLIB set everything after the header is one zlib stream.
+
+Restores memory-map the file and bulk load it through _bulk_docs.
+"""
+import os
+import mmap
+import logging
+import numbers
+import zlib
+import struct
+from . import bulk
+from .models import Inventory
+
+MAGIC = b'INVSNAP1'
+FLAG_ZLIB = 0x01
+NONE = 0xFFFF
+LONG = 0xFFFE   # a uint32 length follows
+
+CATEGORY, CONDITION = 0, 1
+AVAILABLE = {False: 0, True: 1, None: 2}
+COUNT_INT, COUNT_NONE, COUNT_STR = 0, 1, 2
+
+LENGTH = struct.Struct('<I')
+SHORT = struct.Struct('<H')
+CODES = struct.Struct('<HHB')
+INT64 = struct.Struct('<q')
+
+# bytes decompressed at a time when restoring a compressed snapshot
+READ_SIZE = 1 << 20
+
+logger = logging.getLogger(__name__)
+
+
+######################################################################
+#  E N C O D I N G
+######################################################################
+
+def _pack_str(value):
+    """ Encodes a string or None """
+    if value is None:
+        return SHORT.pack(NONE)
+    if not isinstance(value, bytes):
+        value = value.encode('utf-8')
+    if len(value) >= LONG:
+        return SHORT.pack(LONG) + LENGTH.pack(len(value)) + value
+    return SHORT.pack(len(value)) + value
+
+def _unpack_str(buf, offset):
+    """ Decodes a string at offset; returns it and the next offset """
+    length, = SHORT.unpack_from(buf, offset)
+    offset += SHORT.size
+    if length == NONE:
+        return None, offset
+    if length == LONG:
+        length, = LENGTH.unpack_from(buf, offset)
+        offset += LENGTH.size
+    return bytes(buf[offset:offset + length]).decode('utf-8'), offset + length
+
+def _pack_count(count):
+    """ Encodes a count, which is normally but not always an integer """
+    if count is None:
+        return bytes(bytearray([COUNT_NONE]))
+    if isinstance(count, numbers.Integral) and not isinstance(count, bool):
+        return bytes(bytearray([COUNT_INT])) + INT64.pack(count)
+    return bytes(bytearray([COUNT_STR])) + _pack_str(u'{}'.format(count))
+
+def _unpack_count(buf, offset):
+    """ Decodes a count at offset; returns it and the next offset """
+    kind = bytearray(buf[offset:offset + 1])[0]
+    offset += 1
+    if kind == COUNT_INT:
+        return INT64.unpack_from(buf, offset)[0], offset + INT64.size
+    if kind == COUNT_STR:
+        return _unpack_str(buf, offset)
+    return None, offset
+
+
+class Encoder(object):
+    """ Turns Inventory into snapshot records """
+
+    def __init__(self):
+        self.codes = {CATEGORY: {}, CONDITION: {}}
+
+    def _code(self, field, value, records):
+        """ Returns the code for value, defining it first if it is new """
+        if value is None:
+            return NONE
+        codes = self.codes[field]
+        if value not in codes:
+            codes[value] = len(codes)
+            records.append(b'D' + bytes(bytearray([field])) + _pack_str(value))
+        return codes[value]
+
+    @staticmethod
+    def _available(inventory):
+        """ Returns the code of an Inventory's availability """
+        value = inventory.available
+        if value is None or value is True or value is False:
+            return AVAILABLE[value]
+        try:
+            return AVAILABLE[Inventory.schema.check_available(value)]
+        except (TypeError, ValueError):
+            logger.warning('Inventory %s has available %r; writing it as null',
+                           inventory.id, value)
+            return AVAILABLE[None]
+
+    def encode(self, inventory):
+        """ Returns the length-prefixed records for one Inventory """
+        records = []
+        category = self._code(CATEGORY, inventory.category, records)
+        condition = self._code(CONDITION, inventory.condition, records)
+        records.append(b'R' + _pack_str(inventory.id) + _pack_str(inventory.name) +
+                       CODES.pack(category, condition, self._available(inventory)) +
+                       _pack_count(inventory.count))
+        return b''.join(LENGTH.pack(len(record)) + record for record in records)
+
+
+class Decoder(object):
+    """ Turns snapshot records back into Inventory documents """
+
+    def __init__(self):
+        self.values = {CATEGORY: [], CONDITION: []}
+
+    def decode(self, buf, offset, end):
+        """ Decodes the record in buf[offset:end]; returns a document or None """
+        kind = bytes(buf[offset:offset + 1])
+        offset += 1
+        if kind == b'D':
+            field = bytearray(buf[offset:offset + 1])[0]
+            value, _ = _unpack_str(buf, offset + 1)
+            self.values[field].append(value)
+            return None
+        if kind != b'R':
+            raise ValueError('Unknown snapshot record type {!r}'.format(kind))
+        inventory_id, offset = _unpack_str(buf, offset)
+        name, offset = _unpack_str(buf, offset)
+        category, condition, available = CODES.unpack_from(buf, offset)
+        count, _ = _unpack_count(buf, offset + CODES.size)
+        return {'_id': inventory_id,
+                'name': name,
+                'category': None if category == NONE else self.values[CATEGORY][category],
+                'condition': None if condition == NONE else self.values[CONDITION][condition],
+                'available': {0: False, 1: True, 2: None}[available],
+                'count': count}
+
+
+######################################################################
+#  S N A P S H O T   A N D   R E S T O R E
+######################################################################
+
+def snapshot(path, inventories, compress=False):
+    """ Writes inventories to a snapshot file; returns how many were written """
+    encoder = Encoder()
+    compressor = zlib.compressobj() if compress else None
+    written = 0
+    with open(path, 'wb') as snapshot_file:
+        snapshot_file.write(MAGIC + bytes(bytearray([FLAG_ZLIB if compress else 0])))
+        for inventory in inventories:
+            data = encoder.encode(inventory)
+            if compressor:
+                data = compressor.compress(data)
+            snapshot_file.write(data)
+            written += 1
+        if compressor:
+            snapshot_file.write(compressor.flush())
+    return written
+
+def read_documents(path):
+    """ Yields the Inventory documents of a snapshot file """
+    with open(path, 'rb') as snapshot_file:
+        size = os.fstat(snapshot_file.fileno()).st_size
+        if size < len(MAGIC) + 1:
+            raise ValueError('{} is not an inventory snapshot'.format(path))
+        mapped = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if mapped[:len(MAGIC)] != MAGIC:
+            raise ValueError('{} is not an inventory snapshot'.format(path))
+        flags = bytearray(mapped[len(MAGIC):len(MAGIC) + 1])[0]
+        if flags & FLAG_ZLIB:
+            records = _read_compressed(mapped, len(MAGIC) + 1)
+        else:
+            records = _read_records(mapped, len(MAGIC) + 1, size)
+        decoder = Decoder()
+        for buf, start, end in records:
+            document = decoder.decode(buf, start, end)
+            if document is not None:
+                yield document
+    finally:
+        mapped.close()
+
+def _read_records(buf, offset, end):
+    """ Yields (buf, start, end) for each record of an uncompressed buffer """
+    while offset < end:
+        length, = LENGTH.unpack_from(buf, offset)
+        offset += LENGTH.size
+        yield buf, offset, offset + length
+        offset += length
+
+def _read_compressed(mapped, offset):
+    """ Yields (buf, start, end) for each record of a compressed snapshot """
+    decompressor = zlib.decompressobj()
+    pending = b''
+    position = offset
+    while position < len(mapped):
+        pending += decompressor.decompress(mapped[position:position + READ_SIZE])
+        position += READ_SIZE
+        if position >= len(mapped):
+            pending += decompressor.flush()
+        start = 0
+        while start + LENGTH.size <= len(pending):
+            length, = LENGTH.unpack_from(pending, start)
+            if start + LENGTH.size + length > len(pending):
+                break
+            yield pending, start + LENGTH.size, start + LENGTH.size + length
+            start += LENGTH.size + length
+        pending = pending[start:]
+    if pending:
+        raise ValueError('Snapshot ends with an incomplete record')
+
+def restore(path, progress=None):
+    """ Bulk loads a snapshot file; returns the bulk ImportSummary """
+    return bulk.import_rows(read_documents(path), lambda document: document,
+                            progress=progress, validate=False)
@@ -261,4 +261,31 @@ $(function () {
 
     });
 
+    // ****************************************
+    // Typeahead for inventory names
+    // ****************************************
+
+    $("#inventory_name").on("input", function () {
+
+        var prefix = $("#inventory_name").val();
+        if (prefix.length < 2) {
+            return;
+        }
+
+        var ajax = $.ajax({
+            type: "GET",
+            url: "/inventory/search?limit=10&q=" + encodeURIComponent(prefix),
+            contentType:"application/json",
+            data: ''
+        })
+
+        ajax.done(function(res){
+            $("#inventory_names").empty();
+            for(var i = 0; i < res.length; i++) {
+                $("#inventory_names").append($("<option>").attr("value", res[i].name));
+            }
+        });
+
+    });
+
 })
@@ -0,0 +1,310 @@
+"""
+Request tracing for the Inventory Service
+
+With TRACE_EXPORTER set every request is traced: a span for the Flask
+request, nested spans for the Inventory methods it calls and for every
+HTTP request to CouchDB, and an event for every retry and warning logged
+along the way. A finished request is handed to the exporter as a tree of
+spans, ready to draw as a flame graph.
+
+Exporters are chosen by TRACE_EXPORTER:
+
+    memory - keeps the latest TRACE_MEMORY_SIZE traces in MemoryExporter.traces
+    file   - appends one JSON line per trace to TRACE_FILE
+    package.module:factory - calls factory() for any other exporter, an
+             object with an export(trace) method
+
+Trace context follows the W3C traceparent header: a request that carries
+one continues its trace, and the requests sent to CouchDB carry the
+current span's. Tracing costs one attribute test per call while it is off.
+"""
+import os
+import json
+import time
+import random
+import logging
+import threading
+import importlib
+from functools import wraps
+from collections import deque
+from requests.adapters import BaseAdapter
+
+# where finished traces go: memory, file or package.module:factory; off if empty
+TRACE_EXPORTER = os.environ.get('TRACE_EXPORTER', '')
+# the file the file exporter appends to
+TRACE_FILE = os.environ.get('TRACE_FILE', 'traces.json')
+# traces kept by the memory exporter
+TRACE_MEMORY_SIZE = int(os.environ.get('TRACE_MEMORY_SIZE', 100))
+
+# the retry library logs each failed attempt from this function
+RETRY_FUNCTION = '__retry_internal'
+
+logger = logging.getLogger(__name__)
+
+
+######################################################################
+#  S P A N S
+######################################################################
+
+class Span(object):
+    """ One timed operation of a trace """
+
+    def __init__(self, name, trace_id, parent_id=None, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = '%016x' % random.getrandbits(64)
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.events = []
+        self.children = []
+        self.start = time.time()
+        self.end = None
+        self.error = None
+        self.root = False       # True for the first span of the trace in this process
+
+    def set(self, **attributes):
+        """ Adds attributes to the span """
+        self.attributes.update(attributes)
+
+    def event(self, name, **attributes):
+        """ Records something that happened during the span """
+        self.events.append({'name': name, 'time': time.time(), 'attributes': attributes})
+
+    def traceparent(self):
+        """ Returns the W3C traceparent header of the span """
+        return '00-{}-{}-01'.format(self.trace_id, self.span_id)
+
+    def serialize(self):
+        """ Serializes the span and its children into a dictionary """
+        return {'name': self.name,
+                'trace_id': self.trace_id,
+                'span_id': self.span_id,
+                'parent_id': self.parent_id,
+                'start': self.start,
+                'duration': self.end - self.start if self.end is not None else None,
+                'attributes': self.attributes,
+                'events': self.events,
+                'error': self.error,
+                'children': [child.serialize() for child in self.children]}
+
+
+def parse_traceparent(header):
+    """ Returns (trace id, parent span id) of a traceparent header, or None """
+    parts = (header or '').strip().split('-')
+    if len(parts) < 4 or len(parts[0]) != 2 or parts[0] == 'ff':
+        return None
+    trace_id, span_id = parts[1].lower(), parts[2].lower()
+    try:
+        int(trace_id, 16)
+        int(span_id, 16)
+    except ValueError:
+        return None
+    if (len(trace_id) != 32 or len(span_id) != 16 or
+            trace_id == '0' * 32 or span_id == '0' * 16):
+        return None
+    return trace_id, span_id
+
+
+######################################################################
+#  C O N T E X T
+######################################################################
+
+exporter = None         # where finished traces go; None turns tracing off
+_local = threading.local()
+
+def current():
+    """ Returns the innermost open span of this thread, or None """
+    stack = getattr(_local, 'stack', None)
+    return stack[-1] if stack else None
+
+def start(name, traceparent=None, parent=None, **attributes):
+    """
+    Opens a span as a child of parent (by default the current span)
+
+    A span without a parent starts a trace, or continues the one of a
+    traceparent header. Returns None while tracing is off.
+    """
+    if exporter is None:
+        return None
+    parent = parent or current()
+    if parent is not None:
+        span = Span(name, parent.trace_id, parent.span_id, attributes)
+        parent.children.append(span)
+    else:
+        context = parse_traceparent(traceparent)
+        if context is None:
+            context = ('%032x' % random.getrandbits(128), None)
+        span = Span(name, context[0], context[1], attributes)
+        span.root = True
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    _local.stack.append(span)
+    return span
+
+def finish(span, error=None):
+    """ Closes a span, and exports its trace if it was the first one """
+    if span is None:
+        return
+    span.end = time.time()
+    if error is not None:
+        span.error = '{}: {}'.format(type(error).__name__, error)
+    stack = getattr(_local, 'stack', [])
+    if span in stack:
+        del stack[stack.index(span):]
+    if span.root and exporter is not None:
+        try:
+            exporter.export(span.serialize())
+        except Exception as err:     # a broken exporter must not fail requests
+            logger.warning('Could not export trace %s: %s', span.trace_id, err)
+
+class span(object):
+    """ Traces a block: with tracing.span('name', key=value) as span: ... """
+
+    def __init__(self, name, **attributes):
+        self.name = name
+        self.attributes = attributes
+        self.span = None
+
+    def __enter__(self):
+        self.span = start(self.name, **self.attributes)
+        return self.span
+
+    def __exit__(self, kind, error, traceback):
+        finish(self.span, error)
+        return False
+
+def traced(name):
+    """ Decorates a function to run in a span of its own """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if exporter is None:
+                return function(*args, **kwargs)
+            opened = start(name)
+            try:
+                result = function(*args, **kwargs)
+            except Exception as err:
+                finish(opened, err)
+                raise
+            finish(opened)
+            return result
+        return wrapper
+    return decorator
+
+def attach(parent, function):
+    """ Returns function wrapped to run under parent's span on another thread """
+    if parent is None:
+        return function
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        _local.stack = [parent]
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _local.stack = []
+    return wrapper
+
+
+######################################################################
+#  I N S T R U M E N T A T I O N
+######################################################################
+
+class TracingAdapter(BaseAdapter):
+    """ A requests transport adapter that traces the requests of another """
+
+    def __init__(self, adapter):
+        super(TracingAdapter, self).__init__()
+        self.adapter = adapter
+
+    def send(self, request, **kwargs):
+        """ Sends a request in a span, passing the trace on in traceparent """
+        if exporter is None:
+            return self.adapter.send(request, **kwargs)
+        opened = start('couchdb ' + request.method, method=request.method,
+                       url=request.path_url.split('?', 1)[0])
+        if opened is not None:
+            request.headers['traceparent'] = opened.traceparent()
+        try:
+            response = self.adapter.send(request, **kwargs)
+        except Exception as err:
+            finish(opened, err)
+            raise
+        if opened is not None:
+            opened.set(status=response.status_code)
+        finish(opened)
+        return response
+
+    def close(self):
+        self.adapter.close()
+
+def instrument(adapter):
+    """ Returns adapter wrapped to trace the requests it sends """
+    return TracingAdapter(adapter)
+
+
+class SpanEventHandler(logging.Handler):
+    """ Records log records as events of the current span, retries as 'retry' """
+
+    def emit(self, record):
+        opened = current()
+        if opened is not None:
+            name = 'retry' if record.funcName == RETRY_FUNCTION else 'log'
+            opened.event(name, level=record.levelname, message=record.getMessage())
+
+event_handler = SpanEventHandler(logging.WARNING)
+
+
+######################################################################
+#  E X P O R T E R S
+######################################################################
+
+class MemoryExporter(object):
+    """ Keeps the latest traces in memory, e.g. for tests """
+
+    def __init__(self, size=None):
+        self.traces = deque(maxlen=size or TRACE_MEMORY_SIZE)
+
+    def export(self, trace):
+        """ Keeps a trace """
+        self.traces.append(trace)
+
+class JsonFileExporter(object):
+    """ Appends each trace to a file as one line of JSON """
+
+    def __init__(self, path=None):
+        self.path = path or TRACE_FILE
+        self.lock = threading.Lock()
+
+    def export(self, trace):
+        """ Writes a trace """
+        line = json.dumps(trace, separators=(',', ':'), default=str) + '\n'
+        with self.lock:
+            with open(self.path, 'a') as output:
+                output.write(line)
+
+EXPORTERS = {'memory': MemoryExporter, 'file': JsonFileExporter}
+
+def configure(name=None):
+    """
+    Turns tracing on with the exporter named by name (by default
+    TRACE_EXPORTER), or off if it is empty. Returns the exporter.
+    """
+    global exporter
+    name = TRACE_EXPORTER if name is None else name
+    if not name:
+        exporter = None
+    elif name in EXPORTERS:
+        exporter = EXPORTERS[name]()
+    elif ':' in name:
+        module, _, factory = name.partition(':')
+        exporter = getattr(importlib.import_module(module), factory)()
+    else:
+        raise ValueError('Unknown trace exporter {}'.format(name))
+    root_logger = logging.getLogger()
+    if exporter is None:
+        root_logger.removeHandler(event_handler)
+    elif event_handler not in root_logger.handlers:
+        root_logger.addHandler(event_handler)
+    return exporter
+
+configure()
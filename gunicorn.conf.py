@@ -0,0 +1,50 @@
+"""
+gunicorn settings for the Inventory Service
+
+With SHARED_CACHE_PATH set the master starts the one process that follows
+the database _changes feed into the cache its workers share. Set
+SHARED_CACHE_FOLLOWER=sidecar when the follower runs on its own instead
+(python manage.py follow-cache).
+
+With RESERVATION_SWEEPER=master the master also starts a process that
+sweeps expired and committed reservations. Leave it unset when the
+sweeper runs on its own (python manage.py sweep-reservations); one per
+database is enough.
+
+Both are started as manage.py commands rather than forked from the
+master, which never imports the app: the gevent workers must be the first
+to import it, after they have monkey-patched, or they inherit native
+thread locals and locks.
+"""
+import os
+import sys
+import subprocess
+
+DATABASE = os.getenv('DATABASE', 'inventory')
+MANAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'manage.py')
+
+processes = []
+
+
+def start(server, command, description):
+    """ Runs a manage.py command next to the workers """
+    process = subprocess.Popen([sys.executable, MANAGE, '--database', DATABASE, command])
+    processes.append(process)
+    server.log.info('Started %s (pid %s)', description, process.pid)
+
+def when_ready(server):
+    """ Starts the shared cache follower and reservation sweeper once the master is listening """
+    if os.getenv('RESERVATION_SWEEPER') == 'master':
+        start(server, 'sweep-reservations', 'reservation sweeper')
+    if not os.getenv('SHARED_CACHE_PATH'):
+        return
+    if os.getenv('SHARED_CACHE_FOLLOWER', 'master') != 'master':
+        return
+    start(server, 'follow-cache', 'shared cache follower')
+
+def on_exit(server):
+    """ Stops the processes started by when_ready() """
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.wait()
@@ -0,0 +1,145 @@
+"""
+Inventory Management Commands
+
+Maintenance tasks that run against the database directly, without going
+through the service. For example:
+
+    python manage.py import inventory.csv
+    python manage.py --database test import --format ndjson inventory.ndjson
+    python manage.py snapshot --compress inventory.snap
+    python manage.py --database test restore inventory.snap
+    SHARED_CACHE_PATH=/tmp/inventory.cache python manage.py follow-cache
+    python manage.py --database inventory_by_category migrate-partitioned inventory
+    python manage.py sweep-reservations --once
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import argparse
+from app.models import Inventory
+from app import bulk, reservations, sharedcache
+
+DATABASE = os.getenv('DATABASE', 'inventory')
+
+######################################################################
+#   C O M M A N D S
+######################################################################
+
+def progress(summary):
+    """ Prints the running totals of a bulk load on one line """
+    sys.stderr.write('\rimported {} failed {}'.format(summary.imported, summary.failed))
+    sys.stderr.flush()
+
+def import_inventory(args):
+    """ Imports a CSV or NDJSON file """
+    file_format = args.format or os.path.splitext(args.file)[1].lstrip('.').lower()
+    if file_format == 'jsonl':
+        file_format = 'ndjson'
+    if file_format not in bulk.FORMATS:
+        sys.stderr.write('Cannot tell the format of {}; use --format {}\n'.format(
+            args.file, '|'.join(sorted(bulk.FORMATS))))
+        return 2
+    with open(args.file, 'rb') as stream:
+        summary = bulk.import_file(stream, file_format, progress=progress)
+    sys.stderr.write('\n')
+    print(json.dumps(summary.serialize(), indent=2))
+    return 1 if summary.failed else 0
+
+def snapshot_inventory(args):
+    """ Writes the database to a binary snapshot file """
+    written = Inventory.snapshot(args.file, compress=args.compress)
+    print('wrote {} inventory to {}'.format(written, args.file))
+    return 0
+
+def restore_inventory(args):
+    """ Bulk loads a binary snapshot file """
+    summary = Inventory.restore(args.file, progress=progress)
+    sys.stderr.write('\n')
+    print(json.dumps(summary.serialize(), indent=2))
+    return 1 if summary.failed else 0
+
+def migrate_partitioned(args):
+    """ Copies a database into the partitioned --database """
+    try:
+        source = Inventory.client[args.source]
+    except KeyError:
+        sys.stderr.write('Database {} does not exist\n'.format(args.source))
+        return 1
+    summary = bulk.migrate_partitioned(source, progress=progress)
+    sys.stderr.write('\n')
+    print(json.dumps(summary.serialize(), indent=2))
+    return 1 if summary.failed else 0
+
+def follow_cache(args):
+    """ Keeps the shared cache current until interrupted """
+    if Inventory.cache is None:
+        sys.stderr.write('SHARED_CACHE_PATH is not set\n')
+        return 1
+    follower = sharedcache.CacheFollower(Inventory.cache, Inventory.database)
+    try:
+        follower.run()
+    except KeyboardInterrupt:
+        follower.stop()
+    return 0
+
+def sweep_reservations(args):
+    """ Expires holds and folds committed reservations until interrupted """
+    sweeper = reservations.ReservationSweeper()
+    if args.once:
+        print('expired {} holds, folded {} reservations'.format(*sweeper.sweep()))
+        return 0
+    try:
+        sweeper.run()
+    except KeyboardInterrupt:
+        sweeper.stop()
+    return 0
+
+
+def main(argv=None):
+    """ Parses the command line and runs a command """
+    parser = argparse.ArgumentParser(description='Inventory management commands')
+    parser.add_argument('--database', default=DATABASE,
+                        help='database name (default: %(default)s)')
+    commands = parser.add_subparsers(dest='command')
+
+    command = commands.add_parser('import', help='import a CSV or NDJSON file')
+    command.add_argument('file')
+    command.add_argument('--format', choices=sorted(bulk.FORMATS),
+                         help='file format (default: from the file extension)')
+    command.set_defaults(func=import_inventory)
+
+    command = commands.add_parser('snapshot', help='write a binary snapshot file')
+    command.add_argument('file')
+    command.add_argument('--compress', action='store_true', help='zlib compress the file')
+    command.set_defaults(func=snapshot_inventory)
+
+    command = commands.add_parser('restore', help='load a binary snapshot file')
+    command.add_argument('file')
+    command.set_defaults(func=restore_inventory)
+
+    command = commands.add_parser('migrate-partitioned',
+                                  help='copy a database into a new partitioned one')
+    command.add_argument('source', help='the database to copy from')
+    command.set_defaults(func=migrate_partitioned, partitioned=True)
+
+    command = commands.add_parser('follow-cache',
+                                  help='follow _changes into the shared cache')
+    command.set_defaults(func=follow_cache)
+
+    command = commands.add_parser('sweep-reservations',
+                                  help='expire holds and fold committed reservations')
+    command.add_argument('--once', action='store_true', help='sweep once and exit')
+    command.set_defaults(func=sweep_reservations)
+
+    args = parser.parse_args(argv)
+    Inventory.init_db(args.database, partitioned=getattr(args, 'partitioned', None))
+    return args.func(args)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,2 +1,10 @@
-from tests.test_inventory import TestInventory
-from tests.test_server import TestInventoryServer
+"""
+Test package for the Inventory Service
+
+The suite runs against the in-memory database backend, so it needs no
+CouchDB and each test process has databases of its own. Set
+DATABASE_BACKEND=cloudant to run it against a real server instead.
+"""
+import os
+
+os.environ.setdefault('DATABASE_BACKEND', 'memory')
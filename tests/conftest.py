@@ -0,0 +1,22 @@
+"""
+pytest fixtures for the Inventory Service tests
+
+Run the suite in parallel with pytest-xdist (pytest -n 4): every worker
+gets a database of its own, named after the worker, so that workers never
+see each other's data even against a shared CouchDB.
+"""
+import os
+import pytest
+from app import models
+
+
+@pytest.fixture(scope='session', autouse=True)
+def worker_database():
+    """ Suffixes database names with the pytest-xdist worker id """
+    worker = os.environ.get('PYTEST_XDIST_WORKER')
+    suffix = models.DATABASE_SUFFIX
+    if worker:
+        models.DATABASE_SUFFIX = '{}_{}'.format(suffix, worker)
+    yield
+    models.DATABASE_SUFFIX = suffix
+
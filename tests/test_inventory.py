@@ -24,10 +24,20 @@ import unittest
 from mock import MagicMock, patch
 from requests import HTTPError, ConnectionError
 import os
+import sys
+import shutil
+import subprocess
+import tempfile
 import json
+import time
 import logging
-from app.models import Inventory, DataValidationError
-from app import app
+import threading
+from app.models import Inventory, InventoryCollection, InventorySchema, DataValidationError
+from app.models import partition_key
+from app import app, admission, analytics, bulk, encoding, hedging, idempotency, profiling
+from app import routing
+from app import changes, reservations, sharedcache, tracing
+from app.reservations import Reservation, ReservationConflict, ReservationSweeper
 
 VCAP_SERVICES = {
     'cloudantNoSQLDB': [
@@ -80,6 +90,35 @@ class TestInventory(unittest.TestCase):
         self.assertEqual(inventorys[0].available, True)
         self.assertEqual(inventorys[0].condition, "new")
 
+    def test_create_many(self):
+        """ Create many Inventory in one request """
+        inventories = [Inventory("tools", "widget1"), Inventory("materials", "widget2")]
+        results = Inventory.create_many(inventories)
+        self.assertEqual(len(results), 2)
+        self.assertNotIn('error', results[0])
+        self.assertIsNotNone(inventories[0].id)
+        self.assertEqual(Inventory.find(inventories[1].id).name, "materials")
+        # ids that were given rather than generated are real conflicts
+        results = Inventory.create_many(inventories)
+        self.assertEqual(results[0]['error'], 'conflict')
+        self.assertEqual(len(Inventory.all()), 2)
+
+    def test_import_rows_writer_error(self):
+        """ Fail the chunks of an import whose writes raise """
+        records = [{'name': 'tools', 'category': 'widget1', 'available': True,
+                    'condition': 'new', 'count': 1}] * 5
+        with patch.object(Inventory, 'create_many',
+                          side_effect=RuntimeError('boom')) as create_many:
+            summary = bulk.import_rows(records, dict, chunk_size=1, workers=1)
+        self.assertEqual(create_many.call_count, 5)
+        self.assertEqual((summary.imported, summary.failed), (0, 5))
+        self.assertEqual(set(error['error'] for error in summary.errors), set(['boom']))
+
+    def test_create_many_without_name(self):
+        """ Create many Inventory with one missing a name """
+        inventories = [Inventory("tools", "widget1"), Inventory(None, "widget2")]
+        self.assertRaises(DataValidationError, Inventory.create_many, inventories)
+
     def test_update_a_inventory(self):
         """ Update an Inventory """
         inventory = Inventory(name="tools", category="widget1", available=True,condition="new")
@@ -104,6 +143,67 @@ class TestInventory(unittest.TestCase):
         inventory.delete()
         self.assertEqual(len(Inventory.all()), 0)
 
+    def test_remove_all(self):
+        """ Remove all Inventory by recreating the database """
+        Inventory("tools", "widget1", True, "new", 1).save()
+        Inventory("materials", "widget2", True, "new", 2).save()
+        Inventory.remove_all()
+        self.assertEqual(Inventory.all(), [])
+        self.assertEqual(list(Inventory.database.keys()), [])
+        # the indexes and views are recreated with the database
+        Inventory("tools", "widget1", True, "new", 1).save()
+        self.assertEqual(len(Inventory.find_low_stock(5, category="widget1")), 1)
+        self.assertEqual(len(Inventory.search_by_name("to")), 1)
+
+    @patch('cloudant.database.CouchDatabase.delete')
+    def test_remove_all_without_drop_permission(self, delete_mock):
+        """ Remove all Inventory when the database cannot be dropped """
+        response = MagicMock(status_code=403)
+        delete_mock.side_effect = HTTPError(response=response)
+        for i in range(3):
+            Inventory("tools{}".format(i), "widget1", True, "new", i).save()
+        Inventory.remove_all()
+        self.assertEqual(Inventory.all(), [])
+        self.assertEqual(len(Inventory.find_low_stock(5)), 0)
+
+    def test_inventory_has_no_dict(self):
+        """ Inventory only holds its declared fields """
+        inventory = Inventory(name="tools", category="widget1")
+        self.assertFalse(hasattr(inventory, '__dict__'))
+        self.assertRaises(AttributeError, setattr, inventory, 'price', 10)
+
+    def test_collection(self):
+        """ Read Inventory into an InventoryCollection """
+        Inventory("tools", "widget1", True, "new", 5).save()
+        Inventory("nails", "widget1", False, "old", 1).save()
+        Inventory("materials", "widget2", True, "new", "2").save()
+        collection = Inventory.collection()
+        self.assertEqual(len(collection), 3)
+        self.assertEqual(sorted(item['name'] for item in json.loads(collection.to_json())),
+                         ["materials", "nails", "tools"])
+        self.assertEqual(sorted(collection.serialize()),
+                         sorted(item.serialize() for item in Inventory.all()))
+        self.assertEqual(collection.sum(), 6)
+        self.assertEqual(collection.sum(category="widget1", available=True), 5)
+        widget2 = collection.filter(category="widget2")
+        self.assertEqual([item.count for item in widget2], ["2"])
+        self.assertEqual(len(Inventory.collection(category="widget1")), 2)
+        # values kept aside are matched as they were stored
+        self.assertEqual(len(collection.filter(count="2")), 1)
+        self.assertEqual(len(collection.filter(count=2)), 0)
+        self.assertEqual([item.name for item in collection.filter(name="nails", count=1)],
+                         ["nails"])
+        self.assertEqual(collection.filter(available=True, condition="new").sum(), 5)
+
+    def test_collection_bad_filter(self):
+        """ Filter an InventoryCollection on an unknown field """
+        collection = InventoryCollection()
+        collection.append({"_id": "1", "name": "tools", "category": "widget1",
+                           "available": True, "condition": "new", "count": 1})
+        self.assertRaises(DataValidationError, collection.filter, price=1)
+        self.assertEqual(len(collection.filter(category="widget9")), 0)
+        self.assertRaises(DataValidationError, collection.append, {"_id": "2"})
+
     def test_serialize_a_inventory(self):
         """ Test serialization of a Inventory """
         inventory = Inventory(name="tools", category="widget1", available=False, condition="new")
@@ -137,6 +237,47 @@ class TestInventory(unittest.TestCase):
         inventory = Inventory()
         self.assertRaises(DataValidationError, inventory.deserialize, data)
 
+    def test_deserialize_coerces_types(self):
+        """ Test deserialization converts strings to counts and flags """
+        data = {"name": "materials", "category": "widget2", "available": "False",
+                "count": " 12", "condition": "new"}
+        inventory = Inventory().deserialize(data)
+        self.assertEqual(inventory.count, 12)
+        self.assertEqual(inventory.available, False)
+
+    def test_deserialize_reports_every_error(self):
+        """ Test deserialization reports all of the errors in a record """
+        data = {"name": "", "category": "widget2", "available": "maybe", "count": "x"}
+        try:
+            Inventory().deserialize(data)
+        except DataValidationError as error:
+            message = str(error)
+        else:
+            self.fail('DataValidationError not raised')
+        for problem in ('name must be', 'available must be', 'missing condition',
+                        'count must be an integer'):
+            self.assertIn(problem, message)
+
+    def test_deserialize_many(self):
+        """ Test deserialization of a batch of records """
+        records = [{"_id": "1", "name": "tools", "category": "widget1", "available": True,
+                    "condition": "new", "count": 1},
+                   {"name": "materials", "count": -1}]
+        results = Inventory.deserialize_many(records)
+        self.assertEqual(results[0][0].id, "1")
+        self.assertIsNone(results[0][1])
+        self.assertIsNone(results[1][0])
+        self.assertIn('count must not be negative', results[1][1])
+
+    def test_deserialize_allowed_categories(self):
+        """ Test deserialization only accepts the allowed categories """
+        data = {"name": "tools", "category": "widget9", "available": True,
+                "count": 1, "condition": "new"}
+        with patch.object(Inventory, 'schema', InventorySchema(['widget1', 'widget2'])):
+            self.assertRaises(DataValidationError, Inventory().deserialize, data)
+            data['category'] = 'widget1'
+            self.assertEqual(Inventory().deserialize(data).category, 'widget1')
+
     @patch('cloudant.database.CloudantDatabase.__getitem__')
     def test_deserialize_bad_data1(self, bad_mock):
         """ Test deserialization of bad data """
@@ -156,6 +297,560 @@ class TestInventory(unittest.TestCase):
         inventory = Inventory()
         inventory.deserialize(data)
 
+    def test_iterate(self):
+        """ Iterate over all Inventory a page at a time """
+        for i in range(5):
+            Inventory("tools{}".format(i), "widget1").save()
+        inventory = list(Inventory.iterate(page_size=2))
+        self.assertEqual(len(inventory), 5)
+        self.assertEqual(len(set(item.id for item in inventory)), 5)
+
+    def test_snapshot_and_restore(self):
+        """ Snapshot the database and restore it into an empty one """
+        Inventory("tools", "widget1", True, "new", 5).save()
+        Inventory("materials", "widget2", False, None, 2).save()
+        Inventory(u"caf\xe9", "widget1", True, "new", "3").save()
+        expected = sorted((item.id, item.serialize()) for item in Inventory.all())
+        folder = tempfile.mkdtemp()
+        try:
+            for compress in (False, True):
+                path = os.path.join(folder, 'inventory.snap')
+                self.assertEqual(Inventory.snapshot(path, compress=compress), 3)
+                Inventory.remove_all()
+                summary = Inventory.restore(path)
+                self.assertEqual(summary.imported, 3)
+                self.assertEqual(summary.failed, 0)
+                restored = sorted((item.id, item.serialize()) for item in Inventory.all())
+                self.assertEqual(restored, expected)
+        finally:
+            shutil.rmtree(folder)
+
+    def test_snapshot_odd_values(self):
+        """ Snapshot long strings and availability that is not a boolean """
+        names = [u'x' * 65534, u'y' * 65535, u'z' * 70000]
+        for name in names:
+            Inventory(name, "widget1", True, "new", 1).save()
+        Inventory("tools", "widget1", "yes", "new", 1).save()
+        Inventory("materials", "widget2", "maybe", None, 2).save()
+        folder = tempfile.mkdtemp()
+        try:
+            path = os.path.join(folder, 'inventory.snap')
+            self.assertEqual(Inventory.snapshot(path), 5)
+            Inventory.remove_all()
+            self.assertEqual(Inventory.restore(path).imported, 5)
+        finally:
+            shutil.rmtree(folder)
+        restored = dict((item.name, item.available) for item in Inventory.all())
+        self.assertEqual(sorted(restored), sorted(names + ['tools', 'materials']))
+        self.assertEqual(restored['tools'], True)
+        self.assertEqual(restored['materials'], None)
+
+    def test_restore_bad_file(self):
+        """ Restore a file that is not a snapshot """
+        handle, path = tempfile.mkstemp()
+        os.write(handle, b'not a snapshot')
+        os.close(handle)
+        try:
+            self.assertRaises(ValueError, Inventory.restore, path)
+        finally:
+            os.remove(path)
+
+    def test_shared_cache(self):
+        """ Read Inventory through a cache kept current by a follower """
+        folder = tempfile.mkdtemp()
+        cache = sharedcache.SharedCache(os.path.join(folder, 'cache.db'),
+                                        Inventory.database.database_url)
+        follower = sharedcache.CacheFollower(cache, Inventory.database)
+        follower.catch_up()
+        Inventory.cache = cache
+        try:
+            tools = Inventory("tools", "widget1", True, "new", 5)
+            tools.save()
+            self.assertEqual(cache.get(tools.id)[1]['count'], 5)
+            # another worker updates the document
+            document = dict(cache.get(tools.id)[1], count=7)
+            Inventory.database.bulk_docs([document])
+            self.assertEqual(Inventory.find(tools.id).count, 5)
+            follower.catch_up()
+            self.assertEqual(Inventory.find(tools.id).count, 7)
+            # a stale read cannot replace a newer revision
+            cache.put(dict(document, count=1))
+            self.assertEqual(Inventory.find_many([tools.id])[0].count, 7)
+            materials = Inventory("materials", "widget2", True, "new", 2)
+            materials.save()
+            cache.clear()
+            found = Inventory.find_many([tools.id, "missing", materials.id])
+            self.assertEqual([item.name for item in found], ["tools", "materials"])
+            self.assertTrue(cache.get(materials.id)[0])
+            materials.delete()
+            self.assertEqual(cache.get(materials.id), (True, None))
+            self.assertIsNone(Inventory.find(materials.id))
+            follower.catch_up()
+            self.assertEqual(cache.get(materials.id), (True, None))
+            # without a follower the cache is not used
+            follower.stop()
+            cache.checked = 0
+            self.assertFalse(cache.fresh())
+        finally:
+            Inventory.cache = None
+            shutil.rmtree(folder)
+
+    def test_partition_key(self):
+        """ Map categories to partition names """
+        self.assertEqual(partition_key("tools"), "tools")
+        self.assertEqual(partition_key("a:b"), "a%3Ab")
+        self.assertEqual(partition_key("_hidden"), "hidden")
+        self.assertEqual(partition_key(None), "uncategorized")
+        self.assertEqual(partition_key(""), "uncategorized")
+
+    def test_partitioned_database(self):
+        """ Migrate Inventory into a database partitioned by category """
+        Inventory("tools", "widget1", True, "new", 5).save()
+        Inventory("screws", "widget1", True, "new", 2).save()
+        Inventory("nails", "widget2", True, "new", 1).save()
+        source = Inventory.database
+        Inventory.init_db("test-partitioned", partitioned=True)
+        try:
+            if not Inventory.partitioned:
+                self.skipTest('the server does not support partitioned databases')
+            Inventory.remove_all()
+            summary = bulk.migrate_partitioned(source)
+            self.assertEqual((summary.imported, summary.failed), (3, 0))
+            inventory = Inventory.find_by_category("widget1")
+            self.assertEqual(sorted(item.name for item in inventory), ["screws", "tools"])
+            self.assertTrue(all(item.id.startswith("widget1:") for item in inventory))
+            self.assertEqual(len(Inventory.collection(category="widget2")), 1)
+            low = Inventory.find_low_stock(10, category="widget1")
+            self.assertEqual([item.name for item in low], ["screws", "tools"])
+            self.assertEqual([item.count for item in Inventory.find_low_stock(10)], [1, 2, 5])
+            self.assertEqual(len(Inventory.search_by_name("too")), 1)
+            bolts = Inventory("bolts", None, True, "new", 4)
+            bolts.save()
+            self.assertTrue(bolts.id.startswith("uncategorized:"))
+            # changing the category moves the Inventory to another partition
+            old_id = bolts.id
+            bolts.category = "widget2"
+            bolts.save()
+            self.assertTrue(bolts.id.startswith("widget2:"))
+            self.assertIsNone(Inventory.find(old_id))
+            self.assertEqual(len(Inventory.find_by_category("widget2")), 2)
+            summary = bulk.migrate_partitioned(source)
+            self.assertEqual((summary.imported, summary.failed), (0, 3))
+        finally:
+            Inventory.init_db("test")
+
+    def test_parse_endpoints(self):
+        """ Parse the roles and URLs of the database servers """
+        endpoints = routing.parse_endpoints("primary=http://a:5984, replica=http://b:5984")
+        self.assertEqual(endpoints, [("primary", "http://a:5984"), ("replica", "http://b:5984")])
+        self.assertEqual(routing.parse_endpoints(""), [])
+        self.assertRaises(ValueError, routing.parse_endpoints, "replica=http://b:5984")
+        self.assertRaises(ValueError, routing.parse_endpoints, "master=http://a:5984")
+
+    @patch('app.routing.READ_YOUR_WRITES', 60)
+    def test_read_routing(self):
+        """ Read from a replica, failing over to the primary """
+        replica = Inventory.create_database("test-replica")
+        router = routing.ReadRouter(routing.Node("primary", Inventory.database),
+                                    [routing.Node("replica", replica)])
+        Inventory.router = router
+        try:
+            tools = Inventory("tools", "widget1", True, "new", 5)
+            tools.save()
+            # the replica has not caught up, so our own write is read from the primary
+            self.assertEqual(Inventory.find(tools.id).name, "tools")
+            self.assertEqual(Inventory.find_by_name("tools")[0].id, tools.id)
+            router.last_write = 0
+            router.written.clear()
+            self.assertIsNone(Inventory.find(tools.id))
+            self.assertEqual(Inventory.find_by_name("tools"), [])
+            replica.bulk_docs([dict(tools.serialize(), _id=tools.id)])
+            self.assertEqual(Inventory.find_many([tools.id])[0].count, 5)
+            self.assertEqual(router.replicas[0].reads, 4)
+            # a failing replica is ejected and the primary answers
+            router.replicas[0].database = MagicMock()
+            router.replicas[0].database.all_docs.side_effect = ConnectionError()
+            self.assertEqual(len(Inventory.all()), 1)
+            self.assertFalse(router.replicas[0].healthy())
+            self.assertEqual(router.choose(), [])
+            self.assertEqual(len(Inventory.all()), 1)
+            # a failing health check keeps it out and a passing one brings it back
+            router.replicas[0].database.r_session.head.side_effect = ConnectionError()
+            router.check()
+            self.assertFalse(router.replicas[0].healthy())
+            router.replicas[0].database.r_session.head.side_effect = None
+            router.check()
+            self.assertTrue(router.replicas[0].healthy())
+            self.assertEqual(router.choose(), router.replicas)
+        finally:
+            router.close()
+            Inventory.router = None
+            replica.delete()
+
+    def test_analytics_queries_during_refresh(self):
+        """ Query an analytics snapshot while a refresh grows its columns """
+        snapshot = analytics.AnalyticsSnapshot(Inventory.database)
+        done = threading.Event()
+        def fill():
+            for i in range(20000):
+                with snapshot.lock:
+                    snapshot._put(str(i), Inventory("tools", "widget1", True, "new", i))
+            done.set()
+        thread = threading.Thread(target=fill)
+        thread.start()
+        try:
+            while not done.is_set():     # these raised on mismatched column lengths
+                snapshot.total(category="widget1")
+                snapshot.sum_by("condition", category="widget1")
+                snapshot.top(3)
+        finally:
+            thread.join()
+        self.assertEqual(snapshot.total(category="widget1")[0], 20000)
+
+    @patch('app.hedging.HEDGE_DEFAULT_DELAY', 0.01)
+    def test_hedged_reads(self):
+        """ Hedge slow reads within a budget """
+        def slow():
+            time.sleep(0.2)
+            return "slow"
+        def failing():
+            raise ConnectionError()
+        hedger = hedging.Hedger()
+        self.assertEqual(hedger.run("find", slow, lambda: "fast"), "fast")
+        self.assertEqual(hedger.run("find", lambda: "first", slow), "first")
+        self.assertRaises(ConnectionError, hedger.run, "find", failing, failing)
+        self.assertEqual((hedger.reads, hedger.hedged, hedger.won), (3, 1, 1))
+        # without a budget late reads just wait
+        hedger = hedging.Hedger(budget=0, burst=0)
+        self.assertEqual(hedger.run("find", slow, lambda: "fast"), "slow")
+        self.assertEqual((hedger.hedged, hedger.over_budget), (0, 1))
+        # hedged model reads
+        Inventory.hedger = hedging.Hedger()
+        try:
+            tools = Inventory("tools", "widget1", True, "new", 5)
+            tools.save()
+            self.assertEqual(Inventory.find(tools.id).name, "tools")
+            self.assertEqual(Inventory.find_by_name("tools")[0].id, tools.id)
+            self.assertEqual(Inventory.find_many([tools.id])[0].id, tools.id)
+            self.assertIsNone(Inventory.find("missing"))
+            self.assertEqual(Inventory.hedger.reads, 4)
+        finally:
+            Inventory.hedger = None
+
+    def test_gradient_limit(self):
+        """ Adapt a concurrency limit to latency """
+        limit = admission.GradientLimit(initial=100, minimum=10, maximum=200)
+        for _ in range(50):
+            limit.update(0.01, 90, False)
+        self.assertGreater(limit.limit, 100)
+        # an idle limit does not grow
+        grown = limit.limit
+        limit.update(0.01, 1, False)
+        self.assertEqual(limit.limit, grown)
+        # latency rising above the tolerance shrinks it
+        for _ in range(50):
+            limit.update(0.2, 90, False)
+        self.assertLess(limit.limit, grown)
+        # so do failures, down to the minimum
+        for _ in range(100):
+            limit.update(0.01, 90, True)
+        self.assertEqual(limit.limit, 10)
+
+    def test_admission_control(self):
+        """ Shed requests over the limit of their route class """
+        controller = admission.AdmissionController()
+        controller.limits['read'] = admission.FixedLimit(2)
+        self.assertTrue(controller.acquire('read'))
+        self.assertTrue(controller.acquire('read'))
+        self.assertFalse(controller.acquire('read'))
+        # bulk is shed while interactive classes use up the headroom
+        self.assertFalse(controller.acquire('bulk'))
+        controller.release('read', 0.01)
+        controller.release('read', 0.01)
+        self.assertTrue(controller.acquire('bulk'))
+        self.assertTrue(controller.acquire('bulk'))
+        self.assertFalse(controller.acquire('bulk'))
+        self.assertEqual(controller.retry_after('bulk'), 5 * controller.retry_after('read'))
+        stats = controller.serialize()
+        self.assertEqual((stats['read']['admitted'], stats['read']['shed']), (2, 1))
+        self.assertEqual((stats['bulk']['inflight'], stats['bulk']['shed']), (2, 2))
+        # tickets release once
+        with patch.object(admission, 'controller', controller):
+            self.assertIsNone(admission.admit(None))
+            self.assertRaises(admission.Overloaded, admission.admit, 'bulk')
+            ticket = admission.admit('write')
+            ticket.release()
+            ticket.release()
+        self.assertEqual(controller.inflight['write'], 0)
+
+    def test_update_matching(self):
+        """ Update Inventory by selector, retrying conflicts """
+        for name in ("hammer", "saw", "drill"):
+            Inventory(name, "tools", True, "new", 1).save()
+        Inventory("glue", "supplies", True, "new", 1).save()
+        save_many = Inventory.save_many
+        def concurrent_write(documents):
+            """ Changes a document between the read and the write, once """
+            if not concurrent_write.done:
+                concurrent_write.done = True
+                saw = Inventory.find_by_name("saw")[0]
+                saw.count = 9
+                saw.save()
+            return save_many(documents)
+        concurrent_write.done = False
+        with patch.object(Inventory, 'save_many', side_effect=concurrent_write):
+            summary = bulk.update_matching({'category': 'tools'},
+                                           {'condition': 'used'})
+        self.assertEqual(summary.serialize(), {'matched': 3, 'updated': 3, 'unchanged': 0,
+                                               'skipped': 0, 'failed': 0, 'errors': []})
+        saw = Inventory.find_by_name("saw")[0]
+        self.assertEqual((saw.condition, saw.count), ("used", 9))
+        self.assertEqual(Inventory.find_by_name("glue")[0].condition, "new")
+        self.assertRaises(DataValidationError, bulk.update_matching,
+                          {'category': 'tools'}, {'id': 'x'})
+
+    def test_update_matching_counts(self):
+        """ Count every matched Inventory once, whatever happened to it """
+        for name in ("hammer", "saw", "drill"):
+            Inventory(name, "tools", True, "new", 1).save()
+        glue = Inventory("glue", "supplies", True, "new", 1)
+        glue.save()
+        database_request = Inventory.database_request
+        with patch.object(Inventory, 'database_request',
+                          side_effect=database_request) as request_mock:
+            ids = Inventory.find_ids({'category': 'tools'}, page_size=2)
+        self.assertEqual(len(ids), 3)
+        self.assertEqual(request_mock.call_count, 2)
+        save_many = Inventory.save_many
+        def conflict_then_fail(documents):
+            """ Saves the first document, conflicts on the others, then fails """
+            if conflict_then_fail.done:
+                raise HTTPError('unavailable')
+            conflict_then_fail.done = True
+            return save_many(documents[:1]) + [{'error': 'conflict'}] * (len(documents) - 1)
+        conflict_then_fail.done = False
+        # glue no longer matches and the last id was deleted
+        with patch.object(Inventory, 'find_ids', return_value=ids + [glue.id, 'gone']), \
+                patch.object(Inventory, 'save_many', side_effect=conflict_then_fail):
+            summary = bulk.update_matching({'category': 'tools'}, {'condition': 'used'})
+        data = summary.serialize()
+        self.assertEqual((data['matched'], data['updated'], data['skipped'], data['failed']),
+                         (5, 1, 2, 2))
+
+    def test_tracing(self):
+        """ Trace Inventory calls and their database requests """
+        self.assertEqual(tracing.parse_traceparent(
+            '00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01'),
+            ('4bf92f3577b34da6a3ce929d0e0e4736', '00f067aa0ba902b7'))
+        self.assertIsNone(tracing.parse_traceparent('00-xyz-00f067aa0ba902b7-01'))
+        self.assertIsNone(tracing.parse_traceparent(None))
+        exporter = tracing.configure('memory')
+        try:
+            tools = Inventory("tools", "widget1", True, "new", 5)
+            tools.save()
+            with tracing.span('update', item=tools.id):
+                tools.count = 6
+                tools.save()
+                logging.getLogger('app.models').warning('slow')
+        finally:
+            tracing.configure('')
+        save, update = exporter.traces
+        self.assertEqual(save['name'], 'Inventory.save')
+        self.assertEqual(update['attributes'], {'item': tools.id})
+        self.assertEqual(update['events'][0]['attributes']['message'], 'slow')
+        child = update['children'][0]
+        self.assertEqual((child['name'], child['parent_id']),
+                         ('Inventory.save', update['span_id']))
+        self.assertEqual(child['children'][0]['name'], 'Inventory.update')
+        requests = child['children'][0]['children']
+        self.assertTrue(requests)
+        self.assertTrue(all(request['name'].startswith('couchdb ') for request in requests))
+        self.assertTrue(all(request['trace_id'] == update['trace_id'] for request in requests))
+        # nothing is traced while tracing is off
+        tools.save()
+        self.assertEqual(len(exporter.traces), 2)
+
+    def test_trace_file_exporter(self):
+        """ Append traces to a JSON file """
+        path = os.path.join(tempfile.mkdtemp(), 'traces.json')
+        try:
+            exporter = tracing.JsonFileExporter(path)
+            exporter.export({'name': 'a'})
+            exporter.export({'name': 'b'})
+            with open(path) as traces:
+                self.assertEqual([json.loads(line)['name'] for line in traces], ['a', 'b'])
+        finally:
+            shutil.rmtree(os.path.dirname(path))
+
+    def test_sampling_profiler(self):
+        """ Sample the stacks of every thread """
+        def busy():
+            """ Spins until the profile is over """
+            deadline = time.time() + 0.5
+            while time.time() < deadline:
+                pass
+        import threading
+        worker = threading.Thread(target=busy, name='busy-worker')
+        worker.start()
+        try:
+            sampler = profiling.profile(0.1, interval=0.001)
+        finally:
+            worker.join()
+        self.assertGreater(sampler.samples, 0)
+        collapsed = sampler.collapsed()
+        self.assertIn('busy-worker;', collapsed)
+        self.assertIn('busy (', collapsed)
+        self.assertNotIn('inventory-profiler', collapsed)
+        self.assertNotIn('test_sampling_profiler', collapsed)
+        speedscope = sampler.speedscope()
+        frames = [frame['name'] for frame in speedscope['shared']['frames']]
+        self.assertIn('busy-worker', frames)
+        profile = speedscope['profiles'][0]
+        self.assertEqual(len(profile['samples']), len(profile['weights']))
+        self.assertEqual(len(profile['samples']), len(sampler.stacks))
+
+    def test_reservation_holds(self):
+        """ Hold stock without writing the Inventory """
+        Reservation.remove_all()
+        inventory = Inventory("tools", "widget1", True, "new", 5)
+        inventory.save()
+        rev = inventory.rev
+        first = Reservation.hold(inventory, 3)
+        self.assertEqual(first.state, 'held')
+        self.assertEqual(Reservation.held(inventory.id), 3)
+        self.assertEqual(Reservation.available(inventory), 2)
+        self.assertRaises(ReservationConflict, Reservation.hold, inventory, 3)
+        # the rejected hold was withdrawn
+        self.assertEqual(Reservation.held(inventory.id), 3)
+        second = Reservation.hold(inventory, 2, ttl=60)
+        self.assertEqual(Reservation.available(inventory), 0)
+        second.release()
+        self.assertEqual(Reservation.available(inventory), 2)
+        self.assertRaises(DataValidationError, Reservation.hold, inventory, 0)
+        self.assertRaises(DataValidationError, Reservation.hold, inventory, 1, ttl=-1)
+        # holds stop counting once they expire
+        self.assertEqual(Reservation.held(inventory.id, first.expires + 1), 0)
+        self.assertEqual(Inventory.find(inventory.id).rev, rev)
+        self.assertEqual(Reservation.find(inventory.id, first.id).quantity, 3)
+        self.assertIsNone(Reservation.find('other', first.id))
+        self.assertIsNone(Reservation.find(inventory.id, 'missing'))
+
+    def test_reservation_sweeper(self):
+        """ Expire holds and fold committed reservations into count """
+        Reservation.remove_all()
+        inventory = Inventory("tools", "widget1", True, "new", 10)
+        inventory.save()
+        expired = Reservation.hold(inventory, 1)
+        committed = [Reservation.hold(inventory, 2), Reservation.hold(inventory, 3)]
+        for reservation in committed:
+            reservation.commit()
+        self.assertRaises(ReservationConflict, committed[0].commit)
+        self.assertRaises(ReservationConflict, committed[0].release)
+        sweeper = ReservationSweeper()
+        self.assertEqual(sweeper.expire(expired.expires + 1), 1)
+        self.assertIsNone(Reservation.find(inventory.id, expired.id))
+        self.assertEqual(Reservation.held(inventory.id), 5)
+        self.assertEqual(sweeper.fold(), 2)
+        self.assertEqual(Inventory.find(inventory.id).count, 5)
+        self.assertEqual(Reservation.held(inventory.id), 0)
+        self.assertEqual(sweeper.sweep(), (0, 0))
+        # a fold the Inventory records is not applied twice
+        again = Reservation.hold(inventory, 1)
+        again.commit()
+        document = Reservation.connect()[again.id]
+        document.fetch()
+        document['state'] = 'folding'
+        document['fold'] = Inventory.database[inventory.id]['folds'][-1]
+        document.save()
+        self.assertEqual(sweeper.fold(), 1)
+        self.assertEqual(Inventory.find(inventory.id).count, 5)
+        self.assertIsNone(Reservation.find(inventory.id, again.id))
+
+    def test_reservation_sweepers(self):
+        """ Fold a reservation once with two sweepers at work """
+        Reservation.remove_all()
+        inventory = Inventory("tools", "widget1", True, "new", 10)
+        inventory.save()
+        Reservation.hold(inventory, 3).commit()
+        first, second = ReservationSweeper(), ReservationSweeper()
+        lower_count = ReservationSweeper.lower_count
+        def interleaved(item, fold_id, quantity, deadline=None):
+            """ Lets the second sweeper run between marking and folding """
+            taken.append(second.fold())
+            return lower_count(item, fold_id, quantity, deadline)
+        taken = []
+        with patch.object(first, 'lower_count', side_effect=interleaved):
+            self.assertEqual(first.fold(), 1)
+        self.assertEqual(taken, [0])
+        self.assertEqual(Inventory.find(inventory.id).count, 7)
+        # a sweeper whose lease ran out leaves the fold to the next one
+        Reservation.hold(inventory, 2).commit()
+        taken = []
+        later = time.time() + reservations.RESERVATION_FOLD_LEASE + 1
+        def stalled(item, fold_id, quantity, deadline=None):
+            """ Resumes the first sweeper after its lease ran out """
+            with patch('time.time', return_value=later):
+                return interleaved(item, fold_id, quantity, deadline)
+        with patch.object(first, 'lower_count', side_effect=stalled):
+            self.assertEqual(first.fold(), 0)
+        self.assertEqual(taken, [1])
+        self.assertEqual(Inventory.find(inventory.id).count, 5)
+        self.assertEqual(Reservation.held(inventory.id), 0)
+
+    def test_reservation_commit_conflicts(self):
+        """ Commit a hold that was swept or committed elsewhere """
+        Reservation.remove_all()
+        inventory = Inventory("tools", "widget1", True, "new", 10)
+        inventory.save()
+        hold = Reservation.hold(inventory, 1)
+        other = Reservation.find(inventory.id, hold.id)
+        hold.commit()
+        self.assertRaises(ReservationConflict, other.commit)
+        hold = Reservation.hold(inventory, 1)
+        ReservationSweeper().expire(hold.expires + 1)
+        with patch('time.time', return_value=hold.expires - 1):
+            self.assertRaises(ReservationConflict, hold.commit)
+
+    @unittest.skipUnless(profiling.gevent_monkey, 'gevent is not installed')
+    def test_sampling_profiler_gevent(self):
+        """ Sample a gevent worker, whose threads are greenlets """
+        script = '\n'.join([
+            'from gevent import monkey',
+            'monkey.patch_all()',
+            'import time, gevent',
+            'from app import profiling',
+            'def busy():',
+            '    deadline = time.time() + 0.3',
+            '    while time.time() < deadline:',
+            '        pass',
+            'gevent.spawn(busy)',
+            'print(profiling.profile(0.2, interval=0.001).collapsed())',
+        ])
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ, PYTHONPATH=root)
+        collapsed = subprocess.check_output([sys.executable, '-c', script],
+                                            cwd=root, env=env).decode('utf-8')
+        self.assertIn('greenlets;busy (', collapsed)
+        self.assertNotIn('sample (', collapsed)
+
+    def test_idempotency_store(self):
+        """ Keep responses by idempotency key for a while """
+        store = idempotency.IdempotencyStore(ttl=60, size=2)
+        self.assertIsNone(store.begin('a', 'post'))
+        store.finish('a', (201, [], b'{}'))
+        self.assertEqual(store.begin('a', 'post'), (201, [], b'{}'))
+        self.assertRaises(DataValidationError, store.begin, 'a', 'other')
+        self.assertIsNone(store.begin('b', 'post'))
+        # the oldest key is evicted above the size
+        self.assertIsNone(store.begin('c', 'post'))
+        self.assertEqual(len(store), 2)
+        self.assertIsNone(store.begin('a', 'post'))
+        # expired keys are forgotten
+        store = idempotency.IdempotencyStore(ttl=0)
+        store.begin('a', 'post')
+        store.finish('a', (201, [], b'{}'))
+        self.assertIsNone(store.begin('a', 'post'))
+
     def test_find_inventory(self):
         """ Find an Inventory by ID """
         Inventory("tools", "widget1").save()
@@ -167,6 +862,40 @@ class TestInventory(unittest.TestCase):
         self.assertEqual(inventory.id, saved_inventory.id)
         self.assertEqual(inventory.name, "materials")
 
+    def test_find_many(self):
+        """ Find many Inventory by ID """
+        tools = Inventory("tools", "widget1")
+        tools.save()
+        materials = Inventory("materials", "widget2")
+        materials.save()
+        Inventory("nails", "widget2").save()
+        inventory = Inventory.find_many([materials.id, "missing", tools.id])
+        self.assertEqual([item.id for item in inventory], [materials.id, tools.id])
+        self.assertEqual(inventory[0].name, "materials")
+        self.assertEqual(Inventory.find_many([]), [])
+
+    def test_json_fragments(self):
+        """ Encode Inventory once per revision """
+        encoding.fragments.clear()
+        tools = Inventory("tools", "widget1", True, "new", 1)
+        tools.save()
+        self.assertIsNotNone(tools.rev)
+        inventory = Inventory.find_many([tools.id])
+        self.assertEqual(json.loads(encoding.encode_list(inventory)), [tools.serialize()])
+        self.assertEqual(len(encoding.fragments), 1)
+        self.assertIsNotNone(encoding.fragments.get(tools.id, tools.rev))
+        # a new revision is encoded again
+        tools.count = 5
+        tools.save()
+        inventory = Inventory.find_many([tools.id])
+        self.assertEqual(json.loads(encoding.encode_list(inventory))[0]['count'], 5)
+        self.assertEqual(json.loads(Inventory.collection().to_json())[0]['count'], 5)
+        # changed in memory without a revision, so never cached
+        tools.deserialize({'name': 'pliers', 'category': 'widget1', 'available': True,
+                           'condition': 'new', 'count': 5})
+        self.assertIsNone(tools.rev)
+        self.assertEqual(json.loads(encoding.encode_list([tools]))[0]['name'], 'pliers')
+
     def test_find_by_category(self):
         """ Find an Inventory by Category """
         Inventory(name="tools", category="widget1", available=True,condition="new").save()
@@ -210,6 +939,98 @@ class TestInventory(unittest.TestCase):
         self.assertEqual(inventory[0].available, True)
         self.assertEqual(inventory[0].condition, "new")
 
+    def test_find_low_stock(self):
+        """ Find Inventory with a count below a threshold """
+        Inventory("tools", "widget1", True, "new", 5).save()
+        Inventory("nails", "widget1", True, "new", 1).save()
+        Inventory("materials", "widget2", True, "new", 2).save()
+        Inventory("screws", "widget1", True, "new", 20).save()
+        inventory = Inventory.find_low_stock(10)
+        self.assertEqual([item.count for item in inventory], [1, 2, 5])
+        inventory = Inventory.find_low_stock(10, category="widget1")
+        self.assertEqual([item.name for item in inventory], ["nails", "tools"])
+        inventory = Inventory.find_low_stock(10, limit=1)
+        self.assertEqual(len(inventory), 1)
+        self.assertEqual(inventory[0].name, "nails")
+
+    def test_search_by_name(self):
+        """ Find Inventory by a name prefix """
+        Inventory("Toolbox", "widget1", True, "new").save()
+        Inventory("tools", "widget1", True, "new").save()
+        Inventory("materials", "widget2", True, "new").save()
+        inventory = Inventory.search_by_name("too")
+        self.assertEqual(sorted(item.name for item in inventory), ["Toolbox", "tools"])
+        inventory = Inventory.search_by_name("TOOLS")
+        self.assertEqual([item.name for item in inventory], ["tools"])
+        self.assertEqual(Inventory.search_by_name("x"), [])
+        self.assertEqual(len(Inventory.search_by_name("t", limit=1)), 1)
+
+    def test_changes(self):
+        """ Read changes after an update sequence """
+        changes, checkpoint, complete = Inventory.changes()
+        self.assertTrue(complete)
+        inventory = Inventory("tools", "widget1", True, "new", 5)
+        inventory.save()
+        changes, last_seq, _ = Inventory.changes(since=checkpoint)
+        self.assertEqual(len(changes), 1)
+        self.assertEqual(changes[0][1], inventory.id)
+        self.assertEqual(changes[0][2].name, "tools")
+        inventory.delete()
+        changes, _, _ = Inventory.changes(since=last_seq)
+        self.assertEqual(changes[0][1:], (inventory.id, None))
+        # design documents fill a page without being returned
+        changes, _, complete = Inventory.changes(limit=1)
+        self.assertEqual(changes, [])
+        self.assertFalse(complete)
+        self.assertRaises(DataValidationError, Inventory.changes, since='yesterday')
+
+    def test_change_feed(self):
+        """ Follow changes from a checkpoint past a change that fails """
+        _, checkpoint, _ = Inventory.changes(since='now')
+        first = Inventory("tools", "widget1", True, "new", 5)
+        first.save()
+        second = Inventory("nails", "widget1", True, "new", 1)
+        second.save()
+        from_document = Inventory.from_document
+        def flaky(document):
+            """ Fails on the first document """
+            if document['_id'] == first.id:
+                raise ValueError('unreadable')
+            return from_document(document)
+        feed = changes.ChangeFeed(Inventory.database)
+        with patch.multiple(changes, RETRY_DELAY=0, CHANGES_HEARTBEAT=1), \
+                patch.object(Inventory, 'from_document', side_effect=flaky):
+            subscription = feed.subscribe(checkpoint)
+            change = subscription.get(timeout=5)
+            thread = feed.thread
+            subscription.close()
+            thread.join(5)
+        self.assertEqual(change[1], second.id)
+        self.assertIsNone(feed.thread)
+
+    def test_matches(self):
+        """ Match Inventory against a selector """
+        inventory = Inventory("tools", "widget1", True, "new", 5)
+        self.assertTrue(inventory.matches({}))
+        self.assertTrue(inventory.matches({'category': 'widget1', 'available': True}))
+        self.assertFalse(inventory.matches({'category': 'widget2'}))
+
+    @unittest.skipUnless(os.environ.get('DATABASE_BACKEND') == 'memory',
+                         'only the in-memory backend')
+    def test_memory_backend(self):
+        """ The in-memory backend rejects what CouchDB would """
+        inventory = Inventory("tools", "widget1", True, "new", 5)
+        inventory.save()
+        stale = inventory.rev
+        inventory.count = 6
+        inventory.save()
+        self.assertNotEqual(inventory.rev, stale)
+        document = dict(inventory.serialize(), _id=inventory.id, _rev=stale)
+        result = Inventory.database.bulk_docs([document])
+        self.assertEqual(result[0]['error'], 'conflict')
+        self.assertRaises(HTTPError, Inventory.database.get_query_result,
+                          {'name': 'tools'}, raw_result=True, sort=[{'name': 'asc'}])
+
     def test_create_query_index(self):
         """ Test create query index """
         Inventory("tools", "widget1", False, "new").save()
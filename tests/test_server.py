@@ -25,12 +25,17 @@ import mock
 import unittest
 import os
 import json
+import gzip
+import hashlib
+import io
 import logging
 from flask_api import status    # HTTP Status Codes
 #from mock import MagicMock, patch
 from app.models import Inventory, DataValidationError
 from .inventory_factory import InventoryFactory
 import app.service as app
+from app import idempotency
+from app.reservations import Reservation
 
 ######################################################################
 #  T E S T   C A S E S
@@ -46,6 +51,8 @@ class TestInventoryServer(unittest.TestCase):
         Inventory.remove_all()
         Inventory("tools", "widget1", True, "new",1).save()
         Inventory("materials", "widget2", False, "old",2).save()
+        idempotency.store.clear()
+        Reservation.remove_all()
 
     def _create_inventorys(self, count):
         """ Factory method to create inventorys in bulk """
@@ -113,6 +120,71 @@ class TestInventoryServer(unittest.TestCase):
         self.assertEqual(len(data), inventory_count + 1)
         self.assertIn(new_json, data)
 
+    def test_create_inventory_idempotent(self):
+        """ Create an Inventory once per Idempotency-Key """
+        data = json.dumps({'name': 'nails', 'category': 'widget3', 'available': True,
+                           'condition': 'new', 'count': 5})
+        headers = {'Idempotency-Key': 'create-nails'}
+        resp = self.app.post('/inventory', data=data, content_type='application/json',
+                             headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        created = json.loads(resp.data)
+        with mock.patch.object(Inventory, 'create') as create:
+            resp = self.app.post('/inventory', data=data, content_type='application/json',
+                                 headers=headers)
+            self.assertFalse(create.called)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(json.loads(resp.data), created)
+        self.assertEqual(resp.headers['Idempotent-Replayed'], 'true')
+        self.assertIn(created['id'], resp.headers['Location'])
+        self.assertEqual(self.get_inventory_count(), 3)
+        # the key cannot be reused for another request
+        resp = self.app.post('/inventory', data=data.replace('nails', 'screws'),
+                             content_type='application/json', headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        # a failed request is not kept
+        headers = {'Idempotency-Key': 'create-broken'}
+        resp = self.app.post('/inventory', data='{}', content_type='application/json',
+                             headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post('/inventory', data=data, content_type='application/json',
+                             headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.get_inventory_count(), 4)
+
+    def test_create_inventory_idempotent_across_workers(self):
+        """ Create an Inventory once per Idempotency-Key in every worker """
+        data = json.dumps({'name': 'nails', 'category': 'widget3', 'available': True,
+                           'condition': 'new', 'count': 5})
+        headers = {'Idempotency-Key': 'create-nails'}
+        resp = self.app.post('/inventory', data=data, content_type='application/json',
+                             headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        created = json.loads(resp.data)
+        idempotency.store.clear()   # as if the retry reached another worker
+        resp = self.app.post('/inventory', data=data, content_type='application/json',
+                             headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(json.loads(resp.data), created)
+        self.assertEqual(resp.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(self.get_inventory_count(), 3)
+        # the same key with another body is another request
+        idempotency.store.clear()
+        resp = self.app.post('/inventory', data=data.replace('nails', 'screws'),
+                             content_type='application/json', headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertNotEqual(json.loads(resp.data)['id'], created['id'])
+        self.assertEqual(self.get_inventory_count(), 4)
+
+    def test_create_inventory_in_progress(self):
+        """ Create an Inventory while the same Idempotency-Key is in progress """
+        data = json.dumps({'name': 'nails'})
+        idempotency.store.begin('POST /inventory running', hashlib.sha1(data).hexdigest())
+        resp = self.app.post('/inventory', data=data,
+                             content_type='application/json',
+                             headers={'Idempotency-Key': 'running'})
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+
     def test_void_inventory(self):
         """ VOID Inventory """
         inventory = self.get_inventory('tools')[0] # returns a list
@@ -129,6 +201,40 @@ class TestInventoryServer(unittest.TestCase):
         new_json = json.loads(resp.data)
         self.assertEqual(new_json['available'], False)
 
+    def test_void_matching_inventory(self):
+        """ Void every Inventory in a category """
+        Inventory("nails", "widget1", True, "new", 3).save()
+        resp = self.app.put('/inventory/void', query_string='category=widget1')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual((data['matched'], data['updated'], data['failed']), (2, 2, 0))
+        self.assertEqual([item['available'] for item in self.get_inventory('nails') +
+                          self.get_inventory('tools')], [False, False])
+        # voiding again writes nothing
+        resp = self.app.put('/inventory/void', query_string='category=widget1')
+        data = json.loads(resp.data)
+        self.assertEqual((data['updated'], data['unchanged']), (0, 2))
+        # a filter is required
+        resp = self.app.put('/inventory/void')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_update_matching_inventory(self):
+        """ Update fields of every Inventory matching the filters """
+        Inventory("nails", "widget2", True, "new", 3).save()
+        resp = self.app.patch('/inventory', query_string='category=widget2',
+                              data=json.dumps({'condition': 'used', 'count': '7'}),
+                              content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(resp.data)['updated'], 2)
+        nails = self.get_inventory('nails')[0]
+        self.assertEqual((nails['condition'], nails['count']), ('used', 7))
+        self.assertEqual(self.get_inventory('tools')[0]['condition'], 'new')
+        resp = self.app.patch('/inventory', query_string='category=widget2',
+                              data=json.dumps({'count': -1, 'colour': 'red'}),
+                              content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('unknown field colour', json.loads(resp.data)['message'])
+
     def test_void_non_existing_inventory(self):
         """ Void inventory that doesn't exist """
         resp = self.app.put('/inventory/0/void', content_type='application/json')
@@ -176,6 +282,440 @@ class TestInventoryServer(unittest.TestCase):
         data = json.loads(resp.data)
         query_item = data[0]
         self.assertEqual(query_item['category'], 'widget1')
+        # a category takes precedence over a name
+        resp = self.app.get('/inventory', query_string='name=materials&category=widget1')
+        self.assertEqual([item['name'] for item in json.loads(resp.data)], ['tools'])
+
+    def test_list_low_stock(self):
+        """ Query Inventory with a count below a threshold """
+        resp = self.app.get('/inventory/low-stock', query_string='threshold=2')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]['name'], 'tools')
+        resp = self.app.get('/inventory/low-stock',
+                            query_string='threshold=5&category=widget2')
+        data = json.loads(resp.data)
+        self.assertEqual([item['name'] for item in data], ['materials'])
+
+    def test_list_low_stock_bad_threshold(self):
+        """ Query low stock without a numeric threshold or with a bad limit """
+        resp = self.app.get('/inventory/low-stock')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/inventory/low-stock', query_string='threshold=few')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        for limit in ('0', '-1'):
+            resp = self.app.get('/inventory/low-stock',
+                                query_string={'threshold': 2, 'limit': limit})
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_search_inventory(self):
+        """ Search Inventory by a name prefix """
+        resp = self.app.get('/inventory/search', query_string='q=ma')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual([item['name'] for item in data], ['materials'])
+        resp = self.app.get('/inventory/search')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/inventory/search', query_string='q=x&limit=-1')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_create_inventory_from_form(self):
+        """ Create an Inventory from a form, converting its fields """
+        form = {'name': 'hammer', 'category': 'tools', 'available': 'true',
+                'condition': 'new', 'count': '4'}
+        resp = self.app.post('/inventory', data=form,
+                             content_type='application/x-www-form-urlencoded')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        data = json.loads(resp.data)
+        self.assertEqual(data['count'], 4)
+        self.assertEqual(data['available'], True)
+        form['count'] = 'four'
+        resp = self.app.post('/inventory', data=form,
+                             content_type='application/x-www-form-urlencoded')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_import_inventory_csv(self):
+        """ Import Inventory from CSV """
+        body = ('name,category,available,condition,count\n'
+                'hammer,tools,true,new,4\n'
+                'nails,tools,true,new,40\n'
+                'saw,tools,false,used,x\n'
+                'drill,tools,false,used,2\n')
+        resp = self.app.post('/inventory/import', data=body, content_type='text/csv')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(data['imported'], 3)
+        self.assertEqual(data['failed'], 1)
+        self.assertEqual(data['errors'][0]['row'], 3)
+        drill = self.get_inventory('drill')[0]
+        self.assertEqual(drill['count'], 2)
+        self.assertEqual(drill['available'], False)
+
+    def test_import_inventory_csv_bad_rows(self):
+        """ Import CSV with rows that have extra columns or invalid UTF-8 """
+        body = (b'name,category,available,condition,count\n'
+                b'hammer,tools,true,new,4,extra\n'
+                b'caf\xe9,tools,true,new,1\n'
+                b'drill,tools,false,used,2\n')
+        resp = self.app.post('/inventory/import', data=body, content_type='text/csv')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(data['imported'], 1)
+        self.assertEqual([error['row'] for error in data['errors']], [1, 2])
+
+    def test_import_inventory_ndjson(self):
+        """ Import Inventory from NDJSON """
+        rows = [{'name': 'hammer', 'category': 'tools', 'available': True,
+                 'condition': 'new', 'count': 4},
+                {'name': 'saw'}]
+        body = '\n'.join(json.dumps(row) for row in rows) + '\nnot json\n'
+        resp = self.app.post('/inventory/import', data=body,
+                             content_type='application/x-ndjson')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(data['imported'], 1)
+        self.assertEqual([error['row'] for error in data['errors']], [2, 3])
+        self.assertEqual(self.get_inventory_count(), 3)
+        # a retried import with the same key is not imported again
+        resp = self.app.post('/inventory/import', data=body,
+                             content_type='application/x-ndjson',
+                             headers={'Idempotency-Key': 'import-1'})
+        self.assertEqual(json.loads(resp.data)['imported'], 1)
+        resp = self.app.post('/inventory/import', data=body,
+                             content_type='application/x-ndjson',
+                             headers={'Idempotency-Key': 'import-1'})
+        self.assertEqual(json.loads(resp.data)['imported'], 1)
+        self.assertEqual(resp.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(self.get_inventory_count(), 4)
+
+    def test_import_inventory_idempotent_across_workers(self):
+        """ Import a file once per Idempotency-Key in every worker """
+        body = ('name,category,available,condition,count\n'
+                'hammer,tools,true,new,4\n'
+                'saw,tools,false,used,x\n'
+                'drill,tools,false,used,2\n')
+        headers = {'Idempotency-Key': 'import-tools'}
+        resp = self.app.post('/inventory/import', data=body, content_type='text/csv',
+                             headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(resp.data)['imported'], 2)
+        idempotency.store.clear()   # as if the retry reached another worker
+        resp = self.app.post('/inventory/import', data=body, content_type='text/csv',
+                             headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual((data['imported'], data['failed']), (2, 1))
+        self.assertEqual(self.get_inventory_count(), 4)
+        # another file of the same size is another request
+        resp = self.app.post('/inventory/import', data=body.replace('hammer', 'mallet'),
+                             content_type='text/csv', headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_import_inventory_bad_media_type(self):
+        """ Import Inventory with an unsupported Content-Type """
+        resp = self.app.post('/inventory/import', data='{}', content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+    def test_export_inventory_ndjson(self):
+        """ Export Inventory as NDJSON """
+        resp = self.app.get('/inventory/export')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        rows = [json.loads(line) for line in resp.data.splitlines()]
+        self.assertEqual(sorted(row['name'] for row in rows), ['materials', 'tools'])
+
+    def test_export_inventory_csv(self):
+        """ Export selected fields of filtered Inventory as CSV """
+        resp = self.app.get('/inventory/export',
+                            query_string='format=csv&fields=name,count&category=widget1')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, 'text/csv')
+        self.assertEqual(resp.data.splitlines(), ['name,count', 'tools,1'])
+
+    def test_export_inventory_bad_request(self):
+        """ Export Inventory with an unknown format or field """
+        resp = self.app.get('/inventory/export', query_string='format=xml')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/inventory/export', query_string='fields=name,price')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @mock.patch('app.analytics.ANALYTICS_MAX_AGE', 0)
+    def test_inventory_analytics(self):
+        """ Get stock analytics """
+        resp = self.app.get('/inventory/analytics', query_string='top=1')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(data['items'], 2)
+        self.assertEqual(data['total'], 3)
+        self.assertEqual(data['by_category'], {'widget1': 1, 'widget2': 2})
+        self.assertEqual(data['percentiles']['50'], 1.5)
+        self.assertEqual([item['name'] for item in data['top']], ['materials'])
+        # changes are picked up incrementally
+        self.app.post('/inventory', data=json.dumps({'name': 'nails', 'category': 'widget1',
+                                                     'available': True, 'condition': 'new',
+                                                     'count': 10}),
+                      content_type='application/json')
+        resp = self.app.get('/inventory/analytics',
+                            query_string='group_by=condition&condition=new')
+        data = json.loads(resp.data)
+        self.assertEqual(data['items'], 2)
+        self.assertEqual(data['by_condition'], {'new': 11})
+        self.assertEqual(data['top'][0]['name'], 'nails')
+
+    def test_inventory_analytics_bad_request(self):
+        """ Get stock analytics with bad parameters """
+        resp = self.app.get('/inventory/analytics', query_string='group_by=name')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/inventory/analytics', query_string='percentiles=50,x')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_inventory_metrics(self):
+        """ Get the read path metrics """
+        resp = self.app.get('/inventory/metrics')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(data['hedging'], None)
+        self.assertEqual(data['routing'], None)
+        self.assertEqual(data['admission']['read']['inflight'], 0)
+        self.assertEqual(data['admission']['reset']['limit'], 1)
+
+    def test_admission_control(self):
+        """ Shed requests when their route class is at its limit """
+        controller = app.admission.AdmissionController()
+        controller.limits['read'] = app.admission.FixedLimit(0)
+        with mock.patch.object(app.admission, 'controller', controller):
+            resp = self.app.get('/inventory')
+            self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            self.assertEqual(resp.headers['Retry-After'], '1')
+            self.assertEqual(json.loads(resp.data)['error'], 'Service Unavailable')
+            # other classes and the metrics still answer
+            resp = self.app.post('/inventory', data=json.dumps(
+                {'name': 'nails', 'category': 'widget3', 'available': True,
+                 'condition': 'new', 'count': 5}), content_type='application/json')
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+            resp = self.app.get('/inventory/metrics')
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(controller.shed['read'], 1)
+        self.assertEqual((controller.admitted['write'], controller.inflight['write']), (1, 0))
+
+    def test_request_tracing(self):
+        """ Trace a request, continuing the client's trace """
+        exporter = app.tracing.configure('memory')
+        try:
+            inventory = self.get_inventory('tools')[0]
+            traceparent = '00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01'
+            resp = self.app.get('/inventory/{}'.format(inventory['id']),
+                                headers={'traceparent': traceparent})
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        finally:
+            app.tracing.configure('')
+        trace = exporter.traces[-1]
+        self.assertEqual(trace['name'], 'GET /inventory/<string:inventory_id>')
+        self.assertEqual(trace['trace_id'], '4bf92f3577b34da6a3ce929d0e0e4736')
+        self.assertEqual(trace['parent_id'], '00f067aa0ba902b7')
+        self.assertEqual(trace['attributes']['status'], 200)
+        self.assertEqual(trace['children'][0]['name'], 'Inventory.find')
+
+    def test_reserve_inventory(self):
+        """ Hold, commit and release stock of an Inventory """
+        inventory = Inventory.find_by_name('materials')[0]
+        url = '/inventory/{}/reservations'.format(inventory.id)
+        resp = self.app.post(url, json={'quantity': 1}, content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        held = json.loads(resp.data)
+        self.assertEqual(held['state'], 'held')
+        self.assertIn(held['id'], resp.headers['Location'])
+        resp = self.app.post(url, json={'quantity': 2}, content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        resp = self.app.get(url)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual((data['count'], data['held'], data['available']), (2, 1, 1))
+        headers = {'Idempotency-Key': 'hold-materials'}
+        resp = self.app.post(url, json={'quantity': 1, 'ttl': 60},
+                             content_type='application/json', headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        other = json.loads(resp.data)
+        idempotency.store.clear()   # a retry on another worker holds nothing more
+        resp = self.app.post(url, json={'quantity': 1, 'ttl': 60},
+                             content_type='application/json', headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(json.loads(resp.data)['id'], other['id'])
+        resp = self.app.post('{}/{}/commit'.format(url, held['id']))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(resp.data)['state'], 'committed')
+        resp = self.app.post('{}/{}/commit'.format(url, held['id']))
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        resp = self.app.delete('{}/{}'.format(url, other['id']))
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        resp = self.app.get(url)
+        self.assertEqual(json.loads(resp.data)['available'], 1)
+        # the Inventory itself was not written
+        self.assertEqual(Inventory.find(inventory.id).count, 2)
+
+    def test_reserve_inventory_errors(self):
+        """ Reject reservations of missing Inventory and bad quantities """
+        resp = self.app.post('/inventory/missing/reservations', json={'quantity': 1},
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.get('/inventory/missing/reservations')
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        inventory = Inventory.find_by_name('tools')[0]
+        url = '/inventory/{}/reservations'.format(inventory.id)
+        for body in ({}, {'quantity': 'many'}, {'quantity': 1, 'ttl': 'long'}):
+            resp = self.app.post(url, json=body, content_type='application/json')
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post(url + '/missing/commit')
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.delete(url + '/missing')
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+
+    def test_profile_worker(self):
+        """ Profile the worker through the debug endpoints """
+        resp = self.app.post('/debug/profile')
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        with mock.patch.multiple(app.profiling, PROFILING=True, PROFILING_TOKEN='secret'):
+            resp = self.app.post('/debug/profile', headers={'Authorization': 'Bearer wrong'})
+            self.assertEqual(resp.status_code, status.HTTP_401_UNAUTHORIZED)
+            headers = {'Authorization': 'Bearer secret'}
+            resp = self.app.post('/debug/profile', query_string='seconds=0',
+                                 headers=headers)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+            with mock.patch.object(app.profiling, 'PROFILE_INTERVAL', 0.01):
+                resp = self.app.post('/debug/profile', query_string='seconds=1',
+                                     headers=headers)
+                self.assertEqual(resp.status_code, status.HTTP_200_OK)
+                self.assertEqual(resp.mimetype, 'text/plain')
+            resp = self.app.post('/debug/profile', query_string='format=svg',
+                                 headers=headers)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+            resp = self.app.get('/debug/memory', headers=headers)
+            if app.profiling.tracemalloc is None:
+                self.assertEqual(resp.status_code, status.HTTP_501_NOT_IMPLEMENTED)
+            else:
+                self.assertEqual(resp.status_code, status.HTTP_200_OK)
+                self.assertTrue(json.loads(resp.data)['started'])
+                resp = self.app.get('/debug/memory', headers=headers)
+                self.assertIn('growth', json.loads(resp.data))
+            resp = self.app.delete('/debug/memory', headers=headers)
+            self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+
+    def test_list_inventory_changes(self):
+        """ Sync Inventory changes after a checkpoint """
+        resp = self.app.get('/inventory', query_string='since=0')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data['inventory']), 2)
+        self.assertTrue(data['complete'])
+        checkpoint = data['checkpoint']
+        # nothing changed since the checkpoint
+        resp = self.app.get('/inventory', query_string={'since': checkpoint})
+        data = json.loads(resp.data)
+        self.assertEqual(data['inventory'], [])
+        self.assertEqual(data['deleted'], [])
+        # one update and one delete
+        tools = self.get_inventory('tools')[0]
+        materials = self.get_inventory('materials')[0]
+        tools['count'] = 7
+        self.app.put('/inventory/{}'.format(tools['id']), data=json.dumps(tools),
+                     content_type='application/json')
+        self.app.delete('/inventory/{}'.format(materials['id']))
+        resp = self.app.get('/inventory', query_string={'since': checkpoint})
+        data = json.loads(resp.data)
+        self.assertEqual(data['inventory'], [tools])
+        self.assertEqual(data['deleted'], [materials['id']])
+        self.assertNotEqual(data['checkpoint'], checkpoint)
+
+    def test_list_inventory_changes_pages(self):
+        """ Sync every change a page at a time, past the design documents """
+        names = []
+        checkpoint, complete = 0, False
+        while not complete:
+            resp = self.app.get('/inventory', query_string={'since': checkpoint, 'limit': 1})
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            data = json.loads(resp.data)
+            names += [item['name'] for item in data['inventory']]
+            checkpoint, complete = data['checkpoint'], data['complete']
+        self.assertEqual(sorted(names), ['materials', 'tools'])
+
+    def test_list_inventory_changes_removed(self):
+        """ Sync with a filter reports Inventory that left it """
+        resp = self.app.get('/inventory', query_string='since=now')
+        checkpoint = json.loads(resp.data)['checkpoint']
+        tools = self.get_inventory('tools')[0]
+        tools['category'] = 'widget3'
+        self.app.put('/inventory/{}'.format(tools['id']), data=json.dumps(tools),
+                     content_type='application/json')
+        resp = self.app.get('/inventory', query_string={'since': checkpoint,
+                                                        'category': 'widget1'})
+        data = json.loads(resp.data)
+        self.assertEqual(data['inventory'], [])
+        self.assertEqual(data['removed'], [tools['id']])
+
+    def test_list_inventory_changes_bad_since(self):
+        """ Sync from a malformed checkpoint """
+        for since in ('yesterday', '-1', '7-'):
+            resp = self.app.get('/inventory', query_string={'since': since})
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/inventory', query_string='since=0&limit=0')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_stream_changes(self):
+        """ Stream Inventory changes from the start of the feed """
+        resp = self.app.get('/inventory/changes', query_string='since=0&category=widget2',
+                            buffered=False)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, 'text/event-stream')
+        event = next(iter(resp.response))
+        resp.close()
+        self.assertIn('event: update', event)
+        self.assertIn('"materials"', event)
+        self.assertNotIn('"tools"', event)
+
+    @mock.patch('app.service.QUERY_LIMIT', 1)
+    def test_stream_changes_pages(self):
+        """ Replay every change a page at a time, past the design documents """
+        resp = self.app.get('/inventory/changes', query_string='since=0', buffered=False)
+        events = iter(resp.response)
+        replayed = next(events) + next(events)
+        resp.close()
+        self.assertIn('"materials"', replayed)
+        self.assertIn('"tools"', replayed)
+
+    def test_stream_changes_bad_checkpoint(self):
+        """ Resume a stream from a malformed Last-Event-ID """
+        resp = self.app.get('/inventory/changes', headers={'Last-Event-ID': 'last'})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @mock.patch('app.compression.COMPRESS_MIN_SIZE', 0)
+    def test_gzip_inventory_list(self):
+        """ Get a gzip compressed list of Inventory """
+        resp = self.app.get('/inventory', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        data = json.loads(gzip.GzipFile(fileobj=io.BytesIO(resp.data)).read())
+        self.assertEqual(len(data), 2)
+
+    def test_small_response_not_compressed(self):
+        """ Responses below the size threshold are not compressed """
+        inventory = self.get_inventory('tools')[0]
+        resp = self.app.get('/inventory/{}'.format(inventory['id']),
+                            headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertEqual(json.loads(resp.data)['name'], 'tools')
+
+    def test_query_inventory_list_by_ids(self):
+        """ Query Inventory by a list of ids """
+        tools = self.get_inventory('tools')[0]
+        materials = self.get_inventory('materials')[0]
+        resp = self.app.get('/inventory',
+                            query_string='ids={},{}'.format(materials['id'], tools['id']))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(data, [materials, tools])
 
     @mock.patch('app.service.Inventory.find_by_name')
     def test_bad_request(self, bad_request_mock):